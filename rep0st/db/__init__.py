@@ -9,3 +9,12 @@ class PostType(enum.Enum):
   ANIMATED = 'ANIMATED'
   VIDEO = 'VIDEO'
   UNKNOWN = 'UNKNOWN'
+
+
+class MediaKind(enum.Enum):
+  # Image of image and animated posts.
+  IMAGE = 'IMAGE'
+  # Video of video posts.
+  VIDEO = 'VIDEO'
+  # Fullsize image of image posts.
+  FULLSIZE = 'FULLSIZE'
@@ -0,0 +1,159 @@
+from typing import Collection, List, NamedTuple
+
+from injector import Module, ProviderOf, inject
+from sqlalchemy import Column, DateTime, Enum, ForeignKey, Index, Integer, String, UniqueConstraint, func, select, update
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+from rep0st.config.rep0st_database import Rep0stDatabaseModule
+from rep0st.db import Base, MediaKind
+from rep0st.db.post import Post, main_media_kind
+from rep0st.framework.data.repository import Repository
+from rep0st.framework.data.transaction import transactional
+
+
+# Priority of the media of new posts.
+PRIORITY_NEW = 100
+# Priority of media downloaded again for existing posts.
+PRIORITY_REPAIR = 50
+# Priority of media of old posts found by the full post update.
+PRIORITY_BACKFILL = 0
+
+
+class DownloadQueueRepositoryModule(Module):
+
+  def configure(self, binder):
+    binder.install(Rep0stDatabaseModule)
+    binder.bind(DownloadQueueRepository)
+
+
+class DownloadQueueItem(Base):
+  __tablename__ = 'download_queue'
+  __table_args__ = (UniqueConstraint('post_id', 'media_kind'),)
+  # Id of the queue item.
+  id = Column(Integer, primary_key=True)
+  # Id of the post the media belongs to.
+  post_id = Column(Integer, ForeignKey('post.id'), nullable=False, index=True)
+  # Kind of the media to download.
+  media_kind = Column(Enum(MediaKind), nullable=False)
+  # Path of the media on pr0gramm servers.
+  path = Column(String(256), nullable=False)
+  # Items with a higher priority are downloaded first.
+  priority = Column(Integer, nullable=False, default=0)
+  # Number of times a worker claimed the item.
+  attempts = Column(Integer, nullable=False, default=0)
+  # The item is not claimed before this timestamp. Set when claiming an item,
+  # so it is picked up again if the worker dies, and when retrying.
+  visible_after = Column(DateTime(), nullable=False, server_default=func.now())
+  # Timestamp the item was added to the queue.
+  created = Column(DateTime(), nullable=False, server_default=func.now())
+  # Error of the last failed attempt.
+  last_error = Column(String(512))
+
+  def __str__(self):
+    return f'DownloadQueueItem(id={self.id}, post_id={self.post_id}, media_kind={self.media_kind})'
+
+  def __repr__(self):
+    return self.__str__()
+
+
+class ClaimedDownload(NamedTuple):
+  id: int
+  post_id: int
+  media_kind: MediaKind
+  path: str
+  # Number of attempts including this one.
+  attempts: int
+
+
+class QueuedDownload(NamedTuple):
+  post_id: int
+  media_kind: MediaKind
+  path: str
+  priority: int = 0
+
+
+class DownloadQueueRepository(Repository[int, DownloadQueueItem]):
+
+  indices = [
+      # Index matching the order items are claimed in.
+      Index('download_queue_claim_index', DownloadQueueItem.priority.desc(),
+            DownloadQueueItem.id),
+  ]
+
+  @inject
+  def __init__(self, session_provider: ProviderOf[Session]) -> None:
+    super().__init__(int, DownloadQueueItem, session_provider)
+
+  @transactional()
+  def enqueue_all(self, downloads: Collection[QueuedDownload]) -> None:
+    """Adds the downloads to the queue. Media already in the queue is kept."""
+    if not downloads:
+      return
+    self._get_session().connection().execute(
+        postgresql.insert(DownloadQueueItem).values([
+            download._asdict() for download in downloads
+        ]).on_conflict_do_nothing(index_elements=['post_id', 'media_kind']))
+
+  @transactional()
+  def enqueue_posts(self, posts: Collection[Post], priority: int) -> None:
+    """Adds the media of the posts to the queue."""
+    downloads = []
+    for post in posts:
+      if post.fullsize:
+        # Features are calculated from the fullsize image if it exists, so
+        # download it first.
+        downloads.append(
+            QueuedDownload(post.id, MediaKind.FULLSIZE, post.fullsize,
+                           priority + 1))
+      # Media of unknown type is downloaded as image. The feature job marks it
+      # broken if it cannot be read.
+      media_kind = main_media_kind(post) or MediaKind.IMAGE
+      downloads.append(QueuedDownload(post.id, media_kind, post.image, priority))
+    self.enqueue_all(downloads)
+
+  @transactional()
+  def claim(self, limit: int,
+            visibility_timeout: float) -> List[ClaimedDownload]:
+    """Claims the visible items with the highest priority.
+
+    Items locked by other workers are skipped. Claimed items are hidden for
+    visibility_timeout seconds and have to be completed or failed until then.
+    """
+    q = DownloadQueueItem
+    claimable = select(q.id).where(q.visible_after <= func.now()).order_by(
+        q.priority.desc(), q.id).limit(limit).with_for_update(skip_locked=True)
+    rows = self._get_session().connection().execute(
+        update(q).where(q.id.in_(claimable.scalar_subquery())).values(
+            attempts=q.attempts + 1,
+            visible_after=func.now() +
+            func.make_interval(0, 0, 0, 0, 0, 0, visibility_timeout)).returning(
+                q.id, q.post_id, q.media_kind, q.path, q.attempts)).all()
+    return [ClaimedDownload(*row) for row in rows]
+
+  @transactional()
+  def complete(self, id: int) -> None:
+    self.get_by_id(id).delete()
+
+  @transactional()
+  def retry(self, id: int, error: str, delay: float) -> None:
+    q = DownloadQueueItem
+    self._get_session().connection().execute(
+        update(q).where(q.id == id).values(
+            last_error=error[:512],
+            visible_after=func.now() +
+            func.make_interval(0, 0, 0, 0, 0, 0, delay)))
+
+  @transactional()
+  def depth(self) -> int:
+    session = self._get_session()
+    return session.query(func.count(DownloadQueueItem.id)).scalar()
+
+  @transactional()
+  def oldest_age(self) -> float:
+    """Returns the age of the oldest item in seconds."""
+    session = self._get_session()
+    age = session.query(
+        func.extract('epoch',
+                     func.now() - func.min(DownloadQueueItem.created))).scalar()
+    return 0 if age is None else float(age)
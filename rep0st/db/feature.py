@@ -1,11 +1,14 @@
+from typing import Collection
+
 from injector import Module, ProviderOf, inject
 from pgvector.sqlalchemy import Vector
 from sqlalchemy import Column, Enum, ForeignKey, Index, Integer
-from sqlalchemy.orm import Session, relationship
+from sqlalchemy.orm import Query, Session, relationship
 
 from rep0st.config.rep0st_database import Rep0stDatabaseModule
 from rep0st.db import Base, PostType
 from rep0st.framework.data.repository import CompoundKey, Repository
+from rep0st.framework.data.transaction import transactional
 
 
 class FeatureVectorRepositoryModule(Module):
@@ -56,9 +59,38 @@ class FeatureVectorRepository(Repository[FeatureVectorKey, FeatureVector]):
           },
           postgresql_ops={'vec': 'vector_l2_ops'},
           postgresql_where=FeatureVector.post_type == PostType.IMAGE,
-      )
+      ),
+      Index(
+          'feature_vector_post_type_animated_vec_approx',
+          FeatureVector.vec,
+          postgresql_using='hnsw',
+          postgresql_with={
+              'm': 16,
+              'ef_construction': 64
+          },
+          postgresql_ops={'vec': 'vector_l2_ops'},
+          postgresql_where=FeatureVector.post_type == PostType.ANIMATED,
+      ),
+      Index(
+          'feature_vector_post_type_video_vec_approx',
+          FeatureVector.vec,
+          postgresql_using='hnsw',
+          postgresql_with={
+              'm': 16,
+              'ef_construction': 64
+          },
+          postgresql_ops={'vec': 'vector_l2_ops'},
+          postgresql_where=FeatureVector.post_type == PostType.VIDEO,
+      ),
   ]
 
   @inject
   def __init__(self, session_provider: ProviderOf[Session]) -> None:
     super().__init__(FeatureVectorKey, FeatureVector, session_provider)
+
+  @transactional()
+  def get_by_post_ids(self, post_ids: Collection[int]) -> Query[FeatureVector]:
+    session = self._get_session()
+    return session.query(FeatureVector).filter(
+        FeatureVector.post_id.in_(post_ids)).order_by(FeatureVector.post_id,
+                                                      FeatureVector.id)
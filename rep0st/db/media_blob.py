@@ -0,0 +1,133 @@
+from typing import Collection, Dict, List, Tuple
+
+from injector import Module, ProviderOf, inject
+from sqlalchemy import BigInteger, Column, DateTime, Enum, ForeignKey, Integer, String, and_, delete, func, or_, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session, aliased
+
+from rep0st.config.rep0st_database import Rep0stDatabaseModule
+from rep0st.db import Base, MediaKind
+from rep0st.db.post import Post
+from rep0st.framework.data.repository import Repository
+from rep0st.framework.data.transaction import transactional
+
+
+class MediaBlobRepositoryModule(Module):
+
+  def configure(self, binder):
+    binder.install(Rep0stDatabaseModule)
+    binder.bind(MediaBlobRepository)
+
+
+class MediaBlob(Base):
+  __tablename__ = 'media_blob'
+  # Path of the media file relative to the media directory.
+  path = Column(String(256), primary_key=True)
+  # Id of the post the media belongs to.
+  post_id = Column(Integer, ForeignKey('post.id'), nullable=False, index=True)
+  # Kind of the media.
+  media_kind = Column(Enum(MediaKind), nullable=False)
+  # SHA-256 of the content of the media file as hex string.
+  sha256 = Column(String(64), nullable=False, index=True)
+  # Size of the media file in bytes.
+  size = Column(BigInteger(), nullable=False)
+  # Timestamp the media file was downloaded.
+  created = Column(DateTime(), nullable=False, server_default=func.now())
+
+  def __str__(self):
+    return f'MediaBlob(path={self.path}, post_id={self.post_id}, sha256={self.sha256})'
+
+  def __repr__(self):
+    return self.__str__()
+
+
+def _is_feature_source(blob, post):
+  # Features are calculated from the fullsize image if the post has one.
+  return or_(
+      and_(post.fullsize != None, blob.media_kind == MediaKind.FULLSIZE),
+      and_(post.fullsize == None, blob.media_kind != MediaKind.FULLSIZE))
+
+
+class MediaBlobRepository(Repository[str, MediaBlob]):
+  indices = []
+
+  @inject
+  def __init__(self, session_provider: ProviderOf[Session]) -> None:
+    super().__init__(str, MediaBlob, session_provider)
+
+  @transactional()
+  def record(self, path: str, post_id: int, media_kind: MediaKind, sha256: str,
+             size: int) -> None:
+    stmt = postgresql.insert(MediaBlob).values(
+        path=path,
+        post_id=post_id,
+        media_kind=media_kind,
+        sha256=sha256,
+        size=size)
+    self._get_session().connection().execute(
+        stmt.on_conflict_do_update(
+            index_elements=[MediaBlob.path],
+            set_={
+                'post_id': stmt.excluded.post_id,
+                'media_kind': stmt.excluded.media_kind,
+                'sha256': stmt.excluded.sha256,
+                'size': stmt.excluded.size,
+                'created': func.now(),
+            }))
+
+  @transactional()
+  def get_sizes(self, paths: Collection[str]) -> Dict[str, int]:
+    """Returns the recorded size of the media files with the given paths."""
+    if not paths:
+      return {}
+    return {
+        path: size for path, size in self._get_session().execute(
+            select(MediaBlob.path, MediaBlob.size).where(
+                MediaBlob.path.in_(paths)))
+    }
+
+  @transactional()
+  def get_deleted_post_blobs(self, start_id: int,
+                             end_id: int) -> List[Tuple[str, str]]:
+    """Returns path and SHA-256 of the media of deleted posts in the range."""
+    return [(path, sha256)
+            for path, sha256 in self._get_session().execute(
+                select(MediaBlob.path, MediaBlob.sha256).join(
+                    Post, Post.id == MediaBlob.post_id).where(
+                        Post.deleted == True, Post.id >= start_id,
+                        Post.id <= end_id))]
+
+  @transactional()
+  def delete_paths(self, paths: Collection[str]) -> None:
+    if not paths:
+      return
+    self._get_session().execute(
+        delete(MediaBlob).where(MediaBlob.path.in_(paths)))
+
+  @transactional()
+  def get_feature_sources(self, post_ids: Collection[int]) -> Dict[int, int]:
+    """Finds indexed posts with the same media as the given posts.
+
+    Returns a mapping from post id to the id of a post of the same type with
+    features calculated from identical media. Posts without such a post are
+    missing in the mapping.
+    """
+    if not post_ids:
+      return {}
+    blob, other_blob = aliased(MediaBlob), aliased(MediaBlob)
+    post, other_post = aliased(Post), aliased(Post)
+    rows = self._get_session().execute(
+        select(post.id, func.min(other_post.id)).join(
+            blob, blob.post_id == post.id).join(
+                other_blob,
+                and_(other_blob.sha256 == blob.sha256,
+                     other_blob.post_id != post.id)).join(
+                         other_post, other_post.id == other_blob.post_id).where(
+                             post.id.in_(post_ids),
+                             _is_feature_source(blob, post),
+                             _is_feature_source(other_blob, other_post),
+                             other_post.type == post.type,
+                             other_post.error_status == None,
+                             other_post.features_indexed == True).group_by(
+                                 post.id)).all()
+    return {post_id: source_id for post_id, source_id in rows}
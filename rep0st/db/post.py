@@ -1,19 +1,23 @@
 import enum
 import logging
 import math
-from typing import List, Optional
+from typing import Collection, List, NamedTuple, Optional, Tuple
 
 from injector import Module, ProviderOf, inject
 import numpy
 from numpy.typing import NDArray
-from sqlalchemy import Boolean, Column, DateTime, Enum, Index, Integer, String, and_, func, text
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import Boolean, Column, DateTime, Enum, Index, Integer, MetaData, String, Table, and_, bindparam, cast, column, delete, distinct, exists, func, insert, literal_column, select, text, true, update, values
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import Query, Session, relationship
 
 from rep0st.config.rep0st_database import Rep0stDatabaseModule
-from rep0st.db import Base, PostType
+from rep0st.db import Base, MediaKind, PostType
 from rep0st.db.feature import FeatureVector
+from rep0st.db.tag import TagFilter, tag_filter_cte
 from rep0st.framework.data.repository import Repository
 from rep0st.framework.data.transaction import transactional
+from rep0st.framework.execute import execute
 
 log = logging.getLogger(__name__)
 
@@ -80,11 +84,22 @@ class PostErrorStatus(enum.Enum):
   NO_MEDIA_FOUND = 'NO_MEDIA_FOUND'
   # The downloaded media cannot be read.
   MEDIA_BROKEN = 'MEDIA_BROKEN'
+  # The post was saved, but its media is not downloaded yet.
+  MEDIA_PENDING = 'MEDIA_PENDING'
+  # The media could not be downloaded or read after all retries. The post is
+  # not retried anymore.
+  MEDIA_UNAVAILABLE = 'MEDIA_UNAVAILABLE'
+
+
+# Error statuses retried with backoff until they reach MEDIA_UNAVAILABLE.
+RETRIED_ERROR_STATUSES = [
+    PostErrorStatus.NO_MEDIA_FOUND, PostErrorStatus.MEDIA_BROKEN
+]
 
 
 class Post(Base):
   from rep0st.db.feature import FeatureVector
-  from rep0st.db.tag import Tag
+  from rep0st.db.tag import PostTagSummary, Tag
 
   __tablename__ = 'post'
   # Post id.
@@ -132,6 +147,18 @@ class Post(Base):
       Boolean(), nullable=False, index=True, default=False)
   # List of tags associated with this post.
   tags = relationship(Tag)
+  # Summary of the tags of this post. Queries serializing a list of posts
+  # load it with selectinload, so the tags of every post are not queried one
+  # by one.
+  tag_summary = relationship(PostTagSummary, uselist=False, viewonly=True)
+  # Number of times the media was retried after an error.
+  media_retries = Column(Integer(), nullable=False, default=0)
+  # Timestamp the media is retried next. Only set for posts with an error
+  # status that is retried.
+  media_retry_after = Column(DateTime(), nullable=True)
+  # True if duplicates of this post were searched after its features were
+  # indexed.
+  duplicates_searched = Column(Boolean(), nullable=False, default=False)
 
   def __json__(self):
     return {
@@ -146,6 +173,7 @@ class Post(Base):
         'image': self.image,
         'thumb': self.thumb,
         'fullsize': self.fullsize,
+        'tags': self.tag_summary.tags if self.tag_summary else [],
     }
 
   def is_sfw(self):
@@ -173,18 +201,98 @@ class Post(Base):
     return "Post(id=" + str(self.id) + ")"
 
 
+def main_media_kind(post: Post) -> Optional[MediaKind]:
+  """Returns the kind of the media features are calculated from."""
+  if post.type == PostType.IMAGE or post.type == PostType.ANIMATED:
+    return MediaKind.IMAGE
+  elif post.type == PostType.VIDEO:
+    return MediaKind.VIDEO
+  return None
+
+
+# Temporary table holding the state of a range of posts from the API to
+# reconcile the database with. Dropped at the end of the transaction.
+_post_sync_table = Table(
+    'post_sync',
+    MetaData(),
+    Column('id', Integer, primary_key=True),
+    Column('flags', Integer),
+    prefixes=['TEMPORARY'],
+    postgresql_on_commit='DROP')
+
+
+# Columns of a post that come from the API. Only these are updated if a post is
+# upserted again.
+_POST_METADATA_COLUMNS = [
+    'created', 'image', 'thumb', 'fullsize', 'width', 'height', 'audio',
+    'source', 'flags', 'username', 'type'
+]
+
+
+class ReconcileResult(NamedTuple):
+  # Ids of posts returned by the API, but missing in the database.
+  missing_ids: List[int]
+  # Ids of posts marked deleted since the API no longer returns them.
+  deleted_ids: List[int]
+  # Ids of posts unmarked deleted since the API returns them again.
+  undeleted_ids: List[int]
+  # Number of posts where the flags changed.
+  flags_changed: int
+
+
 class PostRepository(Repository[int, Post]):
 
   indices = [
       # Index on error_status, type and deleted and features_indexed for fast missing feature lookups.
       Index('post_error_status_type_deleted_features_indexed_index',
             Post.error_status, Post.type, Post.deleted, Post.features_indexed),
+      # Index for finding posts due for a media retry.
+      Index('post_error_status_media_retry_after_index', Post.error_status,
+            Post.media_retry_after),
+      # Partial index for finding indexed posts without a duplicate search.
+      Index(
+          'post_duplicates_not_searched_index',
+          Post.id,
+          postgresql_where=and_(Post.features_indexed == True,
+                                Post.duplicates_searched == False)),
   ]
 
   @inject
   def __init__(self, session_provider: ProviderOf[Session]) -> None:
     super().__init__(int, Post, session_provider)
 
+  @execute(-1001)
+  @transactional()
+  def initialize_error_status_values(self):
+    # create_all() does not update existing enum types, so add values that
+    # were added later by hand.
+    connection = self._get_session().connection()
+    for error_status in PostErrorStatus:
+      connection.execute(
+          text(
+              f"ALTER TYPE posterrorstatus ADD VALUE IF NOT EXISTS '{error_status.value}'"
+          ))
+
+  @execute(-1001)
+  @transactional()
+  def initialize_media_retry_columns(self):
+    # create_all() does not add columns to existing tables.
+    connection = self._get_session().connection()
+    connection.execute(
+        text('ALTER TABLE post ADD COLUMN IF NOT EXISTS '
+             'media_retries INTEGER NOT NULL DEFAULT 0'))
+    connection.execute(
+        text('ALTER TABLE post ADD COLUMN IF NOT EXISTS '
+             'media_retry_after TIMESTAMP WITHOUT TIME ZONE'))
+
+  @execute(-1001)
+  @transactional()
+  def initialize_duplicates_searched_column(self):
+    # create_all() does not add columns to existing tables.
+    self._get_session().connection().execute(
+        text('ALTER TABLE post ADD COLUMN IF NOT EXISTS '
+             'duplicates_searched BOOLEAN NOT NULL DEFAULT false'))
+
   @transactional()
   def get_latest_post_id(self) -> int:
     session = self._get_session()
@@ -199,6 +307,165 @@ class PostRepository(Repository[int, Post]):
     else:
       return session.query(Post)
 
+  @transactional()
+  def schedule_media_retries(self, delay: float, max_delay: float) -> int:
+    """Schedules the next retry of posts with a retried error status.
+
+    The delay doubles with every retry, up to max_delay seconds. Returns the
+    number of scheduled posts.
+    """
+    backoff = func.least(delay * func.power(2, Post.media_retries), max_delay)
+    return self._get_session().connection().execute(
+        update(Post).where(
+            and_(
+                Post.error_status.in_(RETRIED_ERROR_STATUSES),
+                Post.deleted == False, Post.media_retry_after == None)).values(
+                    media_retry_after=func.now() +
+                    func.make_interval(0, 0, 0, 0, 0, 0, backoff))).rowcount
+
+  @transactional()
+  def give_up_media_retries(self, max_retries: int) -> int:
+    """Marks due posts without retries left as MEDIA_UNAVAILABLE.
+
+    Returns the number of marked posts.
+    """
+    return self._get_session().connection().execute(
+        update(Post).where(
+            and_(Post.error_status.in_(RETRIED_ERROR_STATUSES),
+                 Post.media_retry_after <= func.now(),
+                 Post.media_retries >= max_retries)).values(
+                     error_status=PostErrorStatus.MEDIA_UNAVAILABLE,
+                     media_retry_after=None)).rowcount
+
+  @transactional()
+  def claim_media_retries(self, limit: int, delay: float,
+                          max_delay: float) -> List[int]:
+    """Claims posts due for a media retry and schedules their next retry.
+
+    If the retry succeeds, the error status of the post is reset. Otherwise
+    the post is retried again at the scheduled time. Returns the ids of the
+    claimed posts.
+    """
+    due = select(Post.id).where(
+        and_(Post.error_status.in_(RETRIED_ERROR_STATUSES),
+             Post.deleted == False,
+             Post.media_retry_after <= func.now())).order_by(
+                 Post.media_retry_after).limit(limit).with_for_update(
+                     skip_locked=True)
+    backoff = func.least(delay * func.power(2, Post.media_retries + 1),
+                         max_delay)
+    return self._get_session().connection().execute(
+        update(Post).where(Post.id.in_(due.scalar_subquery())).values(
+            media_retries=Post.media_retries + 1,
+            media_retry_after=func.now() +
+            func.make_interval(0, 0, 0, 0, 0, 0, backoff)).returning(
+                Post.id)).scalars().all()
+
+  @transactional()
+  def mark_error_status(self, post_ids: Collection[int],
+                        error_status: PostErrorStatus) -> int:
+    """Sets the error status of the posts. Returns the number of posts."""
+    if not post_ids:
+      return 0
+    return self._get_session().connection().execute(
+        update(Post).where(Post.id.in_(post_ids)).values(
+            error_status=error_status)).rowcount
+
+  @transactional()
+  def get_post_ids_with_error_status(
+      self, error_status: PostErrorStatus) -> List[int]:
+    session = self._get_session()
+    return session.scalars(
+        select(Post.id).where(Post.error_status == error_status).order_by(
+            Post.id)).all()
+
+  @transactional()
+  def get_media_paths(self, type: PostType, start_id: int,
+                      end_id: int) -> List[Tuple[str, Optional[str]]]:
+    """Returns image and fullsize path of the undeleted posts in the range."""
+    session = self._get_session()
+    return [
+        (image, fullsize) for image, fullsize in session.execute(
+            select(Post.image, Post.fullsize).where(
+                Post.type == type, Post.deleted == False, Post.id >= start_id,
+                Post.id <= end_id).order_by(Post.id))
+    ]
+
+  @transactional()
+  def upsert_all(
+      self,
+      posts: Collection[Post],
+      error_status: Optional[PostErrorStatus] = None) -> List[int]:
+    """Inserts the posts with a single statement.
+
+    Posts that already exist only get their metadata updated. New posts are
+    saved with the given error status and whether their features are
+    indexed. Returns the ids of the inserted posts.
+    """
+    if not posts:
+      return []
+    stmt = postgresql.insert(Post).values([
+        dict({c: getattr(post, c) for c in _POST_METADATA_COLUMNS},
+             id=post.id,
+             error_status=error_status,
+             deleted=False,
+             features_indexed=bool(post.features_indexed)) for post in posts
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Post.id],
+        set_={c: stmt.excluded[c] for c in _POST_METADATA_COLUMNS})
+    # xmax is only 0 for rows that were inserted, not updated.
+    rows = self._get_session().connection().execute(
+        stmt.returning(Post.id,
+                       literal_column('xmax = 0').label('inserted'))).all()
+    return [id for id, inserted in rows if inserted]
+
+  @transactional()
+  def reconcile_posts(self, posts: Collection[Post], start_id: int,
+                      end_id: int) -> ReconcileResult:
+    """Reconciles the posts in the id range with the posts from the API.
+
+    Marks posts missing in the API as deleted, unmarks posts that are returned
+    again and updates changed flags, all without loading the posts. Posts
+    missing in the database are only reported and have to be added by the
+    caller.
+    """
+    connection = self._get_session().connection()
+    _post_sync_table.create(bind=connection)
+    if posts:
+      connection.execute(
+          insert(_post_sync_table), [{
+              'id': post.id,
+              'flags': post.flags
+          } for post in posts])
+    sync = _post_sync_table.c
+
+    missing_ids = connection.execute(
+        select(sync.id).where(~exists().where(Post.id == sync.id)).order_by(
+            sync.id)).scalars().all()
+    deleted_ids = connection.execute(
+        update(Post).where(
+            and_(Post.id >= start_id, Post.id <= end_id, Post.deleted == False,
+                 ~exists().where(sync.id == Post.id))).values(
+                     deleted=True,
+                     features_indexed=False).returning(Post.id)).scalars().all()
+    if deleted_ids:
+      # Remove the features from the DB for good measure.
+      connection.execute(
+          delete(FeatureVector).where(FeatureVector.post_id.in_(deleted_ids)))
+    undeleted_ids = connection.execute(
+        update(Post).where(and_(Post.id == sync.id,
+                                Post.deleted == True)).values(
+                                    deleted=False).returning(
+                                        Post.id)).scalars().all()
+    flags_changed = connection.execute(
+        update(Post).where(
+            and_(Post.id == sync.id, sync.flags != None,
+                 Post.flags.is_distinct_from(sync.flags))).values(
+                     flags=sync.flags)).rowcount
+    return ReconcileResult(missing_ids, deleted_ids, undeleted_ids,
+                           flags_changed)
+
   @transactional()
   def get_posts_missing_features(self, type: Optional[PostType] = None):
     session = self._get_session()
@@ -209,6 +476,15 @@ class PostRepository(Repository[int, Post]):
         and_(Post.error_status == None, Post.deleted == False,
              Post.features_indexed == False)).order_by(Post.id)
 
+  @transactional()
+  def get_posts_missing_duplicate_search(self, limit: int) -> List[Post]:
+    session = self._get_session()
+    # Matches the partial index, deleted posts are searched as well.
+    return session.query(Post).filter(
+        and_(Post.features_indexed == True,
+             Post.duplicates_searched == False)).order_by(
+                 Post.id).limit(limit).all()
+
   @transactional()
   def post_count(self) -> int:
     session = self._get_session()
@@ -234,7 +510,8 @@ class PostRepository(Repository[int, Post]):
                    feature_vector: NDArray[numpy.float32],
                    flags: list[Flag] | None = None,
                    exact: bool | None = False,
-                   ef_search: int | None = None) -> Query[Post]:
+                   ef_search: int | None = None,
+                   tags: list[TagFilter] | None = None) -> Query[Post]:
     session = self._get_session()
     if exact:
       session.connection().execute(text('SET enable_indexscan = off'))
@@ -252,4 +529,73 @@ class PostRepository(Repository[int, Post]):
                 FeatureVector.vec.l2_distance(feature_vector))
     if flags:
       q = q.filter(Post.flags.op('&')(flags_to_flagbits(flags)) > 0)
+    if tags:
+      q = q.filter(Post.id.in_(select(tag_filter_cte(tags).c.post_id)))
     return q
+
+  @transactional()
+  def search_posts_multi(self,
+                         type: PostType,
+                         feature_vectors: List[NDArray[numpy.float32]],
+                         flags: list[Flag] | None = None,
+                         exact: bool | None = False,
+                         ef_search: int | None = None,
+                         limit_per_vector: int = 50,
+                         order_by_votes: bool = False,
+                         tags: list[TagFilter] | None = None) -> Query:
+    """Searches posts for multiple feature vectors at once.
+
+    Every feature vector gets its own nearest neighbour lookup, which can use
+    the index. The results are aggregated per post: `score` is the score of
+    the best matching frame and `votes` the number of query feature vectors
+    the post was found for. Results are ordered by score, or by votes first if
+    order_by_votes is set.
+    """
+    session = self._get_session()
+    if exact:
+      session.connection().execute(text('SET enable_indexscan = off'))
+    if ef_search:
+      session.connection().execute(text(f'SET hnsw.ef_search = {ef_search}'))
+    # Every vector is sent as a typed parameter and cast explicitly. Otherwise
+    # PostgreSQL types the VALUES column as text and the distance operator
+    # fails.
+    query_vectors = values(
+        column('idx', Integer),
+        column('vec', Vector(108)),
+        name='query_vectors').data([
+            (i,
+             cast(
+                 bindparam(
+                     f'query_vector_{i}',
+                     feature_vector,
+                     Vector(108),
+                     unique=True),
+                 Vector(108)))
+            for i, feature_vector in enumerate(feature_vectors)
+        ])
+    distance = FeatureVector.vec.l2_distance(query_vectors.c.vec)
+    candidates = select(
+        FeatureVector.post_id.label('post_id'),
+        distance.label('distance')).join(
+            Post, Post.id == FeatureVector.post_id).where(
+                FeatureVector.post_type == type)
+    if flags:
+      candidates = candidates.where(
+          Post.flags.op('&')(flags_to_flagbits(flags)) > 0)
+    if tags:
+      candidates = candidates.where(
+          Post.id.in_(select(tag_filter_cte(tags).c.post_id)))
+    candidates = candidates.order_by(distance).limit(
+        limit_per_vector).lateral('candidates')
+    matches = session.query(
+        candidates.c.post_id.label('post_id'),
+        # See search_posts for the calculation of the score.
+        (1 - (func.min(candidates.c.distance) / math.sqrt(108))).label('score'),
+        func.count(distinct(query_vectors.c.idx)).label('votes')).select_from(
+            query_vectors).join(candidates, true()).group_by(
+                candidates.c.post_id).subquery()
+    order_by = [matches.c.score.desc()]
+    if order_by_votes:
+      order_by.insert(0, matches.c.votes.desc())
+    return session.query(matches.c.score, matches.c.votes, Post).join(
+        Post, Post.id == matches.c.post_id).order_by(*order_by)
@@ -0,0 +1,247 @@
+from collections import Counter
+from typing import Collection, Dict, List, NamedTuple, Optional
+
+from injector import Module, ProviderOf, inject
+from sqlalchemy import Column, DateTime, Float, ForeignKey, Integer, delete, func, or_, select, update
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+from rep0st.config.rep0st_database import Rep0stDatabaseModule
+from rep0st.db import Base
+from rep0st.framework.data.repository import Repository
+from rep0st.framework.data.transaction import transactional
+
+# Channel reposts found by the repost stream are published on.
+REPOST_CHANNEL = 'rep0st_reposts'
+# Key of the advisory lock serializing changes to the clusters.
+_CLUSTER_LOCK = 0x72657030
+
+
+class PostDuplicateRepositoryModule(Module):
+
+  def configure(self, binder):
+    binder.install(Rep0stDatabaseModule)
+    binder.bind(PostDuplicateRepository)
+
+
+class PostDuplicate(Base):
+  __tablename__ = 'post_duplicate'
+  # Id of the older post. Always smaller than duplicate_id.
+  post_id = Column(Integer, ForeignKey('post.id'), primary_key=True)
+  # Id of the newer post.
+  duplicate_id = Column(
+      Integer, ForeignKey('post.id'), primary_key=True, index=True)
+  # Similarity of the best matching feature vectors of both posts.
+  score = Column(Float, nullable=False)
+  # Timestamp the duplicate was found.
+  created = Column(DateTime(), nullable=False, server_default=func.now())
+
+  def __str__(self):
+    return f'PostDuplicate(post_id={self.post_id}, duplicate_id={self.duplicate_id}, score={self.score})'
+
+  def __repr__(self):
+    return self.__str__()
+
+
+class PostCluster(Base):
+  __tablename__ = 'post_cluster'
+  # Id of the post. Only posts with at least one duplicate have a cluster.
+  post_id = Column(Integer, ForeignKey('post.id'), primary_key=True)
+  # Id of the oldest post in the cluster.
+  cluster_id = Column(Integer, nullable=False, index=True)
+
+  def __str__(self):
+    return f'PostCluster(post_id={self.post_id}, cluster_id={self.cluster_id})'
+
+  def __repr__(self):
+    return self.__str__()
+
+
+class Duplicate(NamedTuple):
+  post_id: int
+  duplicate_id: int
+  score: float
+
+
+class ClusterMember(NamedTuple):
+  post_id: int
+  # Score of the duplicate between the member and the requested post. None if
+  # they are only connected through other posts of the cluster.
+  score: Optional[float]
+
+
+class PostDuplicateRepository(Repository[int, PostDuplicate]):
+  indices = []
+
+  @inject
+  def __init__(self, session_provider: ProviderOf[Session]) -> None:
+    super().__init__(int, PostDuplicate, session_provider)
+
+  def _lock_clusters(self) -> None:
+    # Clusters are read, merged or split in Python and written back. Changes
+    # from other processes in between would be overwritten, so they are
+    # serialized until the transaction ends.
+    self._get_session().execute(
+        select(func.pg_advisory_xact_lock(_CLUSTER_LOCK)))
+
+  @transactional()
+  def add_duplicates(self, duplicates: Collection[Duplicate]) -> None:
+    """Saves the duplicates and merges the clusters of their posts."""
+    if not duplicates:
+      return
+    self._lock_clusters()
+    connection = self._get_session().connection()
+    edges = {}
+    for d in duplicates:
+      key = (min(d.post_id, d.duplicate_id), max(d.post_id, d.duplicate_id))
+      edges[key] = max(d.score, edges.get(key, d.score))
+    stmt = postgresql.insert(PostDuplicate).values([{
+        'post_id': post_id,
+        'duplicate_id': duplicate_id,
+        'score': score
+    } for (post_id, duplicate_id), score in edges.items()])
+    connection.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[PostDuplicate.post_id, PostDuplicate.duplicate_id],
+            set_={'score': func.greatest(PostDuplicate.score,
+                                         stmt.excluded.score)}))
+
+    # Union-find over the existing clusters of the posts. A post without a
+    # cluster is its own cluster. The smallest cluster id becomes the root.
+    post_ids = {post_id for edge in edges for post_id in edge}
+    clusters: Dict[int, int] = {
+        post_id: cluster_id for post_id, cluster_id in connection.execute(
+            select(PostCluster.post_id, PostCluster.cluster_id).where(
+                PostCluster.post_id.in_(post_ids)))
+    }
+    parent: Dict[int, int] = {}
+
+    def find(x: int) -> int:
+      root = x
+      while parent.get(root, root) != root:
+        root = parent[root]
+      while x != root:
+        parent[x], x = root, parent.get(x, x)
+      return root
+
+    for post_id, duplicate_id in edges:
+      a = find(clusters.get(post_id, post_id))
+      b = find(clusters.get(duplicate_id, duplicate_id))
+      if a != b:
+        parent[max(a, b)] = min(a, b)
+
+    # Move the members of merged clusters to the new root.
+    merged: Dict[int, List[int]] = {}
+    for cluster_id in set(clusters.values()):
+      root = find(cluster_id)
+      if root != cluster_id:
+        merged.setdefault(root, []).append(cluster_id)
+    for root, cluster_ids in merged.items():
+      connection.execute(
+          update(PostCluster).where(
+              PostCluster.cluster_id.in_(cluster_ids)).values(cluster_id=root))
+    stmt = postgresql.insert(PostCluster).values([{
+        'post_id': post_id,
+        'cluster_id': find(clusters.get(post_id, post_id))
+    } for post_id in post_ids])
+    connection.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[PostCluster.post_id],
+            set_={'cluster_id': stmt.excluded.cluster_id}))
+
+  @transactional()
+  def remove_post(self, post_id: int) -> None:
+    """Removes the duplicates of the post and splits its cluster.
+
+    The other members of the cluster might only have been connected through
+    the post, so their clusters are derived again from the remaining
+    duplicates.
+    """
+    self._lock_clusters()
+    connection = self._get_session().connection()
+    cluster_id = self.get_cluster_id(post_id)
+    connection.execute(
+        delete(PostDuplicate).where(
+            or_(PostDuplicate.post_id == post_id,
+                PostDuplicate.duplicate_id == post_id)))
+    if cluster_id is None:
+      return
+    connection.execute(
+        delete(PostCluster).where(PostCluster.post_id == post_id))
+    member_ids = connection.execute(
+        select(PostCluster.post_id).where(
+            PostCluster.cluster_id == cluster_id)).scalars().all()
+    if not member_ids:
+      return
+
+    # Union-find over the remaining duplicates of the cluster. The oldest
+    # post of a component becomes its cluster id.
+    parent: Dict[int, int] = {}
+
+    def find(x: int) -> int:
+      root = x
+      while parent.get(root, root) != root:
+        root = parent[root]
+      while x != root:
+        parent[x], x = root, parent.get(x, x)
+      return root
+
+    for a, b in connection.execute(
+        select(PostDuplicate.post_id, PostDuplicate.duplicate_id).where(
+            PostDuplicate.post_id.in_(member_ids))):
+      a, b = find(a), find(b)
+      if a != b:
+        parent[max(a, b)] = min(a, b)
+
+    # Posts without duplicates left have no cluster.
+    sizes = Counter(find(member_id) for member_id in member_ids)
+    removed = [
+        member_id for member_id in member_ids if sizes[find(member_id)] == 1
+    ]
+    if removed:
+      connection.execute(
+          delete(PostCluster).where(PostCluster.post_id.in_(removed)))
+    moved: Dict[int, List[int]] = {}
+    for member_id in member_ids:
+      root = find(member_id)
+      if root != cluster_id and sizes[root] > 1:
+        moved.setdefault(root, []).append(member_id)
+    for root, moved_ids in moved.items():
+      connection.execute(
+          update(PostCluster).where(
+              PostCluster.post_id.in_(moved_ids)).values(cluster_id=root))
+
+  @transactional()
+  def notify_reposts(self, payloads: Collection[str]) -> None:
+    """Publishes the payloads on REPOST_CHANNEL once the transaction commits."""
+    session = self._get_session()
+    for payload in payloads:
+      session.execute(select(func.pg_notify(REPOST_CHANNEL, payload)))
+
+  @transactional()
+  def get_cluster_id(self, post_id: int) -> Optional[int]:
+    session = self._get_session()
+    return session.scalar(
+        select(PostCluster.cluster_id).where(PostCluster.post_id == post_id))
+
+  @transactional()
+  def get_cluster(self, post_id: int) -> List[ClusterMember]:
+    """Returns the other posts in the cluster of the post, oldest first."""
+    cluster_id = self.get_cluster_id(post_id)
+    if cluster_id is None:
+      return []
+    session = self._get_session()
+    scores = {
+        (d.duplicate_id if d.post_id == post_id else d.post_id): d.score
+        for d in session.scalars(
+            select(PostDuplicate).where(
+                or_(PostDuplicate.post_id == post_id,
+                    PostDuplicate.duplicate_id == post_id)))
+    }
+    return [
+        ClusterMember(member_id, scores.get(member_id))
+        for member_id in session.scalars(
+            select(PostCluster.post_id).where(
+                PostCluster.cluster_id == cluster_id,
+                PostCluster.post_id != post_id).order_by(PostCluster.post_id))
+    ]
@@ -0,0 +1,109 @@
+from datetime import datetime
+import os
+
+from absl.testing import absltest
+import numpy
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+
+from rep0st.db import Base, PostType
+from rep0st.db.feature import FeatureVector
+from rep0st.db.post import Post, PostRepository
+
+# URI of a PostgreSQL database with the pgvector extension available, e.g.
+# postgresql+psycopg2://rep0st:pw@127.0.0.1:5432/rep0st. The tests run in a
+# schema that is dropped afterwards.
+_DATABASE_URI = os.environ.get('REP0ST_TEST_DATABASE_URI')
+_SCHEMA = f'rep0st_test_{os.getpid()}'
+
+
+class _SessionProvider:
+
+  def __init__(self, session: Session):
+    self.session = session
+
+  def get(self) -> Session:
+    return self.session
+
+
+def _post(id: int, type: PostType) -> Post:
+  return Post(
+      id=id,
+      created=datetime(2024, 1, 1),
+      image=f'2024/01/01/{id}.mp4',
+      thumb=f'2024/01/01/{id}.jpg',
+      width=100,
+      height=100,
+      audio=False,
+      flags=1,
+      username='test',
+      type=type,
+      features_indexed=True)
+
+
+@absltest.skipUnless(_DATABASE_URI, 'REP0ST_TEST_DATABASE_URI is not set')
+class SearchPostsMultiTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.engine = create_engine(_DATABASE_URI)
+    self.connection = self.engine.connect()
+    self.connection.execute(text('CREATE EXTENSION IF NOT EXISTS vector'))
+    self.connection.execute(text(f'CREATE SCHEMA {_SCHEMA}'))
+    self.connection.execute(text(f'SET search_path TO {_SCHEMA}, public'))
+    Base.metadata.create_all(self.connection)
+    self.session = Session(bind=self.connection)
+    self.repository = PostRepository(_SessionProvider(self.session))
+
+  def tearDown(self):
+    self.session.close()
+    self.connection.rollback()
+    self.connection.execute(text(f'DROP SCHEMA IF EXISTS {_SCHEMA} CASCADE'))
+    self.connection.commit()
+    self.connection.close()
+    self.engine.dispose()
+    super().tearDown()
+
+  def _add(self, post: Post, *vecs: numpy.ndarray) -> None:
+    post.feature_vectors = [
+        FeatureVector(id=i, post_type=post.type, vec=vec)
+        for i, vec in enumerate(vecs)
+    ]
+    self.session.add(post)
+    self.session.flush()
+
+  def _search(self, *args, **kwargs):
+    # Call the query builder directly, the transaction is handled by the test.
+    return PostRepository.search_posts_multi.__wrapped__(
+        self.repository, *args, **kwargs).all()
+
+  def test_ranks_posts_by_best_matching_frame(self):
+    a = numpy.zeros(108, dtype=numpy.float32)
+    b = numpy.ones(108, dtype=numpy.float32)
+    self._add(_post(1, PostType.VIDEO), a, b)
+    self._add(_post(2, PostType.VIDEO), b * 0.5)
+    self._add(_post(3, PostType.IMAGE), a)
+
+    results = self._search(PostType.VIDEO, [a, b], limit_per_vector=10)
+
+    self.assertEqual([post.id for _, _, post in results], [1, 2])
+    score, votes, _ = results[0]
+    self.assertAlmostEqual(score, 1.0, places=5)
+    self.assertEqual(votes, 2)
+
+  def test_orders_by_votes(self):
+    a = numpy.zeros(108, dtype=numpy.float32)
+    b = numpy.full(108, 0.1, dtype=numpy.float32)
+    c = numpy.full(108, 0.2, dtype=numpy.float32)
+    self._add(_post(1, PostType.ANIMATED), a)
+    self._add(_post(2, PostType.ANIMATED), b, c)
+
+    results = self._search(
+        PostType.ANIMATED, [a, b, c], limit_per_vector=1, order_by_votes=True)
+
+    self.assertEqual([(post.id, votes) for _, votes, post in results],
+                     [(2, 2), (1, 1)])
+
+
+if __name__ == '__main__':
+  absltest.main()
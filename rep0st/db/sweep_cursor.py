@@ -0,0 +1,61 @@
+from datetime import datetime
+
+from injector import Module, ProviderOf, inject
+from sqlalchemy import Column, DateTime, Integer, String
+from sqlalchemy.orm import Session
+
+from rep0st.config.rep0st_database import Rep0stDatabaseModule
+from rep0st.db import Base
+from rep0st.framework.data.repository import Repository
+from rep0st.framework.data.transaction import transactional
+
+
+class SweepCursorRepositoryModule(Module):
+
+  def configure(self, binder):
+    binder.install(Rep0stDatabaseModule)
+    binder.bind(SweepCursorRepository)
+
+
+class SweepCursor(Base):
+  __tablename__ = 'sweep_cursor'
+  # Name of the sweep this cursor belongs to.
+  name = Column(String(64), primary_key=True)
+  # Last id processed in the current pass.
+  position = Column(Integer, nullable=False, default=0)
+  # Timestamp the current pass started.
+  pass_started = Column(DateTime(), nullable=True)
+  # Timestamp the last pass was completed.
+  pass_completed = Column(DateTime(), nullable=True)
+  # Number of completed passes.
+  passes = Column(Integer, nullable=False, default=0)
+
+  def __str__(self):
+    return f'SweepCursor(name={self.name}, position={self.position})'
+
+  def __repr__(self):
+    return self.__str__()
+
+
+class SweepCursorRepository(Repository[str, SweepCursor]):
+  indices = []
+
+  @inject
+  def __init__(self, session_provider: ProviderOf[Session]) -> None:
+    super().__init__(str, SweepCursor, session_provider)
+
+  @transactional()
+  def get_cursor(self, name: str) -> SweepCursor:
+    cursor = self.get_by_id(name).one_or_none()
+    if cursor is None:
+      cursor = self.persist(SweepCursor(name=name, position=0, passes=0))
+    return cursor
+
+  @transactional()
+  def advance(self, name: str, position: int, pass_completed: bool) -> None:
+    cursor = self.get_cursor(name)
+    cursor.position = position
+    if pass_completed:
+      cursor.pass_started = None
+      cursor.pass_completed = datetime.utcnow()
+      cursor.passes += 1
@@ -1,11 +1,15 @@
+import io
+from typing import Collection, NamedTuple, Optional
+
 from injector import Module, ProviderOf, inject
-from sqlalchemy import Column, Float, ForeignKey, Integer, String, func
+from sqlalchemy import ARRAY, CTE, Column, Float, ForeignKey, Index, Integer, String, bindparam, func, intersect, select, text
 from sqlalchemy.orm import Session, relationship
 
 from rep0st.config.rep0st_database import Rep0stDatabaseModule
 from rep0st.db import Base
 from rep0st.framework.data.repository import Repository
 from rep0st.framework.data.transaction import transactional
+from rep0st.framework.execute import execute
 
 
 class TagRepositoryModule(Module):
@@ -33,14 +37,152 @@ class Tag(Base):
     return self.__str__()
 
 
+class PostTagSummary(Base):
+  __tablename__ = 'post_tag_summary'
+  # Id of the post.
+  post_id = Column(Integer, ForeignKey('post.id'), primary_key=True)
+  # Tags of the post with the highest confidence, best first.
+  tags = Column(ARRAY(String(256)), nullable=False)
+  # Number of tags of the post.
+  tag_count = Column(Integer, nullable=False)
+  # Sum of the votes (up - down) of all tags of the post.
+  score = Column(Integer, nullable=False)
+
+  def __str__(self):
+    return f'PostTagSummary(post_id={self.post_id}, tag_count={self.tag_count})'
+
+  def __repr__(self):
+    return self.__str__()
+
+
+class TagFilter(NamedTuple):
+  # Name of the tag. `*` matches any number of characters. Matched case
+  # insensitive.
+  pattern: str
+  # Tags with a confidence less or equal to this value do not match.
+  min_confidence: Optional[float] = None
+
+
+def _like_pattern(pattern: str) -> str:
+  pattern = pattern.replace('\\', '\\\\').replace('%', '\\%').replace(
+      '_', '\\_')
+  return pattern.replace('*', '%')
+
+
+def tag_filter_cte(tag_filters: Collection[TagFilter]) -> CTE:
+  """Returns a CTE with the ids of the posts matching all tag filters.
+
+  The CTE is materialized, so it is evaluated once per query instead of once
+  per candidate.
+  """
+  selects = []
+  for tag_filter in tag_filters:
+    s = select(Tag.post_id).where(
+        Tag.tag.ilike(_like_pattern(tag_filter.pattern), escape='\\'))
+    if tag_filter.min_confidence is not None:
+      s = s.where(Tag.confidence > tag_filter.min_confidence)
+    selects.append(s)
+  matches = selects[0] if len(selects) == 1 else intersect(*selects)
+  return matches.cte('tag_matches').prefix_with('MATERIALIZED')
+
+
+_COLUMNS = ['id', 'post_id', 'tag', 'up', 'down', 'confidence']
+
+
+def _copy_value(value) -> str:
+  # Text format of COPY.
+  if value is None:
+    return '\\N'
+  return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace(
+      '\n', '\\n').replace('\r', '\\r')
+
+
 class TagRepository(Repository[int, Tag]):
+  indices = [
+      # Trigram index used by case insensitive and wildcard tag filters.
+      Index(
+          'tag_tag_trgm_index',
+          Tag.tag,
+          postgresql_using='gin',
+          postgresql_ops={'tag': 'gin_trgm_ops'}),
+  ]
 
   @inject
   def __init__(self, session_provider: ProviderOf[Session]) -> None:
     super().__init__(int, Tag, session_provider)
 
+  @execute(-1001)
+  @transactional()
+  def initialize_trigram_extension(self):
+    # Needed by the trigram index, which is created afterwards.
+    self._get_session().connection().execute(
+        text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+
   @transactional()
   def get_latest_tag_id(self):
     session = self._get_session()
     id = session.query(func.max(Tag.id)).scalar()
     return 0 if id is None else id
+
+  @transactional()
+  def upsert_all(self, tags: Collection[Tag]) -> None:
+    """Inserts the tags or updates them if they already exist.
+
+    The tags are streamed with COPY into a staging table and merged from there
+    with a single statement.
+    """
+    if not tags:
+      return
+    connection = self._get_session().connection()
+    connection.execute(
+        text('CREATE TEMPORARY TABLE IF NOT EXISTS tag_staging '
+             '(LIKE tag INCLUDING DEFAULTS) ON COMMIT DELETE ROWS'))
+    connection.execute(text('TRUNCATE tag_staging'))
+    # A statement cannot update a row twice, so only the last version of a tag
+    # is kept.
+    tags = {tag.id: tag for tag in tags}.values()
+    data = io.StringIO()
+    for tag in tags:
+      data.write('\t'.join(
+          _copy_value(getattr(tag, column)) for column in _COLUMNS))
+      data.write('\n')
+    data.seek(0)
+    with connection.connection.cursor() as cursor:
+      cursor.copy_expert(
+          f'COPY tag_staging ({", ".join(_COLUMNS)}) FROM STDIN', data)
+    columns = ', '.join(_COLUMNS)
+    updates = ', '.join(
+        f'{column} = EXCLUDED.{column}' for column in _COLUMNS[1:])
+    connection.execute(
+        text(f'INSERT INTO tag ({columns}) SELECT {columns} FROM tag_staging '
+             f'ON CONFLICT (id) DO UPDATE SET {updates}'))
+
+  @transactional()
+  def update_summaries(self, post_ids: Collection[int], size: int) -> None:
+    """Recalculates the tag summaries of the posts from their tags.
+
+    size is the number of tags kept per post.
+    """
+    if not post_ids:
+      return
+    self._get_session().connection().execute(
+        text('INSERT INTO post_tag_summary (post_id, tags, tag_count, score) '
+             'SELECT post_id, (array_agg(tag ORDER BY confidence DESC, id))'
+             '[1:CAST(:size AS INTEGER)], count(*), sum(up - down) FROM tag '
+             'WHERE post_id = ANY(:post_ids) GROUP BY post_id '
+             'ON CONFLICT (post_id) DO UPDATE SET tags = EXCLUDED.tags, '
+             'tag_count = EXCLUDED.tag_count, score = EXCLUDED.score'
+            ).bindparams(
+                bindparam('post_ids', list(post_ids)), bindparam('size', size)))
+
+  @transactional()
+  def has_summaries(self) -> bool:
+    session = self._get_session()
+    return session.query(PostTagSummary.post_id).limit(1).first() is not None
+
+  @transactional()
+  def get_tagged_post_id_range(self) -> tuple[int, int]:
+    session = self._get_session()
+    start, end = session.query(func.min(Tag.post_id),
+                               func.max(Tag.post_id)).one()
+    return start or 0, end or 0
@@ -25,6 +25,10 @@ flags.DEFINE_string('webserver_bind_hostname', '',
                     'Hostname to which to bind the HTTP server to.')
 flags.DEFINE_integer('webserver_bind_port', None,
                      'Port to which to bind the HTTP server to.')
+flags.DEFINE_integer(
+    'webserver_threads', 10,
+    'Number of threads handling requests. Streaming responses hold a thread '
+    'as long as the client is connected.')
 
 _WebserverBindHostnameKey = NewType('_WebserverBindHostnameKey', str)
 _WebserverBindPortKey = NewType('_WebserverBindPortKey', str)
@@ -177,7 +181,9 @@ class WebServer:
     app = self._handler
     app = DispatcherMiddleware(app, self.mount_map)
     app = WSGILogger(app)
-    self.server = WSGIServer((self.bind_hostname, self.bind_port), app)
+    self.server = WSGIServer((self.bind_hostname, self.bind_port),
+                             app,
+                             numthreads=FLAGS.webserver_threads)
     self.server.stats['Enabled'] = True
     self.server.start()
 
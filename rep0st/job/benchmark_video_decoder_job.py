@@ -0,0 +1,90 @@
+import logging
+import time
+from typing import Any, List
+
+from absl import flags
+from injector import Binder, Module, inject, singleton
+from sqlalchemy import and_
+
+from rep0st.db import PostType
+from rep0st.db.post import Post, PostRepository, PostRepositoryModule
+from rep0st.framework import app
+from rep0st.framework.execute import execute
+from rep0st.service.media_service import DecodeMediaService, ReadMediaService, ReadMediaServiceModule, VideoDecoder
+
+log = logging.getLogger(__name__)
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('rep0st_benchmark_video_decoder_posts', 100,
+                     'Number of video posts to decode with every backend.')
+
+
+class BenchmarkVideoDecoderJobModule(Module):
+
+  def configure(self, binder: Binder):
+    binder.install(PostRepositoryModule)
+    binder.install(ReadMediaServiceModule)
+    binder.bind(BenchmarkVideoDecoderJob)
+
+
+@singleton
+class BenchmarkVideoDecoderJob:
+  post_repository: PostRepository
+  read_media_service: ReadMediaService
+  decode_media_service: DecodeMediaService
+
+  @inject
+  def __init__(self, post_repository: PostRepository,
+               read_media_service: ReadMediaService,
+               decode_media_service: DecodeMediaService):
+    self.post_repository = post_repository
+    self.read_media_service = read_media_service
+    self.decode_media_service = decode_media_service
+
+  def _benchmark(self, decoder: VideoDecoder, posts: List[Post]):
+    decode_fn = {
+        VideoDecoder.FFMPEG: self.decode_media_service.decode_video_from_file,
+        VideoDecoder.PYAV:
+            self.decode_media_service.decode_video_from_file_pyav,
+    }[decoder]
+    frame_count = 0
+    error_count = 0
+    start = time.time()
+    for post in posts:
+      try:
+        with (self.read_media_service.media_dir / post.image).open('rb') as f:
+          for _ in decode_fn(f):
+            frame_count += 1
+      except ImportError:
+        log.exception(f'Video decoder {decoder.name} is not available')
+        return
+      except:
+        error_count += 1
+        log.exception(
+            f'Error decoding post {post.id} with video decoder {decoder.name}')
+    time_taken = time.time() - start
+    log.info(
+        f'Video decoder {decoder.name}: decoded {frame_count} frames of {len(posts)} posts '
+        f'in {time_taken:.2f}s ({len(posts) / time_taken:.2f} posts/s, '
+        f'{frame_count / time_taken:.2f} frames/s, {error_count} errors)')
+
+  @execute()
+  def benchmark_video_decoder(self):
+    posts = self.post_repository.get_posts(type=PostType.VIDEO).filter(
+        and_(Post.error_status == None, Post.deleted == False)).order_by(
+            Post.id.desc()).limit(
+                FLAGS.rep0st_benchmark_video_decoder_posts).all()
+    log.info(f'Benchmarking video decoders with {len(posts)} posts')
+    # The first round warms up the page cache, so the second round only
+    # compares the decoders.
+    for decoder in VideoDecoder:
+      self._benchmark(decoder, posts)
+    for decoder in VideoDecoder:
+      self._benchmark(decoder, posts)
+
+
+def modules() -> List[Any]:
+  return [BenchmarkVideoDecoderJobModule]
+
+
+if __name__ == "__main__":
+  app.run(modules)
@@ -0,0 +1,117 @@
+import logging
+import os
+from pathlib import Path
+from typing import Any, List
+
+from absl import flags
+from injector import Binder, Module, inject, singleton
+
+from rep0st import util
+from rep0st.db.media_blob import MediaBlobRepository, MediaBlobRepositoryModule
+from rep0st.db.post import PostRepository, PostRepositoryModule
+from rep0st.framework import app
+from rep0st.framework.execute import execute
+from rep0st.service.media_index_service import MediaIndexService, MediaIndexServiceModule
+from rep0st.service.media_service import _MediaDirectory, blob_file
+
+log = logging.getLogger(__name__)
+FLAGS = flags.FLAGS
+flags.DEFINE_bool(
+    'rep0st_collect_media_blobs_job_remove_deleted', True,
+    'If True, the media files of deleted posts stored as blobs are removed, so '
+    'their blobs are collected. The media is downloaded again if a post is '
+    'undeleted.')
+
+
+class CollectMediaBlobsJobModule(Module):
+
+  def configure(self, binder: Binder):
+    binder.install(PostRepositoryModule)
+    binder.install(MediaBlobRepositoryModule)
+    binder.install(MediaIndexServiceModule)
+    binder.bind(CollectMediaBlobsJob)
+
+
+@singleton
+class CollectMediaBlobsJob:
+  """Removes blobs no media file links to anymore.
+
+  Media files are hard links to their blob, so a blob with a single link is
+  not used. This happens once its media was packed, removed after the
+  derivative was written or replaced by another download.
+  """
+  post_repository: PostRepository
+  media_blob_repository: MediaBlobRepository
+  media_index_service: MediaIndexService
+  media_dir: Path
+
+  @inject
+  def __init__(self, post_repository: PostRepository,
+               media_blob_repository: MediaBlobRepository,
+               media_index_service: MediaIndexService,
+               media_dir: _MediaDirectory):
+    self.post_repository = post_repository
+    self.media_blob_repository = media_blob_repository
+    self.media_index_service = media_index_service
+    self.media_dir = media_dir
+
+  def _remove_deleted(self) -> int:
+    removed = 0
+    max_id = self.post_repository.get_latest_post_id()
+    for batch_start, batch_end in util.batched_ranges(1, max_id + 1, 10000):
+      paths = []
+      for path, sha256 in self.media_blob_repository.get_deleted_post_blobs(
+          batch_start, batch_end):
+        media_file = self.media_dir / path
+        try:
+          if not os.path.samefile(media_file, blob_file(self.media_dir,
+                                                        sha256)):
+            # Stored before content addressing, keep it.
+            continue
+          media_file.unlink()
+        except FileNotFoundError:
+          continue
+        self.media_index_service.remove(media_file)
+        paths.append(path)
+      self.media_blob_repository.delete_paths(paths)
+      removed += len(paths)
+    return removed
+
+  def _collect(self) -> int:
+    collected = 0
+    blob_dir = self.media_dir / 'blobs'
+    if not blob_dir.is_dir():
+      return 0
+    stack = [os.fspath(blob_dir)]
+    while stack:
+      with os.scandir(stack.pop()) as it:
+        for entry in it:
+          if entry.is_dir(follow_symlinks=False):
+            stack.append(entry.path)
+            continue
+          if entry.stat(follow_symlinks=False).st_nlink > 1:
+            continue
+          # Downloads link the media file before the blob is created and
+          # store their own blob if it is collected while they link it.
+          blob = Path(entry.path)
+          blob.unlink(missing_ok=True)
+          self.media_index_service.remove(blob)
+          collected += 1
+    return collected
+
+  @execute()
+  def collect_media_blobs(self):
+    if FLAGS.rep0st_collect_media_blobs_job_remove_deleted:
+      removed = self._remove_deleted()
+      log.info(f'Removed {removed} media files of deleted posts')
+    collected = self._collect()
+    self.media_index_service.save()
+    log.info(f'Collected {collected} unused blobs')
+
+
+def modules() -> List[Any]:
+  return [CollectMediaBlobsJobModule]
+
+
+if __name__ == "__main__":
+  app.run(modules)
@@ -0,0 +1,77 @@
+import logging
+from typing import Any, List
+
+from absl import flags
+from injector import Binder, Module, inject, singleton
+import numpy
+
+from rep0st import util
+from rep0st.db import PostType
+from rep0st.db.post import PostRepository, PostRepositoryModule
+from rep0st.framework import app
+from rep0st.framework.execute import execute
+from rep0st.service.media_pack import MediaPack, hash_media_path
+from rep0st.service.media_service import _MediaPackModule
+
+log = logging.getLogger(__name__)
+FLAGS = flags.FLAGS
+flags.DEFINE_float(
+    'rep0st_compact_media_pack_job_min_dead_ratio', 0.3,
+    'Fraction of bytes of a pack segment belonging to deleted posts before '
+    'the segment is rewritten.')
+
+
+class CompactMediaPackJobModule(Module):
+
+  def configure(self, binder: Binder):
+    binder.install(PostRepositoryModule)
+    binder.install(_MediaPackModule)
+    binder.bind(CompactMediaPackJob)
+
+
+@singleton
+class CompactMediaPackJob:
+  """Removes the media of deleted posts from the pack segments."""
+  post_repository: PostRepository
+  media_pack: MediaPack
+
+  @inject
+  def __init__(self, post_repository: PostRepository, media_pack: MediaPack):
+    self.post_repository = post_repository
+    self.media_pack = media_pack
+
+  def _live_hashes(self) -> numpy.ndarray:
+    hashes = []
+    max_id = self.post_repository.get_latest_post_id()
+    for batch_start, batch_end in util.batched_ranges(1, max_id + 1, 100000):
+      for image, fullsize in self.post_repository.get_media_paths(
+          PostType.IMAGE, batch_start, batch_end):
+        hashes.append(hash_media_path(image))
+        if fullsize:
+          hashes.append(hash_media_path(f'full/{fullsize}'))
+    return numpy.array(hashes, dtype=numpy.uint64)
+
+  @execute()
+  def compact_media_pack(self):
+    # Media packed while the live media is queried is not part of it. Only
+    # segments that were complete before are compacted.
+    segments = self.media_pack.closed_segments()
+    live_hashes = self._live_hashes()
+    log.info(
+        f'Compacting {len(segments)} media pack segments keeping {len(live_hashes)} media files'
+    )
+    result = self.media_pack.compact(
+        live_hashes, FLAGS.rep0st_compact_media_pack_job_min_dead_ratio,
+        segments)
+    self.media_pack.close()
+    log.info(
+        f'Compacted {result.segments} segments: kept {result.records_kept} and dropped {result.records_dropped} media files ({result.bytes_dropped} bytes)'
+    )
+
+
+def modules() -> List[Any]:
+  return [CompactMediaPackJobModule]
+
+
+if __name__ == "__main__":
+  app.run(modules)
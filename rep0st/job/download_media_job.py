@@ -0,0 +1,48 @@
+import logging
+from typing import Any, List
+
+from absl import flags
+from injector import Binder, Module, inject, singleton
+
+from rep0st.framework import app
+from rep0st.framework.scheduler import Scheduler, SchedulerModule
+from rep0st.service.download_queue_service import DownloadQueueService, DownloadQueueServiceModule
+
+log = logging.getLogger(__name__)
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+    'rep0st_download_media_job_schedule', '* * * * * *',
+    'Schedule in crontab format for running the media download job.')
+
+
+class DownloadMediaJobModule(Module):
+
+  def configure(self, binder: Binder):
+    binder.install(DownloadQueueServiceModule)
+    binder.install(SchedulerModule)
+    binder.bind(DownloadMediaJob)
+
+
+@singleton
+class DownloadMediaJob:
+  download_queue_service: DownloadQueueService
+
+  @inject
+  def __init__(self, download_queue_service: DownloadQueueService,
+               scheduler: Scheduler):
+    self.download_queue_service = download_queue_service
+    scheduler.schedule('oneshot',
+                       self.download_queue_service.enqueue_orphaned_posts)
+    scheduler.schedule(FLAGS.rep0st_download_media_job_schedule,
+                       self.download_media_job)
+
+  def download_media_job(self):
+    self.download_queue_service.process_queue()
+
+
+def modules() -> List[Any]:
+  return [DownloadMediaJobModule]
+
+
+if __name__ == "__main__":
+  app.run(modules)
@@ -0,0 +1,82 @@
+import logging
+from typing import Any, List
+
+from absl import flags
+from injector import Binder, Module, inject, singleton
+from joblib import Parallel, delayed, parallel_backend
+from sqlalchemy import and_
+
+from rep0st import util
+from rep0st.db import MediaKind, PostType
+from rep0st.db.post import Post, PostRepository, PostRepositoryModule, main_media_kind
+from rep0st.framework import app
+from rep0st.framework.execute import execute
+from rep0st.service.media_derivative_service import MediaDerivativeService, MediaDerivativeServiceModule
+
+log = logging.getLogger(__name__)
+FLAGS = flags.FLAGS
+
+
+class GenerateDerivativesJobModule(Module):
+
+  def configure(self, binder: Binder):
+    binder.install(PostRepositoryModule)
+    binder.install(MediaDerivativeServiceModule)
+    binder.bind(GenerateDerivativesJob)
+
+
+@singleton
+class GenerateDerivativesJob:
+  """Writes the missing derivatives of media downloaded before they existed."""
+  post_repository: PostRepository
+  media_derivative_service: MediaDerivativeService
+
+  @inject
+  def __init__(self, post_repository: PostRepository,
+               media_derivative_service: MediaDerivativeService):
+    self.post_repository = post_repository
+    self.media_derivative_service = media_derivative_service
+
+  def _process(self, post: Post) -> bool:
+    if self.media_derivative_service.has_derivative(post):
+      return False
+    if not self.media_derivative_service.create(post):
+      return False
+    if not FLAGS.rep0st_media_keep_originals:
+      if post.fullsize:
+        self.media_derivative_service.remove_original(
+            post, MediaKind.FULLSIZE, post.fullsize)
+      self.media_derivative_service.remove_original(post,
+                                                    main_media_kind(post),
+                                                    post.image)
+    return True
+
+  @execute()
+  def generate_derivatives(self):
+    created = 0
+    with parallel_backend('threading'), Parallel() as parallel:
+      max_id = self.post_repository.get_latest_post_id()
+      for batch_start, batch_end in util.batched_ranges(1, max_id + 1, 10000):
+        posts = [
+            Post(
+                id=post.id,
+                type=post.type,
+                image=post.image,
+                fullsize=post.fullsize) for post in
+            self.post_repository.get_posts().filter(
+                and_(Post.error_status == None, Post.deleted == False,
+                     Post.type != PostType.UNKNOWN, Post.id >= batch_start,
+                     Post.id <= batch_end))
+        ]
+        created += sum(parallel(delayed(self._process)(post) for post in posts))
+        log.info(
+            f'Generated derivatives of posts up to {batch_end}, {created} total'
+        )
+
+
+def modules() -> List[Any]:
+  return [GenerateDerivativesJobModule]
+
+
+if __name__ == "__main__":
+  app.run(modules)
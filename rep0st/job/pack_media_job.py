@@ -0,0 +1,85 @@
+import logging
+from pathlib import Path
+from typing import Any, List
+
+from absl import flags
+from injector import Binder, Module, inject, singleton
+
+from rep0st import util
+from rep0st.db import PostType
+from rep0st.db.post import PostRepository, PostRepositoryModule
+from rep0st.framework import app
+from rep0st.framework.execute import execute
+from rep0st.service.media_index_service import MediaIndexService, MediaIndexServiceModule
+from rep0st.service.media_pack import MediaPack
+from rep0st.service.media_service import _MediaDirectory, _MediaPackModule
+
+log = logging.getLogger(__name__)
+FLAGS = flags.FLAGS
+flags.DEFINE_bool(
+    'rep0st_pack_media_job_remove_files', False,
+    'If True, media files are removed after they were appended to a pack '
+    'segment.')
+
+
+class PackMediaJobModule(Module):
+
+  def configure(self, binder: Binder):
+    binder.install(PostRepositoryModule)
+    binder.install(_MediaPackModule)
+    binder.install(MediaIndexServiceModule)
+    binder.bind(PackMediaJob)
+
+
+@singleton
+class PackMediaJob:
+  """Moves the images of posts from single files into pack segments."""
+  post_repository: PostRepository
+  media_dir: Path
+  media_pack: MediaPack
+  media_index_service: MediaIndexService
+
+  @inject
+  def __init__(self, post_repository: PostRepository,
+               media_dir: _MediaDirectory, media_pack: MediaPack,
+               media_index_service: MediaIndexService):
+    self.post_repository = post_repository
+    self.media_dir = media_dir
+    self.media_pack = media_pack
+    self.media_index_service = media_index_service
+
+  def _pack(self, path: str) -> bool:
+    if self.media_pack.contains(path):
+      return False
+    media_file = self.media_dir / path
+    try:
+      data = media_file.read_bytes()
+    except (IOError, OSError):
+      return False
+    self.media_pack.append(path, data)
+    if FLAGS.rep0st_pack_media_job_remove_files:
+      media_file.unlink()
+      self.media_index_service.remove(media_file)
+    return True
+
+  @execute()
+  def pack_media(self):
+    packed = 0
+    max_id = self.post_repository.get_latest_post_id()
+    for batch_start, batch_end in util.batched_ranges(1, max_id + 1, 10000):
+      for image, fullsize in self.post_repository.get_media_paths(
+          PostType.IMAGE, batch_start, batch_end):
+        packed += self._pack(image)
+        if fullsize:
+          packed += self._pack(f'full/{fullsize}')
+      log.info(f'Packed media of posts up to {batch_end}, {packed} files total')
+    self.media_pack.close()
+    self.media_index_service.save()
+
+
+def modules() -> List[Any]:
+  return [PackMediaJobModule]
+
+
+if __name__ == "__main__":
+  app.run(modules)
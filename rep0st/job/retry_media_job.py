@@ -0,0 +1,46 @@
+import logging
+from typing import Any, List
+
+from absl import flags
+from injector import Binder, Module, inject, singleton
+
+from rep0st.framework import app
+from rep0st.framework.scheduler import Scheduler, SchedulerModule
+from rep0st.service.media_retry_service import MediaRetryService, MediaRetryServiceModule
+
+log = logging.getLogger(__name__)
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+    'rep0st_retry_media_job_schedule', '*/10 * * * *',
+    'Schedule in crontab format for running the media retry job.')
+
+
+class RetryMediaJobModule(Module):
+
+  def configure(self, binder: Binder):
+    binder.install(MediaRetryServiceModule)
+    binder.install(SchedulerModule)
+    binder.bind(RetryMediaJob)
+
+
+@singleton
+class RetryMediaJob:
+  media_retry_service: MediaRetryService
+
+  @inject
+  def __init__(self, media_retry_service: MediaRetryService,
+               scheduler: Scheduler):
+    self.media_retry_service = media_retry_service
+    scheduler.schedule(FLAGS.rep0st_retry_media_job_schedule,
+                       self.retry_media_job)
+
+  def retry_media_job(self):
+    self.media_retry_service.retry_media()
+
+
+def modules() -> List[Any]:
+  return [RetryMediaJobModule]
+
+
+if __name__ == "__main__":
+  app.run(modules)
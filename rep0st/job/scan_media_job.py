@@ -0,0 +1,281 @@
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, List, NamedTuple, Optional, Tuple
+
+from absl import flags
+import ffmpeg
+from injector import Binder, Module, inject, singleton
+from joblib import Parallel, delayed, parallel_backend
+import numpy
+
+from rep0st import util
+from rep0st.db import MediaKind, PostType
+from rep0st.db.download_queue import PRIORITY_REPAIR, DownloadQueueRepository, DownloadQueueRepositoryModule
+from rep0st.db.media_blob import MediaBlobRepository, MediaBlobRepositoryModule
+from rep0st.db.post import Post, PostErrorStatus, PostRepository, PostRepositoryModule, main_media_kind
+from rep0st.framework import app
+from rep0st.framework.data.transaction import transactional
+from rep0st.framework.execute import execute
+from rep0st.service.media_pack import MediaPack, hash_media_path
+from rep0st.service.media_service import _MediaDirectory, _MediaPackModule, derivative_file
+
+log = logging.getLogger(__name__)
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('rep0st_scan_media_job_workers', 16,
+                     'Number of media files checked concurrently.')
+flags.DEFINE_bool(
+    'rep0st_scan_media_job_probe_videos', False,
+    'If True, video containers are probed with ffprobe in addition to the '
+    'header check.')
+flags.DEFINE_bool(
+    'rep0st_scan_media_job_repair', True,
+    'If True, posts with missing or broken media are marked MEDIA_BROKEN and '
+    'their media is downloaded again. Otherwise they are only reported.')
+flags.DEFINE_string(
+    'rep0st_scan_media_job_report_file', 'media_scan_report.jsonl',
+    'File the problems found are written to, one JSON object per line.')
+
+# Bytes read from the start and the end of a media file.
+_HEAD_SIZE = 16
+_TAIL_SIZE = 32
+# Directories in the media directory not holding media of posts.
+_INTERNAL_DIRECTORIES = {'packs', 'derived', 'blobs'}
+# Depth of the directories scanned concurrently.
+_SCAN_SPLIT_DEPTH = 2
+
+
+class _Problem(NamedTuple):
+  post_id: Optional[int]
+  path: str
+  problem: str
+
+
+def _check_image(head: bytes, tail: bytes, size: int) -> Optional[str]:
+  if head.startswith(b'\xff\xd8\xff'):
+    # Some encoders pad the file after the end of image marker.
+    return None if b'\xff\xd9' in tail else 'bad_trailer'
+  if head.startswith(b'\x89PNG\r\n\x1a\n'):
+    return None if tail.endswith(b'IEND\xaeB`\x82') else 'bad_trailer'
+  if head[:6] in (b'GIF87a', b'GIF89a'):
+    return None if tail.rstrip(b'\x00').endswith(b';') else 'bad_trailer'
+  if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+    # The RIFF header contains the size of the rest of the file.
+    riff_size = int.from_bytes(head[4:8], 'little')
+    return None if riff_size + 8 <= size else 'truncated'
+  return 'bad_header'
+
+
+def _check_video(head: bytes) -> Optional[str]:
+  # MP4 starts with an ftyp box, WebM (Matroska) with an EBML header.
+  if head[4:8] == b'ftyp' or head[:4] == b'\x1a\x45\xdf\xa3':
+    return None
+  return 'bad_header'
+
+
+def _check(media_kind: MediaKind, head: bytes, tail: bytes, size: int,
+           expected_size: Optional[int]) -> Optional[str]:
+  if size == 0:
+    return 'truncated'
+  if expected_size is not None and size != expected_size:
+    return 'size_mismatch'
+  if media_kind == MediaKind.VIDEO:
+    return _check_video(head)
+  return _check_image(head, tail, size)
+
+
+def _scan_directory(root: Path, prefix: str) -> List[str]:
+  paths = []
+  stack = [(os.fspath(root), prefix)]
+  while stack:
+    directory, directory_prefix = stack.pop()
+    with os.scandir(directory) as it:
+      for entry in it:
+        path = directory_prefix + entry.name
+        if entry.is_dir(follow_symlinks=False):
+          stack.append((entry.path, path + '/'))
+        elif not entry.name.endswith('.part'):
+          paths.append(path)
+  return paths
+
+
+class ScanMediaJobModule(Module):
+
+  def configure(self, binder: Binder):
+    binder.install(PostRepositoryModule)
+    binder.install(MediaBlobRepositoryModule)
+    binder.install(DownloadQueueRepositoryModule)
+    binder.install(_MediaPackModule)
+    binder.bind(ScanMediaJob)
+
+
+@singleton
+class ScanMediaJob:
+  """Finds missing, truncated and corrupt media without decoding it.
+
+  Checks the media of all posts without errors against the header and
+  trailer of its format and the size recorded when it was downloaded. Posts
+  with problems are marked MEDIA_BROKEN and their media is downloaded again.
+  Media files no post refers to are reported.
+  """
+  post_repository: PostRepository
+  media_blob_repository: MediaBlobRepository
+  download_queue_repository: DownloadQueueRepository
+  media_pack: MediaPack
+  media_dir: Path
+
+  @inject
+  def __init__(self, post_repository: PostRepository,
+               media_blob_repository: MediaBlobRepository,
+               download_queue_repository: DownloadQueueRepository,
+               media_pack: MediaPack, media_dir: _MediaDirectory):
+    self.post_repository = post_repository
+    self.media_blob_repository = media_blob_repository
+    self.download_queue_repository = download_queue_repository
+    self.media_pack = media_pack
+    self.media_dir = media_dir
+
+  def _read_packed(self, path: str) -> Optional[Tuple[bytes, bytes, int]]:
+    data = self.media_pack.read(path)
+    if data is None:
+      return None
+    return bytes(data[:_HEAD_SIZE]), bytes(data[-_TAIL_SIZE:]), len(data)
+
+  def _read_file(self, media_file: Path) -> Optional[Tuple[bytes, bytes, int]]:
+    try:
+      with media_file.open('rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        head = f.read(_HEAD_SIZE)
+        f.seek(max(0, size - _TAIL_SIZE))
+        return head, f.read(_TAIL_SIZE), size
+    except FileNotFoundError:
+      return None
+
+  def _check_media(self, post: Post, media_kind: MediaKind, path: str,
+                   expected_size: Optional[int]) -> Optional[_Problem]:
+    media_file = self.media_dir / path
+    try:
+      read = None
+      if post.type == PostType.IMAGE:
+        read = self._read_packed(path)
+      if read is None:
+        read = self._read_file(media_file)
+    except (IOError, OSError) as e:
+      log.warning(f'Could not read {media_file.absolute()}: {e}')
+      return _Problem(post.id, path, 'unreadable')
+    if read is None:
+      if (FLAGS.rep0st_media_derivatives and
+          not FLAGS.rep0st_media_keep_originals and
+          derivative_file(self.media_dir, post).is_file()):
+        # The original was removed after the derivative was written.
+        return None
+      return _Problem(post.id, path, 'missing')
+    problem = _check(media_kind, *read, expected_size)
+    if (problem is None and media_kind == MediaKind.VIDEO and
+        FLAGS.rep0st_scan_media_job_probe_videos):
+      try:
+        ffmpeg.probe(os.fspath(media_file))
+      except ffmpeg.Error:
+        problem = 'probe_failed'
+    return _Problem(post.id, path, problem) if problem else None
+
+  @transactional()
+  def _repair(self, post_ids: List[int]) -> None:
+    self.post_repository.mark_error_status(post_ids,
+                                           PostErrorStatus.MEDIA_BROKEN)
+    posts = self.post_repository.get_posts().filter(
+        Post.id.in_(post_ids)).all()
+    self.download_queue_repository.enqueue_posts(posts, PRIORITY_REPAIR)
+
+  def _scan_posts(self, parallel: Parallel, report) -> numpy.ndarray:
+    referenced = []
+    problem_count = 0
+    max_id = self.post_repository.get_latest_post_id()
+    for batch_start, batch_end in util.batched_ranges(1, max_id + 1, 10000):
+      checks = []
+      for post in self.post_repository.get_posts().filter(
+          Post.id >= batch_start, Post.id <= batch_end):
+        paths = [(main_media_kind(post) or MediaKind.IMAGE, post.image)]
+        if post.fullsize:
+          paths.append((MediaKind.FULLSIZE, f'full/{post.fullsize}'))
+        referenced += [hash_media_path(path) for _, path in paths]
+        if (post.deleted or post.error_status is not None or
+            post.type == PostType.UNKNOWN):
+          continue
+        post = Post(
+            id=post.id,
+            type=post.type,
+            image=post.image,
+            fullsize=post.fullsize)
+        checks += [(post, media_kind, path) for media_kind, path in paths]
+      sizes = self.media_blob_repository.get_sizes(
+          [path for _, _, path in checks])
+      problems = [
+          problem for problem in parallel(
+              delayed(self._check_media)(post, media_kind, path,
+                                         sizes.get(path))
+              for post, media_kind, path in checks) if problem is not None
+      ]
+      for problem in problems:
+        report.write(json.dumps(problem._asdict()) + '\n')
+      problem_count += len(problems)
+      broken_post_ids = sorted({problem.post_id for problem in problems})
+      if broken_post_ids and FLAGS.rep0st_scan_media_job_repair:
+        self._repair(broken_post_ids)
+      log.info(
+          f'Checked media of posts up to {batch_end}, {problem_count} problems found'
+      )
+    return numpy.unique(numpy.array(referenced, dtype=numpy.uint64))
+
+  def _scan_orphans(self, parallel: Parallel, report,
+                    referenced: numpy.ndarray) -> int:
+    # Split the tree into subtrees that are scanned concurrently. Files above
+    # the split depth are collected right away.
+    upper_paths = []
+    subtrees = [(self.media_dir, '')]
+    for _ in range(_SCAN_SPLIT_DEPTH):
+      next_subtrees = []
+      for directory, prefix in subtrees:
+        with os.scandir(directory) as it:
+          for entry in it:
+            path = prefix + entry.name
+            if not prefix and (entry.name in _INTERNAL_DIRECTORIES or
+                               entry.name.startswith('.')):
+              continue
+            if entry.is_dir(follow_symlinks=False):
+              next_subtrees.append((Path(entry.path), path + '/'))
+            elif not entry.name.endswith('.part'):
+              upper_paths.append(path)
+      subtrees = next_subtrees
+    orphan_count = 0
+    for paths in [upper_paths] + parallel(
+        delayed(_scan_directory)(directory, prefix)
+        for directory, prefix in subtrees):
+      hashes = numpy.array([hash_media_path(path) for path in paths],
+                           dtype=numpy.uint64)
+      for path in numpy.array(paths, dtype=object)[~numpy.isin(
+          hashes, referenced)]:
+        report.write(json.dumps(_Problem(None, path, 'orphaned')._asdict()) +
+                     '\n')
+        orphan_count += 1
+    return orphan_count
+
+  @execute()
+  def scan_media(self):
+    with open(FLAGS.rep0st_scan_media_job_report_file, 'w') as report:
+      with parallel_backend('threading'), Parallel(
+          n_jobs=FLAGS.rep0st_scan_media_job_workers) as parallel:
+        referenced = self._scan_posts(parallel, report)
+        orphan_count = self._scan_orphans(parallel, report, referenced)
+    log.info(
+        f'Finished media scan, found {orphan_count} orphaned files. Report written to {FLAGS.rep0st_scan_media_job_report_file}'
+    )
+
+
+def modules() -> List[Any]:
+  return [ScanMediaJobModule]
+
+
+if __name__ == "__main__":
+  app.run(modules)
@@ -0,0 +1,46 @@
+import logging
+from typing import Any, List
+
+from absl import flags
+from injector import Binder, Module, inject, singleton
+
+from rep0st.framework import app
+from rep0st.framework.scheduler import Scheduler, SchedulerModule
+from rep0st.service.duplicate_service import DuplicateService, DuplicateServiceModule
+
+log = logging.getLogger(__name__)
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+    'rep0st_update_duplicates_job_schedule', '*/5 * * * *',
+    'Schedule in crontab format for running the duplicate update job.')
+
+
+class UpdateDuplicatesJobModule(Module):
+
+  def configure(self, binder: Binder):
+    binder.install(DuplicateServiceModule)
+    binder.install(SchedulerModule)
+    binder.bind(UpdateDuplicatesJob)
+
+
+@singleton
+class UpdateDuplicatesJob:
+  duplicate_service: DuplicateService
+
+  @inject
+  def __init__(self, duplicate_service: DuplicateService,
+               scheduler: Scheduler):
+    self.duplicate_service = duplicate_service
+    scheduler.schedule(FLAGS.rep0st_update_duplicates_job_schedule,
+                       self.update_duplicates_job)
+
+  def update_duplicates_job(self):
+    self.duplicate_service.update_duplicates()
+
+
+def modules() -> List[Any]:
+  return [UpdateDuplicatesJobModule]
+
+
+if __name__ == "__main__":
+  app.run(modules)
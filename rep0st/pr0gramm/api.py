@@ -1,17 +1,22 @@
 from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import logging
+import random
+import threading
 import time
-from typing import Iterator, NamedTuple
+from typing import Any, Iterator, List, NamedTuple
 import urllib
 
 from absl import flags
 from injector import Module, provider, singleton
-from prometheus_client import Counter
+from prometheus_client import Counter, Gauge, Histogram
 from requests import RequestException, Response, Session, Timeout
+from requests.adapters import HTTPAdapter
 
 from rep0st.db.post import Post, post_type_from_media_path
 from rep0st.db.tag import Tag
-from rep0st.util import get_secret
+from rep0st.pr0gramm.rate_limiter import RateLimiter
+from rep0st.util import get_secret, prefetch
 
 log = logging.getLogger(__name__)
 FLAGS = flags.FLAGS
@@ -38,6 +43,35 @@ flags.DEFINE_string('pr0gramm_api_baseurl_vid', 'https://vid.pr0gramm.com',
                     'Baseurl for the pr0gramm image API.')
 flags.DEFINE_string('pr0gramm_api_baseurl_full', 'https://full.pr0gramm.com',
                     'Baseurl for the pr0gramm image API.')
+flags.DEFINE_integer(
+    'pr0gramm_api_pool_size_api', 2,
+    'Maximum number of concurrent connections to the pr0gramm API. Requests wait '
+    'for a free connection if all are in use.')
+flags.DEFINE_integer(
+    'pr0gramm_api_pool_size_img', 8,
+    'Maximum number of concurrent connections to the pr0gramm image host.')
+flags.DEFINE_integer(
+    'pr0gramm_api_pool_size_vid', 4,
+    'Maximum number of concurrent connections to the pr0gramm video host.')
+flags.DEFINE_integer(
+    'pr0gramm_api_pool_size_full', 4,
+    'Maximum number of concurrent connections to the pr0gramm fullsize host.')
+flags.DEFINE_float(
+    'pr0gramm_api_rate_limit', 10.0,
+    'Maximum number of requests per second sent to pr0gramm, shared by all hosts. '
+    'The rate is reduced automatically if pr0gramm throttles requests. 0 disables '
+    'rate limiting.')
+flags.DEFINE_integer(
+    'pr0gramm_api_rate_limit_burst', 20,
+    'Number of requests that can be sent at once before the rate limit applies.')
+flags.DEFINE_float(
+    'pr0gramm_api_max_retry_after', 300.0,
+    'Maximum number of seconds requests wait when pr0gramm asks to retry later. '
+    'Longer Retry-After values are cut to this.')
+flags.DEFINE_integer(
+    'pr0gramm_api_prefetch_pages', 1,
+    'Number of pages of posts and tags requested ahead while the current page is '
+    'processed. 0 disables prefetching.')
 
 logins_z = Counter('rep0st_pr0gramm_api_logins',
                    'Number of logins to pr0gramm by status.', ['status'])
@@ -52,6 +86,18 @@ requests_z = Counter('rep0st_pr0gramm_api_requests',
 requests_z.labels(status='ok')
 requests_z.labels(status='unknown')
 requests_z.labels(status='not_found')
+requests_z.labels(status='range_not_satisfiable')
+throttled_z = Counter(
+    'rep0st_pr0gramm_api_throttled',
+    'Number of requests to the pr0gramm API that were throttled by status.',
+    ['status'])
+throttled_z.labels(status='429')
+rate_z = Gauge('rep0st_pr0gramm_api_rate',
+               'Current rate limit for requests to pr0gramm per second.')
+rate_limit_wait_z = Histogram(
+    'rep0st_pr0gramm_api_rate_limit_wait_seconds',
+    'Time requests waited for the rate limiter.',
+    buckets=(0.001, 0.01, 0.1, 0.5, 1, 5, 10, 30, 60))
 
 
 class LoginException(Exception):
@@ -62,11 +108,41 @@ class APIException(Exception):
   pass
 
 
+class RangeNotSatisfiableException(APIException):
+  # Content-Range header of the response, usually `bytes */<size>`.
+  content_range: str | None
+
+  def __init__(self, message: str, content_range: str | None = None):
+    super().__init__(message)
+    self.content_range = content_range
+
+
 class MediaPath(NamedTuple):
   base_url: str
   path: str
 
 
+class PoolSizes(NamedTuple):
+  api: int
+  img: int
+  vid: int
+  full: int
+
+
+def _parse_retry_after(value: str | None) -> float | None:
+  if not value:
+    return None
+  try:
+    return max(float(value), 0)
+  except ValueError:
+    pass
+  try:
+    return max((parsedate_to_datetime(value) -
+                datetime.now(timezone.utc)).total_seconds(), 0)
+  except (TypeError, ValueError):
+    return None
+
+
 @singleton
 class Pr0grammAPI:
   api_user: str = None
@@ -75,22 +151,53 @@ class Pr0grammAPI:
   baseurl_img: str = None
   baseurl_vid: str = None
   baseurl_full: str = None
-  session: Session = Session()
+  prefetch_pages: int = None
+  rate_limiter: RateLimiter = None
+  max_retry_after: float = None
+  session: Session = None
 
-  def __init__(self, api_user: str, api_password: str, baseurl_api: str,
-               baseurl_img: str, baseurl_vid: str, baseurl_full: str):
+  def __init__(self,
+               api_user: str,
+               api_password: str,
+               baseurl_api: str,
+               baseurl_img: str,
+               baseurl_vid: str,
+               baseurl_full: str,
+               pool_sizes: PoolSizes = PoolSizes(2, 8, 4, 4),
+               rate_limiter: RateLimiter | None = None,
+               prefetch_pages: int = 1,
+               max_retry_after: float = 300.0):
     self.api_user = api_user
     self.api_password = api_password
     self.baseurl_api = baseurl_api
     self.baseurl_img = baseurl_img
     self.baseurl_vid = baseurl_vid
     self.baseurl_full = baseurl_full
+    self.prefetch_pages = prefetch_pages
+    # Every instance gets its own limiter, a default argument would be shared.
+    self.rate_limiter = rate_limiter or RateLimiter(0, 1)
+    self.max_retry_after = max_retry_after
+    rate_z.set_function(lambda: self.rate_limiter.rate)
+    self._login_lock = threading.Lock()
+    self._login_generation = 0
+    self.session = Session()
+    # The session is shared by all threads. Give every host its own bounded
+    # pool, so concurrent downloads cannot open unlimited connections.
+    for baseurl, pool_size in [(baseurl_api, pool_sizes.api),
+                               (baseurl_img, pool_sizes.img),
+                               (baseurl_vid, pool_sizes.vid),
+                               (baseurl_full, pool_sizes.full)]:
+      self.session.mount(
+          baseurl,
+          HTTPAdapter(
+              pool_connections=1, pool_maxsize=pool_size, pool_block=True))
 
   def perform_login(self) -> None:
     error_count = 0
     while True:
       log.debug(f'Performing pr0gramm login with user {self.api_user}')
       try:
+        rate_limit_wait_z.observe(self.rate_limiter.acquire())
         response = self.session.post(
             self.baseurl_api + "/user/login",
             data={
@@ -127,42 +234,86 @@ class Pr0grammAPI:
       log.info(f'Login to pr0gramm successful with user {self.api_user}')
       return
 
-  def perform_request(self, url: str) -> Response:
+  def _relogin(self, login_generation: int) -> None:
+    # Requests from multiple threads can fail with 403 at the same time. Only
+    # the first one logs in again, the others retry with the new session.
+    with self._login_lock:
+      if self._login_generation != login_generation:
+        return
+      self.perform_login()
+      self._login_generation += 1
+
+  def _backoff(self, url: str, error_count: int,
+               retry_after: float | None) -> None:
+    if error_count > 3:
+      requests_z.labels(status='unknown').inc()
+      raise APIException(f'Request to url {url} failed too often')
+    if retry_after is None:
+      # Add jitter, so concurrent requests don't retry at the same time.
+      retry_after = 3**error_count * random.uniform(0.5, 1.5)
+    log.info(f'Retrying request to {url} in {retry_after:.1f} seconds...')
+    time.sleep(retry_after)
+
+  def perform_request(self,
+                      url: str,
+                      headers: dict[str, str] | None = None,
+                      stream: bool = False) -> Response:
     log.debug(f'Performing request to {url}')
     error_count = 0
     while True:
       try:
-        response = self.session.get(url, timeout=60)
+        rate_limit_wait_z.observe(self.rate_limiter.acquire())
+        login_generation = self._login_generation
+        response = self.session.get(
+            url, headers=headers, timeout=60, stream=stream)
         if response.status_code == 403:
-          self.perform_login()
+          response.close()
+          self._relogin(login_generation)
           continue
         if response.status_code == 404:
+          response.close()
           requests_z.labels(status=f'not_found').inc()
           raise APIException(f'Request to url {url} failed with 404')
-        # Raise an error if there is one and retry the request.
-        response.raise_for_status()
+        if response.status_code == 416:
+          response.close()
+          requests_z.labels(status=f'range_not_satisfiable').inc()
+          raise RangeNotSatisfiableException(
+              f'Request to url {url} failed with 416',
+              response.headers.get('Content-Range'))
+        if response.status_code == 429 or response.status_code >= 500:
+          response.close()
+          # pr0gramm is overloaded or throttles us. Slow down all requests and
+          # retry after the time given by pr0gramm.
+          retry_after = _parse_retry_after(response.headers.get('Retry-After'))
+          if retry_after is not None:
+            retry_after = min(retry_after, self.max_retry_after)
+          throttled_z.labels(status=response.status_code).inc()
+          self.rate_limiter.throttled(retry_after)
+          error_count = error_count + 1
+          log.warning(
+              f'Request to {url} was throttled with status {response.status_code}'
+          )
+          self._backoff(url, error_count, retry_after)
+          continue
+        if not response.ok:
+          response.close()
+          # Raise an error if there is one and retry the request.
+          response.raise_for_status()
+        self.rate_limiter.succeeded()
         requests_z.labels(status=f'ok').inc()
         return response
       except (RequestException, Timeout) as e:
-        log.exception(
-            f'Error sending get request to {url}. Retrying in {3 ** error_count} seconds...'
-        )
+        log.exception(f'Error sending get request to {url}')
         error_count = error_count + 1
-        if error_count > 3:
-          requests_z.labels(status='unknown').inc()
-          raise APIException(f'Request to url {url} failed too often') from e
-        time.sleep(3**error_count)
+        try:
+          self._backoff(url, error_count, None)
+        except APIException as api_exception:
+          raise api_exception from e
         continue
 
-  def iterate_posts(self,
-                    start: int | None = 1,
-                    end: int | None = None) -> Iterator[Post]:
-    if not start:
-      start = 1
-    if end and start >= end:
-      return
+  def _iterate_post_pages(self, start: int,
+                          end: int | None) -> Iterator[List[dict[str, Any]]]:
     newer = start - 1
-
     at_start = False
     while not at_start:
       query_params = dict(flags=31, promoted=0, newer=newer)
@@ -170,8 +321,27 @@ class Pr0grammAPI:
           f'{self.baseurl_api}/items/get?{urllib.parse.urlencode(query_params)}'
       ).json()
       at_start = data['atStart']
+      items = data.get('items', ())
+      if not items:
+        return
+      yield items
+      newer = items[-1]['id']
+      if end and newer > end:
+        return
+
+  def iterate_posts(self,
+                    start: int | None = 1,
+                    end: int | None = None) -> Iterator[Post]:
+    if not start:
+      start = 1
+    if end and start >= end:
+      return
 
-      for item in data.get('items', ()):
+    for items in prefetch(
+        self._iterate_post_pages(start, end),
+        self.prefetch_pages,
+        name='Prefetch posts'):
+      for item in items:
         if end and item['id'] > end:
           return
         post = Post()
@@ -188,7 +358,6 @@ class Pr0grammAPI:
         post.flags = item['flags'] or None
         post.username = item['user'] or None
         post.type = post_type_from_media_path(item['image'])
-        newer = post.id
         yield post
 
   def get_latest_post_id(self) -> int | None:
@@ -202,15 +371,22 @@ class Pr0grammAPI:
       return None
     return data['items'][0]['id']
 
-  def iterate_tags(self, start: int = 1) -> Iterator[Tag]:
+  def _iterate_tag_pages(self, start: int) -> Iterator[List[dict[str, Any]]]:
     while True:
       data = self.perform_request(
           f'{self.baseurl_api}/tags/latest?id={start}').json()
+      tags = data.get('tags', ())
+      if len(tags) == 0:
+        return
+      yield tags
+      start = tags[-1]['id']
 
-      if len(data['tags']) == 0:
-        break
-
-      for item in data.get('tags', ()):
+  def iterate_tags(self, start: int = 1) -> Iterator[Tag]:
+    for items in prefetch(
+        self._iterate_tag_pages(start),
+        self.prefetch_pages,
+        name='Prefetch tags'):
+      for item in items:
         tag = Tag()
         tag.id = item['id']
         tag.up = item['up'] or None
@@ -218,20 +394,25 @@ class Pr0grammAPI:
         tag.confidence = item['confidence'] or None
         tag.post_id = item['itemId'] or None
         tag.tag = item['tag'] or None
-        start = tag.id
         yield tag
 
-  def download_image(self, image_path: str) -> bytes:
-    log.debug(f'Downloading image "{image_path}"')
-    return self.perform_request(f'{self.baseurl_img}/{image_path}').content
+  def _stream_media(self, url: str, offset: int = 0) -> Response:
+    headers = None
+    if offset:
+      headers = {'Range': f'bytes={offset}-'}
+    return self.perform_request(url, headers=headers, stream=True)
+
+  def stream_image(self, image_path: str, offset: int = 0) -> Response:
+    log.debug(f'Downloading image "{image_path}" from offset {offset}')
+    return self._stream_media(f'{self.baseurl_img}/{image_path}', offset)
 
-  def download_fullsize(self, fullsize_path: str) -> bytes:
-    log.debug(f'Downloading fullsize "{fullsize_path}"')
-    return self.perform_request(f'{self.baseurl_full}/{fullsize_path}').content
+  def stream_fullsize(self, fullsize_path: str, offset: int = 0) -> Response:
+    log.debug(f'Downloading fullsize "{fullsize_path}" from offset {offset}')
+    return self._stream_media(f'{self.baseurl_full}/{fullsize_path}', offset)
 
-  def download_video(self, video_path: str) -> bytes:
-    log.debug(f'Downloading video "{video_path}"')
-    return self.perform_request(f'{self.baseurl_vid}/{video_path}').content
+  def stream_video(self, video_path: str, offset: int = 0) -> Response:
+    log.debug(f'Downloading video "{video_path}" from offset {offset}')
+    return self._stream_media(f'{self.baseurl_vid}/{video_path}', offset)
 
 
 class Pr0grammAPIModule(Module):
@@ -244,4 +425,11 @@ class Pr0grammAPIModule(Module):
         get_secret(FLAGS.pr0gramm_api_password,
                    FLAGS.pr0gramm_api_password_file),
         FLAGS.pr0gramm_api_baseurl_api, FLAGS.pr0gramm_api_baseurl_img,
-        FLAGS.pr0gramm_api_baseurl_vid, FLAGS.pr0gramm_api_baseurl_full)
+        FLAGS.pr0gramm_api_baseurl_vid, FLAGS.pr0gramm_api_baseurl_full,
+        PoolSizes(FLAGS.pr0gramm_api_pool_size_api,
+                  FLAGS.pr0gramm_api_pool_size_img,
+                  FLAGS.pr0gramm_api_pool_size_vid,
+                  FLAGS.pr0gramm_api_pool_size_full),
+        RateLimiter(FLAGS.pr0gramm_api_rate_limit,
+                    FLAGS.pr0gramm_api_rate_limit_burst),
+        FLAGS.pr0gramm_api_prefetch_pages, FLAGS.pr0gramm_api_max_retry_after)
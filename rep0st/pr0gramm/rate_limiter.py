@@ -0,0 +1,73 @@
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class RateLimiter:
+  """Token bucket limiting the number of requests per second.
+
+  The rate adapts to upstream throttling: it is halved every time a request is
+  throttled and slowly recovers to the configured rate with every successful
+  request.
+  """
+  max_rate: float = None
+  min_rate: float = None
+  burst: int = None
+  rate: float = None
+
+  def __init__(self, max_rate: float, burst: int, min_rate: float = 0.5):
+    self.max_rate = max_rate
+    self.min_rate = min(min_rate, max_rate)
+    self.burst = max(burst, 1)
+    self.rate = max_rate
+    self._lock = threading.Lock()
+    self._tokens = float(self.burst)
+    self._last_refill = time.monotonic()
+    self._blocked_until = 0.0
+
+  def enabled(self) -> bool:
+    return self.max_rate > 0
+
+  def _refill(self, now: float) -> None:
+    self._tokens = min(self.burst,
+                       self._tokens + (now - self._last_refill) * self.rate)
+    self._last_refill = now
+
+  def acquire(self) -> float:
+    """Blocks until a request can be sent. Returns the time waited in seconds."""
+    if not self.enabled():
+      return 0
+    with self._lock:
+      now = time.monotonic()
+      self._refill(now)
+      # Take the token right away, even if the bucket goes into debt. Every
+      # caller then waits until its own token is refilled, without holding
+      # the lock.
+      self._tokens -= 1
+      wait = max(-self._tokens / self.rate, self._blocked_until - now, 0)
+    if wait > 0:
+      time.sleep(wait)
+    return wait
+
+  def throttled(self, retry_after: float | None = None) -> None:
+    """Called when upstream throttled a request."""
+    if not self.enabled():
+      return
+    with self._lock:
+      now = time.monotonic()
+      self._refill(now)
+      self.rate = max(self.min_rate, self.rate / 2)
+      if retry_after:
+        self._blocked_until = max(self._blocked_until, now + retry_after)
+    log.info(
+        f'Request was throttled, reducing rate to {self.rate:.2f} requests/s')
+
+  def succeeded(self) -> None:
+    """Called when a request succeeded."""
+    if not self.enabled() or self.rate >= self.max_rate:
+      return
+    with self._lock:
+      self._refill(time.monotonic())
+      self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
@@ -1,15 +1,30 @@
+import hashlib
 import logging
 import os
 from pathlib import Path
+import re
+import time
+from typing import Callable, NamedTuple, Optional, Tuple
+
+from absl import flags
 from injector import Binder, Module, inject, singleton
-from prometheus_client import Counter
+from prometheus_client import Counter, Histogram
+from requests import RequestException, Response
 
-from rep0st.db import PostType
-from rep0st.db.post import Post, PostErrorStatus
-from rep0st.pr0gramm.api import APIException, Pr0grammAPI, Pr0grammAPIModule
-from rep0st.service.media_service import _MediaDirectory, _MediaFlagModule
+from rep0st.db import MediaKind, PostType
+from rep0st.db.media_blob import MediaBlobRepository, MediaBlobRepositoryModule
+from rep0st.db.post import Post, PostErrorStatus, main_media_kind
+from rep0st.pr0gramm.api import APIException, Pr0grammAPI, Pr0grammAPIModule, RangeNotSatisfiableException
+from rep0st.service.media_index_service import MediaIndexService, MediaIndexServiceModule
+from rep0st.service.media_pack import MediaPack
+from rep0st.service.media_service import _MediaDirectory, _MediaFlagModule, _MediaPackModule, blob_file, derivative_file, derivative_source_kind, is_packed, original_file
 
 log = logging.getLogger(__name__)
+FLAGS = flags.FLAGS
+flags.DEFINE_bool(
+    'rep0st_media_store_content_addressed', False,
+    'If True, media files are stored once per content under blobs/ in the '
+    'media directory and the media paths of posts are hard links to them.')
 
 download_media_service_renamed_count_z = Counter(
     'download_media_service_renamed_count',
@@ -17,6 +32,52 @@ download_media_service_renamed_count_z = Counter(
 download_media_service_rename_errors_count_z = Counter(
     'download_media_service_rename_errors_count',
     'Number of errors encountered while performing media rename operations')
+download_media_service_downloaded_bytes_z = Counter(
+    'rep0st_download_media_service_downloaded_bytes',
+    'Number of bytes downloaded by media type.', ['media_type'])
+download_media_service_resumed_z = Counter(
+    'rep0st_download_media_service_resumed',
+    'Number of downloads resumed from a partial file by media type.',
+    ['media_type'])
+download_media_service_size_z = Histogram(
+    'rep0st_download_media_service_size_bytes',
+    'Size of downloaded media files by media type.', ['media_type'],
+    buckets=(16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024,
+             16 * 1024 * 1024, 64 * 1024 * 1024, 256 * 1024 * 1024))
+download_media_service_throughput_z = Histogram(
+    'rep0st_download_media_service_throughput_bytes_per_second',
+    'Throughput of media downloads by media type.', ['media_type'],
+    buckets=(64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024,
+             16 * 1024 * 1024, 64 * 1024 * 1024))
+download_media_service_deduplicated_z = Counter(
+    'rep0st_download_media_service_deduplicated',
+    'Number of downloaded media files already stored as blob by media type.',
+    ['media_type'])
+for media_type in ['image', 'video', 'fullsize']:
+  download_media_service_downloaded_bytes_z.labels(media_type=media_type)
+  download_media_service_resumed_z.labels(media_type=media_type)
+  download_media_service_deduplicated_z.labels(media_type=media_type)
+
+# Size of the chunks read from the response and written to disk.
+_CHUNK_SIZE = 1024 * 1024
+# Number of times a download is resumed if the connection breaks.
+_DOWNLOAD_ATTEMPTS = 3
+# Content-Range header, e.g. `bytes 100-199/1000` or `bytes */1000`.
+_CONTENT_RANGE = re.compile(r'bytes (?:(\d+)-\d+|\*)/(\d+|\*)')
+
+
+def _parse_content_range(
+    value: Optional[str]) -> Tuple[Optional[int], Optional[int]]:
+  """Returns the start and the total size of a Content-Range header.
+
+  Parts missing in the header are None.
+  """
+  match = _CONTENT_RANGE.fullmatch((value or '').strip())
+  if not match:
+    return None, None
+  start, total = match.groups()
+  return (int(start) if start is not None else None,
+          int(total) if total != '*' else None)
 
 
 class DownloadMediaServiceModule(Module):
@@ -24,6 +85,9 @@ class DownloadMediaServiceModule(Module):
   def configure(self, binder: Binder):
     binder.install(Pr0grammAPIModule)
     binder.install(_MediaFlagModule)
+    binder.install(_MediaPackModule)
+    binder.install(MediaIndexServiceModule)
+    binder.install(MediaBlobRepositoryModule)
     binder.bind(DownloadMediaService)
 
 
@@ -31,54 +95,287 @@ class DownloadMediaException(Exception):
   pass
 
 
+class _DownloadedFile(NamedTuple):
+  # Downloaded data if it was kept.
+  data: Optional[bytes]
+  # SHA-256 of the content as hex string.
+  sha256: str
+  size: int
+
+
 @singleton
 class DownloadMediaService:
   api: Pr0grammAPI
   media_dir: Path
+  media_index_service: MediaIndexService
+  media_blob_repository: MediaBlobRepository
+  media_pack: MediaPack
 
   @inject
-  def __init__(self, api: Pr0grammAPI, media_dir: _MediaDirectory):
+  def __init__(self, api: Pr0grammAPI, media_dir: _MediaDirectory,
+               media_index_service: MediaIndexService,
+               media_blob_repository: MediaBlobRepository,
+               media_pack: MediaPack):
     self.api = api
     self.media_dir = media_dir
+    self.media_index_service = media_index_service
+    self.media_blob_repository = media_blob_repository
+    self.media_pack = media_pack
 
-  def download_media(self, post: Post):
+  def _store(self, part_file: Path, media_file: Path, sha256: str,
+             media_type: str) -> None:
+    if not FLAGS.rep0st_media_store_content_addressed:
+      os.replace(part_file, media_file)
+      return
+    blob = blob_file(self.media_dir, sha256)
+    # Link next to the target and rename it, so the target is replaced
+    # atomically.
+    link_file = media_file.with_name(media_file.name + '.link')
+    link_file.unlink(missing_ok=True)
+    if self.media_index_service.contains(blob) or blob.is_file():
+      try:
+        os.link(blob, link_file)
+      except FileNotFoundError:
+        # The index is wrong or the blob was collected since. Store the
+        # downloaded file as blob instead.
+        self.media_index_service.remove(blob)
+      else:
+        log.debug(f'Media {media_file.absolute()} is already stored as blob')
+        download_media_service_deduplicated_z.labels(
+            media_type=media_type).inc()
+        part_file.unlink()
+        os.replace(link_file, media_file)
+        return
+    # Link the target before the file becomes the blob. A blob without other
+    # links is collected.
+    os.link(part_file, link_file)
+    blob.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(part_file, blob)
+    self.media_index_service.add(blob)
+    os.replace(link_file, media_file)
+
+  def pack_file(self, media_file: Path, data: Optional[bytes] = None) -> None:
+    """Moves the media file into the pack segments."""
+    if data is None:
+      data = media_file.read_bytes()
+    self.media_pack.append(
+        media_file.relative_to(self.media_dir).as_posix(), data)
+    media_file.unlink()
+    self.media_index_service.remove(media_file)
 
-    def _download_media(path: str, dl_fn, dir_prefix: str = ''):
-      media_file = self.media_dir / dir_prefix / path
-      if media_file.is_file(
-      ) and post.error_status != PostErrorStatus.MEDIA_BROKEN:
+  def _finish(self, post: Post, part_file: Path, media_file: Path,
+              media_type: str, sha256: str, data: Optional[bytearray],
+              size: int) -> _DownloadedFile:
+    try:
+      self._store(part_file, media_file, sha256, media_type)
+    except (IOError, OSError) as e:
+      raise DownloadMediaException(
+          f'Could not save media for post {post.id} to file {media_file.absolute()}'
+      ) from e
+    return _DownloadedFile(
+        bytes(data) if data is not None else None, sha256, size)
+
+  def _download_to_file(self,
+                        post: Post,
+                        path: str,
+                        media_file: Path,
+                        stream_fn: Callable[[str, int], Response],
+                        media_type: str,
+                        keep_data: bool = False) -> _DownloadedFile:
+    # Download into a partial file next to the target and rename it once the
+    # download is complete. The target never contains a truncated file and an
+    # interrupted download can be resumed from the partial file.
+    part_file = media_file.with_name(media_file.name + '.part')
+    for _ in range(_DOWNLOAD_ATTEMPTS):
+      try:
+        offset = part_file.stat().st_size
+      except FileNotFoundError:
+        offset = 0
+      try:
+        response = stream_fn(path, offset)
+      except RangeNotSatisfiableException as e:
+        _, total = _parse_content_range(e.content_range)
+        if offset and total == offset:
+          # The partial file is complete, the download stopped before it was
+          # renamed.
+          log.debug(
+              f'Partial file {part_file.absolute()} is complete, finishing download'
+          )
+          try:
+            sha256 = hashlib.sha256()
+            with part_file.open('rb') as f:
+              for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+          except (IOError, OSError) as e:
+            raise DownloadMediaException(
+                f'Could not read media for post {post.id} from file {part_file.absolute()}'
+            ) from e
+          return self._finish(post, part_file, media_file, media_type,
+                              sha256.hexdigest(), None, offset)
         log.debug(
-            f'Media for post {post.id} found at location {media_file.absolute()}, skipping download'
+            f'Partial file {part_file.absolute()} does not match the remote file, restarting download'
         )
-        return
-      log.debug(f'Downloading media for post {post.id}')
-      try:
-        data = dl_fn(path)
+        part_file.unlink(missing_ok=True)
+        continue
       except APIException as e:
         raise DownloadMediaException(
             f'Could not download media for post {post.id}') from e
+
+      with response:
+        if offset and response.status_code != 206:
+          # The server ignored the range request and sends the whole file.
+          offset = 0
+        elif offset:
+          start, _ = _parse_content_range(response.headers.get('Content-Range'))
+          if start != offset:
+            log.debug(
+                f'Server sent media for post {post.id} from offset {start} instead of {offset}, restarting download'
+            )
+            part_file.unlink(missing_ok=True)
+            continue
+        if offset:
+          log.debug(
+              f'Resuming download for post {post.id} at offset {offset}')
+          download_media_service_resumed_z.labels(media_type=media_type).inc()
+        start = time.time()
+        size = 0
+        # Resumed downloads only see the tail of the file, so their data
+        # cannot be kept.
+        data = bytearray() if keep_data and not offset else None
+        sha256 = hashlib.sha256()
+        try:
+          part_file.parent.mkdir(parents=True, exist_ok=True)
+          with part_file.open('a+b' if offset else 'wb') as f:
+            if offset:
+              # Hash the part that was already downloaded.
+              f.seek(0)
+              for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+            for chunk in response.iter_content(chunk_size=_CHUNK_SIZE):
+              f.write(chunk)
+              sha256.update(chunk)
+              if data is not None:
+                data += chunk
+              size += len(chunk)
+              download_media_service_downloaded_bytes_z.labels(
+                  media_type=media_type).inc(len(chunk))
+            f.flush()
+            os.fsync(f.fileno())
+        except RequestException:
+          log.exception(
+              f'Connection broke while downloading media for post {post.id}, resuming'
+          )
+          continue
+        except (IOError, OSError) as e:
+          raise DownloadMediaException(
+              f'Could not save media for post {post.id} to file {part_file.absolute()}'
+          ) from e
+      time_taken = time.time() - start
+      download_media_service_size_z.labels(media_type=media_type).observe(
+          offset + size)
+      if time_taken > 0:
+        download_media_service_throughput_z.labels(
+            media_type=media_type).observe(size / time_taken)
+
+      return self._finish(post, part_file, media_file, media_type,
+                          sha256.hexdigest(), data, offset + size)
+    raise DownloadMediaException(
+        f'Could not download media for post {post.id} after {_DOWNLOAD_ATTEMPTS} attempts'
+    )
+
+  def download_file(self,
+                    post: Post,
+                    media_kind: MediaKind,
+                    path: str,
+                    keep_data: bool = False) -> Optional[bytes]:
+    """Downloads a single media file of the post if it is missing or broken.
+
+    Returns the downloaded data if keep_data is set, otherwise None.
+    """
+    media_file = original_file(self.media_dir, media_kind, path)
+    packed = is_packed(post)
+    if media_kind == MediaKind.FULLSIZE:
+      stream_fn = self.api.stream_fullsize
+    elif media_kind == MediaKind.VIDEO:
+      stream_fn = self.api.stream_video
+    else:
+      stream_fn = self.api.stream_image
+    if post.error_status == PostErrorStatus.MEDIA_BROKEN:
+      exists = False
+    elif post.type == PostType.IMAGE and self.media_pack.contains(
+        media_file.relative_to(self.media_dir).as_posix()):
+      exists = True
+    elif (FLAGS.rep0st_media_derivatives and
+          not FLAGS.rep0st_media_keep_originals and
+          media_kind == derivative_source_kind(post) and
+          derivative_file(self.media_dir, post).is_file()):
+      # The original was removed after the derivative was written. Other
+      # media is still downloaded, the derivative might have been written
+      # before the media it is made from arrived.
+      exists = True
+    elif post.error_status in (None, PostErrorStatus.MEDIA_PENDING):
+      exists = self.media_index_service.contains(media_file)
+    else:
+      # The index might be wrong for posts with errors, e.g. if the file was
+      # removed by hand. Check the file itself.
+      exists = media_file.is_file()
+    if exists:
+      log.debug(
+          f'Media for post {post.id} found at location {media_file.absolute()}, skipping download'
+      )
+      return None
+    log.debug(f'Downloading {media_kind.name} media for post {post.id}')
+    downloaded = self._download_to_file(
+        post,
+        path,
+        media_file,
+        stream_fn,
+        media_kind.value.lower(),
+        keep_data=keep_data or packed)
+    if packed:
       try:
-        media_file.parent.mkdir(parents=True, exist_ok=True)
-        with media_file.open('wb') as f:
-          f.write(data)
-        return
+        self.pack_file(media_file, downloaded.data)
       except (IOError, OSError) as e:
         raise DownloadMediaException(
-            f'Could not save media for post {post.id} to file {media_file.absolute()}'
-        ) from e
+            f'Could not pack media for post {post.id}') from e
+    else:
+      self.media_index_service.add(media_file)
+    # Remember the content of the media, so posts with identical media can
+    # share features.
+    self.media_blob_repository.record(
+        media_file.relative_to(self.media_dir).as_posix(), post.id, media_kind,
+        downloaded.sha256, downloaded.size)
+    return downloaded.data if keep_data else None
+
+  def download_media(self,
+                     post: Post,
+                     keep_data: bool = False) -> Optional[bytes]:
+    """Downloads the media of the post if it is missing or broken.
 
+    If keep_data is set, the downloaded data of the media features are
+    calculated from is returned for images, so it does not have to be read
+    from disk again. None is returned if nothing was downloaded.
+    """
+    keep_data = keep_data and post.type == PostType.IMAGE
+    fullsize_data = None
+    fullsize_downloaded = False
     if post.fullsize:
       try:
-        _download_media(
-            post.fullsize, self.api.download_fullsize, dir_prefix='full')
+        fullsize_data = self.download_file(
+            post, MediaKind.FULLSIZE, post.fullsize, keep_data=keep_data)
+        fullsize_downloaded = True
       except:
         log.exception('Error downloading fullsize image. Skipping...')
 
-    if post.type == PostType.IMAGE or post.type == PostType.ANIMATED:
-      _download_media(post.image, self.api.download_image)
-    elif post.type == PostType.VIDEO:
-      _download_media(post.image, self.api.download_video)
-    else:
+    media_kind = main_media_kind(post)
+    if media_kind is None:
       log.error(
           f'Error downloading media for post {post.id} with unknown type {post.type}'
       )
+      return None
+    data = self.download_file(
+        post, media_kind, post.image, keep_data=keep_data)
+    # Features are calculated from the fullsize image if it exists.
+    if fullsize_downloaded:
+      return fullsize_data
+    return data
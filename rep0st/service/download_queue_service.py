@@ -0,0 +1,249 @@
+import logging
+from typing import List, Optional
+
+from absl import flags
+from injector import Binder, Module, inject, singleton
+from joblib import Parallel, delayed, parallel_backend
+from prometheus_client import Counter
+from prometheus_client.metrics import Gauge
+from sqlalchemy import exists
+
+from rep0st.db import MediaKind, PostType
+from rep0st.db.download_queue import PRIORITY_BACKFILL, ClaimedDownload, DownloadQueueItem, DownloadQueueRepository, DownloadQueueRepositoryModule
+from rep0st.db.feature import FeatureVector, FeatureVectorRepository
+from rep0st.db.post import Post, PostErrorStatus, PostRepository, PostRepositoryModule
+from rep0st.db.post_duplicate import PostDuplicateRepository, PostDuplicateRepositoryModule
+from rep0st.framework.data.transaction import transactional
+from rep0st.service.download_media_service import DownloadMediaService, DownloadMediaServiceModule
+from rep0st.service.feature_service import FeatureService, FeatureServiceModule
+from rep0st.service.media_derivative_service import MediaDerivativeService, MediaDerivativeServiceModule
+from rep0st.service.media_service import derivative_source_kind
+from rep0st.service.repost_stream_service import IndexedPost, RepostStreamService, RepostStreamServiceModule
+
+log = logging.getLogger(__name__)
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('rep0st_download_workers', 8,
+                     'Number of media downloads running concurrently.')
+flags.DEFINE_integer(
+    'rep0st_download_queue_visibility_timeout', 600,
+    'Seconds a claimed download is hidden from other workers. If the worker '
+    'does not finish it in time, the download is claimed again.')
+flags.DEFINE_integer(
+    'rep0st_download_queue_max_attempts', 5,
+    'Number of attempts before a download is given up and the post is marked '
+    'with NO_MEDIA_FOUND.')
+flags.DEFINE_integer(
+    'rep0st_download_queue_retry_delay', 60,
+    'Seconds before a failed download is retried. Doubles with every attempt.')
+flags.DEFINE_bool(
+    'rep0st_inline_features', False,
+    'If True, features of posts are calculated right after their media was '
+    'downloaded and saved together with the post. The feature update job then only '
+    'processes backfills and retries.')
+
+download_queue_depth_z = Gauge('rep0st_download_queue_depth',
+                               'Number of downloads in the queue.')
+download_queue_oldest_age_z = Gauge('rep0st_download_queue_oldest_age_seconds',
+                                    'Age of the oldest download in the queue.')
+download_queue_processed_z = Counter(
+    'rep0st_download_queue_processed',
+    'Number of downloads processed by result.', ['result'])
+for result in ['completed', 'retried', 'failed']:
+  download_queue_processed_z.labels(result=result)
+download_queue_inline_features_added_z = Counter(
+    'rep0st_download_queue_inline_features_added',
+    'Number of features added to the index right after downloading the media.')
+
+
+class DownloadQueueServiceModule(Module):
+
+  def configure(self, binder: Binder):
+    binder.install(DownloadQueueRepositoryModule)
+    binder.install(PostRepositoryModule)
+    binder.install(PostDuplicateRepositoryModule)
+    binder.install(DownloadMediaServiceModule)
+    binder.install(FeatureServiceModule)
+    binder.install(MediaDerivativeServiceModule)
+    binder.install(RepostStreamServiceModule)
+    binder.bind(DownloadQueueService)
+
+
+@singleton
+class DownloadQueueService:
+  download_queue_repository: DownloadQueueRepository = None
+  post_repository: PostRepository = None
+  post_duplicate_repository: PostDuplicateRepository = None
+  download_media_service: DownloadMediaService = None
+  feature_service: FeatureService = None
+  feature_vector_repository: FeatureVectorRepository = None
+  media_derivative_service: MediaDerivativeService = None
+  repost_stream_service: RepostStreamService = None
+
+  @inject
+  def __init__(self, download_queue_repository: DownloadQueueRepository,
+               post_repository: PostRepository,
+               post_duplicate_repository: PostDuplicateRepository,
+               download_media_service: DownloadMediaService,
+               feature_service: FeatureService,
+               feature_vector_repository: FeatureVectorRepository,
+               media_derivative_service: MediaDerivativeService,
+               repost_stream_service: RepostStreamService):
+    self.download_queue_repository = download_queue_repository
+    self.post_repository = post_repository
+    self.post_duplicate_repository = post_duplicate_repository
+    self.download_media_service = download_media_service
+    self.feature_service = feature_service
+    self.feature_vector_repository = feature_vector_repository
+    self.media_derivative_service = media_derivative_service
+    self.repost_stream_service = repost_stream_service
+    download_queue_depth_z.set_function(self.download_queue_repository.depth)
+    download_queue_oldest_age_z.set_function(
+        self.download_queue_repository.oldest_age)
+
+  @transactional()
+  def enqueue_orphaned_posts(self) -> None:
+    # Posts waiting for media that is not in the queue, e.g. if they were
+    # saved before the queue existed.
+    posts = self.post_repository.get_posts().filter(
+        Post.error_status == PostErrorStatus.MEDIA_PENDING,
+        ~exists().where(DownloadQueueItem.post_id == Post.id)).all()
+    if posts:
+      log.info(f'Adding media of {len(posts)} waiting posts to the queue')
+      self.download_queue_repository.enqueue_posts(posts, PRIORITY_BACKFILL)
+
+  @transactional()
+  def _get_post(self, post_id: int) -> Optional[Post]:
+    post = self.post_repository.get_by_id(post_id).one_or_none()
+    if post is None:
+      return None
+    # The post is detached once the transaction ends, so copy what is needed
+    # for the download.
+    return Post(
+        id=post.id,
+        type=post.type,
+        image=post.image,
+        fullsize=post.fullsize,
+        error_status=post.error_status)
+
+  def _add_features(self, post: Post,
+                    data: Optional[bytes]) -> List[FeatureVector]:
+    feature_vectors = self.feature_service.add_features_to_posts(
+        [post], media_data={post.id: data} if data is not None else {})
+    self.feature_vector_repository.add_all(feature_vectors)
+    download_queue_inline_features_added_z.inc(len(feature_vectors))
+    log.debug(f'Calculated {len(feature_vectors)} features for post {post.id}')
+    return feature_vectors
+
+  @transactional(autoflush=False)
+  def _complete(self, download: ClaimedDownload,
+                data: Optional[bytes]) -> List[IndexedPost]:
+    """Returns the post for the repost stream if its features were indexed."""
+    self.download_queue_repository.complete(download.id)
+    download_queue_processed_z.labels(result='completed').inc()
+    if download.media_kind == MediaKind.FULLSIZE:
+      return []
+    post = self.post_repository.get_by_id(download.post_id).one_or_none()
+    if post is None:
+      return []
+    if post.error_status is not None:
+      # The media is usable again. Remove the features and the duplicates
+      # found with them, the update feature job indexes the media again.
+      post.error_status = None
+      post.media_retry_after = None
+      post.media_retries = 0
+      post.feature_vectors = []
+      post.features_indexed = False
+      post.duplicates_searched = False
+      self.post_duplicate_repository.remove_post(post.id)
+    feature_vectors = []
+    if not post.features_indexed:
+      # Reposts of identical media get the features of the original post.
+      feature_vectors = self.feature_service.copy_duplicate_features([post])
+      if feature_vectors:
+        self.feature_vector_repository.add_all(feature_vectors)
+      elif FLAGS.rep0st_inline_features:
+        feature_vectors = self._add_features(post, data)
+    self.post_repository.persist(post)
+    return self.repost_stream_service.snapshot([post], feature_vectors)
+
+  @transactional()
+  def _fail(self, download: ClaimedDownload, error: str) -> None:
+    if download.attempts < FLAGS.rep0st_download_queue_max_attempts:
+      delay = FLAGS.rep0st_download_queue_retry_delay * 2**(
+          download.attempts - 1)
+      log.info(
+          f'Retrying download {download.id} for post {download.post_id} in {delay}s'
+      )
+      self.download_queue_repository.retry(download.id, error, delay)
+      download_queue_processed_z.labels(result='retried').inc()
+      return
+    log.error(
+        f'Giving up download {download.id} for post {download.post_id} after {download.attempts} attempts'
+    )
+    self.download_queue_repository.complete(download.id)
+    download_queue_processed_z.labels(result='failed').inc()
+    if download.media_kind == MediaKind.FULLSIZE:
+      return
+    post = self.post_repository.get_by_id(download.post_id).one_or_none()
+    if post is not None and post.error_status == PostErrorStatus.MEDIA_PENDING:
+      post.error_status = PostErrorStatus.NO_MEDIA_FOUND
+      self.post_repository.persist(post)
+
+  def _create_derivative(self, post: Post, download: ClaimedDownload,
+                         data: Optional[bytes]) -> None:
+    if (download.media_kind == derivative_source_kind(post) or
+        not self.media_derivative_service.has_derivative(post)):
+      # The derivative is created from whatever media is there first and
+      # replaced once the media features are calculated from arrives.
+      if not self.media_derivative_service.create(post, data):
+        return
+    if not FLAGS.rep0st_media_keep_originals:
+      self.media_derivative_service.remove_original(post, download.media_kind,
+                                                    download.path)
+
+  def _process_download(self, download: ClaimedDownload) -> None:
+    post = self._get_post(download.post_id)
+    if post is None:
+      log.debug(f'Post {download.post_id} of download {download.id} is gone')
+      self.download_queue_repository.complete(download.id)
+      return
+    # Keep the data if features are calculated from it right away. If the post
+    # has a fullsize image, features are calculated from it and it is read
+    # from disk.
+    keep_data = (
+        FLAGS.rep0st_inline_features and post.type == PostType.IMAGE and
+        download.media_kind == MediaKind.IMAGE and not post.fullsize)
+    data = self.download_media_service.download_file(
+        post, download.media_kind, download.path, keep_data=keep_data)
+    if FLAGS.rep0st_media_derivatives:
+      self._create_derivative(post, download, data)
+    indexed_posts = self._complete(download, data)
+    self.repost_stream_service.submit(indexed_posts)
+
+  def _work(self) -> int:
+    processed = 0
+    while True:
+      downloads = self.download_queue_repository.claim(
+          1, FLAGS.rep0st_download_queue_visibility_timeout)
+      if not downloads:
+        return processed
+      download = downloads[0]
+      try:
+        self._process_download(download)
+      except Exception as e:
+        log.exception(
+            f'Error processing {download.media_kind.name} media for post {download.post_id}'
+        )
+        self._fail(download, str(e))
+      processed += 1
+
+  def process_queue(self) -> int:
+    """Downloads media until no download is visible in the queue.
+
+    Returns the number of processed downloads.
+    """
+    workers = FLAGS.rep0st_download_workers
+    with parallel_backend('threading'), Parallel(n_jobs=workers) as parallel:
+      processed = sum(parallel(delayed(self._work)() for _ in range(workers)))
+    log.info(f'Processed {processed} downloads')
+    return processed
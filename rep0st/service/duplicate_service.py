@@ -0,0 +1,122 @@
+from collections import defaultdict
+import logging
+from typing import List, Optional
+
+from absl import flags
+from injector import Binder, Module, inject, singleton
+from prometheus_client import Counter
+
+from rep0st.db import PostType
+from rep0st.db.feature import FeatureVectorRepository, FeatureVectorRepositoryModule
+from rep0st.db.post import Post, PostRepository, PostRepositoryModule
+from rep0st.db.post_duplicate import ClusterMember, Duplicate, PostDuplicateRepository, PostDuplicateRepositoryModule
+from rep0st.framework.data.transaction import transactional
+
+log = logging.getLogger(__name__)
+FLAGS = flags.FLAGS
+flags.DEFINE_float(
+    'rep0st_duplicates_min_score', 0.98,
+    'Minimum similarity of two posts to be saved as duplicates.')
+flags.DEFINE_integer(
+    'rep0st_duplicates_candidates', 20,
+    'Number of nearest neighbours looked at per feature vector of a post.')
+flags.DEFINE_integer('rep0st_duplicates_batch_size', 100,
+                     'Number of posts searched for duplicates per transaction.')
+
+duplicate_service_posts_searched_z = Counter(
+    'rep0st_duplicate_service_posts_searched',
+    'Number of posts searched for duplicates.')
+duplicate_service_duplicates_found_z = Counter(
+    'rep0st_duplicate_service_duplicates_found',
+    'Number of duplicates found between posts.')
+
+# Types searched for duplicates of a post of a type. Gifs are commonly
+# uploaded as videos and the other way around.
+_SEARCHED_TYPES = {
+    PostType.IMAGE: [PostType.IMAGE],
+    PostType.ANIMATED: [PostType.ANIMATED, PostType.VIDEO],
+    PostType.VIDEO: [PostType.VIDEO, PostType.ANIMATED],
+}
+
+
+class DuplicateServiceModule(Module):
+
+  def configure(self, binder: Binder):
+    binder.install(PostRepositoryModule)
+    binder.install(FeatureVectorRepositoryModule)
+    binder.install(PostDuplicateRepositoryModule)
+    binder.bind(DuplicateService)
+
+
+@singleton
+class DuplicateService:
+  """Finds duplicates (reposts) of posts in the feature index.
+
+  Every post is searched once after its features were indexed. Duplicates
+  are saved as edges between two posts, connected posts form a cluster.
+  """
+  post_repository: PostRepository
+  feature_vector_repository: FeatureVectorRepository
+  post_duplicate_repository: PostDuplicateRepository
+
+  @inject
+  def __init__(self, post_repository: PostRepository,
+               feature_vector_repository: FeatureVectorRepository,
+               post_duplicate_repository: PostDuplicateRepository):
+    self.post_repository = post_repository
+    self.feature_vector_repository = feature_vector_repository
+    self.post_duplicate_repository = post_duplicate_repository
+
+  def find_duplicates(self, post: Post, feature_vectors) -> List[Duplicate]:
+    """Returns the duplicates of the post among the indexed posts."""
+    duplicates = []
+    for type in _SEARCHED_TYPES.get(post.type, []):
+      candidates = FLAGS.rep0st_duplicates_candidates
+      for score, _, other in self.post_repository.search_posts_multi(
+          type, feature_vectors,
+          limit_per_vector=candidates).limit(candidates):
+        if score < FLAGS.rep0st_duplicates_min_score:
+          break
+        if other.id != post.id:
+          duplicates.append(Duplicate(post.id, other.id, float(score)))
+    return duplicates
+
+  @transactional()
+  def _process_batch(self) -> int:
+    posts = self.post_repository.get_posts_missing_duplicate_search(
+        FLAGS.rep0st_duplicates_batch_size)
+    if not posts:
+      return 0
+    feature_vectors = defaultdict(list)
+    for feature_vector in self.feature_vector_repository.get_by_post_ids(
+        [post.id for post in posts]):
+      feature_vectors[feature_vector.post_id].append(feature_vector.vec)
+    duplicates = []
+    for post in posts:
+      if feature_vectors[post.id]:
+        duplicates += self.find_duplicates(post, feature_vectors[post.id])
+      post.duplicates_searched = True
+    self.post_duplicate_repository.add_duplicates(duplicates)
+    self.post_repository.add_all(posts)
+    duplicate_service_posts_searched_z.inc(len(posts))
+    duplicate_service_duplicates_found_z.inc(len(duplicates))
+    log.info(
+        f'Found {len(duplicates)} duplicates for {len(posts)} posts up to {posts[-1].id}'
+    )
+    return len(posts)
+
+  def update_duplicates(self) -> None:
+    """Searches duplicates of all indexed posts not searched yet."""
+    counter = 0
+    while True:
+      processed = self._process_batch()
+      if processed == 0:
+        break
+      counter += processed
+    log.info(f'Finished searching duplicates of {counter} posts')
+
+  def get_cluster_id(self, post_id: int) -> Optional[int]:
+    return self.post_duplicate_repository.get_cluster_id(post_id)
+
+  def get_reposts(self, post_id: int) -> List[ClusterMember]:
+    return self.post_duplicate_repository.get_cluster(post_id)
@@ -1,7 +1,11 @@
+from collections import defaultdict
+import itertools
 import logging
 from multiprocessing import TimeoutError
-from typing import List, Optional, Tuple
+import threading
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
+from absl import flags
 import numpy
 from numpy.typing import NDArray
 from injector import Binder, Module, inject, singleton
@@ -11,12 +15,31 @@ from prometheus_client.metrics import Gauge
 
 from rep0st.db import PostType
 from rep0st.db.feature import FeatureVector, FeatureVectorRepository, FeatureVectorRepositoryModule
+from rep0st.db.media_blob import MediaBlobRepository, MediaBlobRepositoryModule
 from rep0st.db.post import Post, PostErrorStatus, PostRepository, PostRepositoryModule
 from rep0st.framework.data.transaction import transactional
 from rep0st.service.analyze_service import AnalyzeService, AnalyzeServiceModule
 from rep0st.service.media_service import ImageDecodeException, NoMediaFoundException, ReadMediaService, ReadMediaServiceModule
+from rep0st.service.repost_stream_service import IndexedPost, RepostStreamService, RepostStreamServiceModule
 
 log = logging.getLogger(__name__)
+FLAGS = flags.FLAGS
+flags.DEFINE_integer(
+    'rep0st_feature_max_frames', 30,
+    'Maximum number of frames stored per video or animated image. 0 stores every frame.'
+)
+flags.DEFINE_bool(
+    'rep0st_feature_scene_selection', True,
+    'If True, frames starting a new scene are kept when a video or animated image has more frames than '
+    'rep0st_feature_max_frames. Otherwise frames are sampled evenly.')
+flags.DEFINE_integer(
+    'rep0st_feature_max_decoded_frames', 600,
+    'Maximum number of frames decoded per video or animated image. Later frames '
+    'are not considered by the frame sampling. 0 decodes every frame.')
+flags.DEFINE_float(
+    'rep0st_feature_collapse_epsilon', 0.3,
+    'Consecutive frames with a feature vector distance less or equal to this value are '
+    'collapsed into a single frame.')
 
 feature_service_features_added_z = Counter(
     'rep0st_feature_service_features_added',
@@ -30,6 +53,83 @@ feature_service_latest_post_with_features_in_database_z = Gauge(
 feature_service_post_count_with_features_in_database_z = Gauge(
     'rep0st_feature_service_post_count_with_features_in_database',
     'Number of posts with features in the database.')
+feature_service_features_copied_z = Counter(
+    'rep0st_feature_service_features_copied',
+    'Number of features copied from posts with identical media.')
+feature_service_frames_dropped_z = Counter(
+    'rep0st_feature_service_frames_dropped',
+    'Number of decoded frames dropped by the frame sampling policy.')
+
+# Post types that produce multiple frames and therefore multiple features.
+FRAME_SAMPLED_POST_TYPES = {PostType.VIDEO, PostType.ANIMATED}
+
+
+class FrameSamplingPolicy(NamedTuple):
+  # Maximum number of frames kept. 0 keeps every frame.
+  max_frames: int
+  # Keep the frames that start new scenes instead of sampling evenly.
+  scene_selection: bool
+  # Maximum distance between consecutive frames to collapse them.
+  collapse_epsilon: float
+  # Maximum number of frames decoded. 0 decodes every frame.
+  max_decoded_frames: int = 0
+
+
+def decoded_frames(frames: Iterable[numpy.ndarray],
+                   policy: FrameSamplingPolicy) -> Iterator[numpy.ndarray]:
+  """Returns the frames considered by the frame sampling.
+
+  Stops the decoder once the policy does not need more frames.
+  """
+  try:
+    yield from itertools.islice(frames, policy.max_decoded_frames or None)
+  finally:
+    if hasattr(frames, 'close'):
+      frames.close()
+
+
+def sample_frames(feature_vectors: List[NDArray[numpy.float32]],
+                  policy: FrameSamplingPolicy) -> List[int]:
+  """Returns the indices of the frames to keep, in order."""
+  if not feature_vectors:
+    return []
+
+  # Collapse consecutive frames into the last kept frame if they are too
+  # similar. The distance to the last kept frame is the scene change score.
+  kept = [0]
+  scene_change = [numpy.inf]
+  for i in range(1, len(feature_vectors)):
+    distance = numpy.linalg.norm(feature_vectors[i] -
+                                 feature_vectors[kept[-1]])
+    if distance <= policy.collapse_epsilon:
+      continue
+    kept.append(i)
+    scene_change.append(distance)
+
+  if policy.max_frames and len(kept) > policy.max_frames:
+    if policy.scene_selection:
+      selected = sorted(
+          range(len(kept)), key=lambda k: scene_change[k],
+          reverse=True)[:policy.max_frames]
+      kept = [kept[k] for k in sorted(selected)]
+    else:
+      kept = [
+          kept[k * len(kept) // policy.max_frames]
+          for k in range(policy.max_frames)
+      ]
+  return kept
+
+
+class FrameSamplingPolicyModule(Module):
+
+  def configure(self, binder: Binder):
+    binder.bind(
+        FrameSamplingPolicy,
+        to=FrameSamplingPolicy(
+            max_frames=FLAGS.rep0st_feature_max_frames,
+            scene_selection=FLAGS.rep0st_feature_scene_selection,
+            collapse_epsilon=FLAGS.rep0st_feature_collapse_epsilon,
+            max_decoded_frames=FLAGS.rep0st_feature_max_decoded_frames))
 
 
 class FeatureServiceModule(Module):
@@ -37,8 +137,11 @@ class FeatureServiceModule(Module):
   def configure(self, binder: Binder):
     binder.install(PostRepositoryModule)
     binder.install(FeatureVectorRepositoryModule)
+    binder.install(MediaBlobRepositoryModule)
     binder.install(AnalyzeServiceModule)
     binder.install(ReadMediaServiceModule)
+    binder.install(FrameSamplingPolicyModule)
+    binder.install(RepostStreamServiceModule)
     binder.bind(FeatureService)
 
 
@@ -58,17 +161,19 @@ class WorkPost:
   error_status: PostErrorStatus = None
   image: str = None
   fullsize: str = None
+  data: bytes = None
   images: List[WorkImage] = []
   started: bool = False
   done: bool = False
 
-  def __init__(self, post: Post):
+  def __init__(self, post: Post, data: bytes | None = None):
     self.post = post
     self.id = post.id
     self.type = post.type
     self.error_status = post.error_status
     self.image = post.image
     self.fullsize = post.fullsize
+    self.data = data
     self.images = []
     self.started = False
     self.done = False
@@ -80,16 +185,25 @@ class FeatureService:
   post_repository: PostRepository = None
   feature_vector_repository: FeatureVectorRepository = None
   analyze_service: AnalyzeService = None
+  frame_sampling_policy: FrameSamplingPolicy = None
+  media_blob_repository: MediaBlobRepository = None
+  repost_stream_service: RepostStreamService = None
 
   @inject
   def __init__(self, read_media_service: ReadMediaService,
                post_repository: PostRepository,
                feature_vector_repository: FeatureVectorRepository,
-               analyze_service: AnalyzeService):
+               analyze_service: AnalyzeService,
+               frame_sampling_policy: FrameSamplingPolicy,
+               media_blob_repository: MediaBlobRepository,
+               repost_stream_service: RepostStreamService):
     self.read_media_service = read_media_service
     self.post_repository = post_repository
     self.feature_vector_repository = feature_vector_repository
     self.analyze_service = analyze_service
+    self.frame_sampling_policy = frame_sampling_policy
+    self.media_blob_repository = media_blob_repository
+    self.repost_stream_service = repost_stream_service
     feature_service_latest_post_with_features_in_database_z.set_function(
         self.post_repository.get_latest_post_id_with_features)
     feature_service_post_count_with_features_in_database_z.set_function(
@@ -98,9 +212,22 @@ class FeatureService:
   def _process_work_post(self, work_post: WorkPost) -> WorkPost:
     work_post.started = True
     try:
-      for i, image in enumerate(self.read_media_service.get_images(work_post)):
+      images = self.read_media_service.get_images(
+          work_post, data=work_post.data)
+      if work_post.type in FRAME_SAMPLED_POST_TYPES:
+        images = decoded_frames(images, self.frame_sampling_policy)
+      for i, image in enumerate(images):
         work_post.images.append(
             WorkImage(i, self.analyze_service.analyze(image)))
+      if work_post.type in FRAME_SAMPLED_POST_TYPES:
+        frame_count = len(work_post.images)
+        work_post.images = [
+            work_post.images[i] for i in sample_frames(
+                [image.feature_vector for image in work_post.images],
+                self.frame_sampling_policy)
+        ]
+        feature_service_frames_dropped_z.inc(frame_count -
+                                             len(work_post.images))
       work_post.error_status = None
     except NoMediaFoundException:
       work_post.error_status = PostErrorStatus.NO_MEDIA_FOUND
@@ -112,15 +239,51 @@ class FeatureService:
       log.exception(
           f'Error getting images for post {work_post.id}. No features are generated for it and post marked with IMAGE_BROKEN'
       )
+    work_post.data = None
     work_post.done = True
 
+  def _process_work_post_in_window(self, work_post: WorkPost,
+                                   window: threading.Semaphore) -> None:
+    try:
+      self._process_work_post(work_post)
+    finally:
+      window.release()
+
+  def _prefetch(self, work_posts: List[WorkPost], window: threading.Semaphore,
+                stop: threading.Event) -> None:
+    # Stays at most the size of the window ahead of the processed posts, so
+    # prefetched media is not evicted before it is read.
+    for work_post in work_posts:
+      window.acquire()
+      if stop.is_set():
+        return
+      self.read_media_service.prefetch(work_post)
+
   def add_features_to_posts(
       self,
       posts: List[Post],
-      parallel: Optional[Parallel] = None) -> List[FeatureVector]:
-    work_posts = [WorkPost(post) for post in posts]
+      parallel: Optional[Parallel] = None,
+      media_data: Dict[int, bytes] | None = None) -> List[FeatureVector]:
+    media_data = media_data or {}
+    work_posts = [WorkPost(post, media_data.get(post.id)) for post in posts]
+    work_posts.sort(key=self.read_media_service.read_order_key)
 
-    if parallel:
+    if parallel and FLAGS.rep0st_media_readahead:
+      window = threading.Semaphore(FLAGS.rep0st_media_readahead)
+      stop = threading.Event()
+      threading.Thread(
+          target=self._prefetch, args=(work_posts, window, stop),
+          daemon=True).start()
+      try:
+        parallel(
+            delayed(self._process_work_post_in_window)(work_post, window)
+            for work_post in work_posts)
+      except TimeoutError:
+        pass
+      finally:
+        stop.set()
+        window.release()
+    elif parallel:
       try:
         parallel(
             delayed(self._process_work_post)(work_post)
@@ -152,24 +315,63 @@ class FeatureService:
                   vec=image.feature_vector))
     return feature_vectors
 
+  @transactional()
+  def copy_duplicate_features(self, posts: List[Post]) -> List[FeatureVector]:
+    """Copies the features of indexed posts with identical media.
+
+    Posts that got features are marked as indexed. Returns the copied
+    features.
+    """
+    sources = self.media_blob_repository.get_feature_sources(
+        [post.id for post in posts])
+    if not sources:
+      return []
+    source_vectors = defaultdict(list)
+    for feature_vector in self.feature_vector_repository.get_by_post_ids(
+        set(sources.values())):
+      source_vectors[feature_vector.post_id].append(feature_vector)
+
+    feature_vectors = []
+    for post in posts:
+      if post.id not in sources:
+        continue
+      for source_vector in source_vectors[sources[post.id]]:
+        post.features_indexed = True
+        feature_vectors.append(
+            FeatureVector(
+                post=post,
+                id=source_vector.id,
+                post_type=post.type,
+                vec=source_vector.vec))
+    log.debug(
+        f'Copied {len(feature_vectors)} features for {len(sources)} posts with identical media'
+    )
+    feature_service_features_copied_z.inc(len(feature_vectors))
+    return feature_vectors
+
   @transactional(autoflush=False)
   def _process_features(
       self,
       post_type: PostType,
-      parallel: Optional[Parallel] = None) -> Tuple[int, int, int]:
+      parallel: Optional[Parallel] = None
+  ) -> Tuple[int, int, int, List[IndexedPost]]:
     posts = self.post_repository.get_posts_missing_features(
         type=post_type).limit(1000).all()
     if len(posts) == 0:
-      return 0, 0, 0
-    log.debug(f'Calculating features for {len(posts)} posts')
-    feature_vectors = self.add_features_to_posts(posts, parallel=parallel)
+      return 0, 0, 0, []
+    feature_vectors = self.copy_duplicate_features(posts)
+    remaining_posts = [post for post in posts if not post.features_indexed]
+    log.debug(f'Calculating features for {len(remaining_posts)} posts')
+    feature_vectors += self.add_features_to_posts(
+        remaining_posts, parallel=parallel)
     feature_count = len(feature_vectors)
     log.debug(
         f'Saving {feature_count} features for {len(posts)} posts to database')
     self.feature_vector_repository.add_all(feature_vectors)
     self.post_repository.add_all(posts)
     max_post_id = max(posts, key=lambda p: p.id).id
-    return len(posts), feature_count, max_post_id
+    indexed_posts = self.repost_stream_service.snapshot(posts, feature_vectors)
+    return len(posts), feature_count, max_post_id, indexed_posts
 
   def update_features(self, post_type: PostType):
     log.info(f'Starting feature update for post type {post_type}')
@@ -177,10 +379,13 @@ class FeatureService:
     feature_counter = 0
     with parallel_backend('threading'), Parallel(timeout=120.0) as parallel:
       while True:
-        post_count, feature_count, max_post_id = self._process_features(
-            post_type, parallel=parallel)
+        (post_count, feature_count, max_post_id,
+         indexed_posts) = self._process_features(
+             post_type, parallel=parallel)
         if post_count == 0:
           break
+        # The features are committed, so the posts can be found by others.
+        self.repost_stream_service.submit(indexed_posts)
         feature_service_latest_processed_post_z.set(max_post_id)
         feature_service_features_added_z.inc(feature_count)
         log.info(
@@ -0,0 +1,124 @@
+import logging
+import os
+from pathlib import Path
+
+from absl import flags
+import cv2
+from injector import Binder, Module, inject, singleton
+import numpy
+from prometheus_client import Counter
+
+from rep0st.db import MediaKind, PostType
+from rep0st.db.post import Post
+from rep0st.service.media_index_service import MediaIndexService, MediaIndexServiceModule
+from rep0st.service.media_service import ImageDecodeException, NoMediaFoundException, ReadMediaService, ReadMediaServiceModule, _MediaDirectory, derivative_file, is_packed, original_file
+
+log = logging.getLogger(__name__)
+FLAGS = flags.FLAGS
+
+media_derivative_service_created_z = Counter(
+    'rep0st_media_derivative_service_created',
+    'Number of media derivatives written by post type.', ['type'])
+media_derivative_service_errors_z = Counter(
+    'rep0st_media_derivative_service_errors',
+    'Number of media derivatives that could not be written by post type.',
+    ['type'])
+for post_type in PostType:
+  media_derivative_service_created_z.labels(type=post_type.value)
+  media_derivative_service_errors_z.labels(type=post_type.value)
+
+
+class MediaDerivativeServiceModule(Module):
+
+  def configure(self, binder: Binder):
+    binder.install(ReadMediaServiceModule)
+    binder.install(MediaIndexServiceModule)
+    binder.bind(MediaDerivativeService)
+
+
+@singleton
+class MediaDerivativeService:
+  """Writes small derivatives of media features are calculated from.
+
+  Images are scaled down to a bounded size. Videos and animated images get a
+  strip of square frames. Derivatives are lossless PNGs, so calculating
+  features from them does not need to decode the original media again.
+  """
+  media_dir: Path
+  read_media_service: ReadMediaService
+  media_index_service: MediaIndexService
+
+  @inject
+  def __init__(self, media_dir: _MediaDirectory,
+               read_media_service: ReadMediaService,
+               media_index_service: MediaIndexService):
+    self.media_dir = media_dir
+    self.read_media_service = read_media_service
+    self.media_index_service = media_index_service
+
+  def has_derivative(self, post: Post) -> bool:
+    return derivative_file(self.media_dir, post).is_file()
+
+  def _render(self, post: Post, data: bytes | None) -> numpy.ndarray:
+    images = self.read_media_service.get_images(
+        post, data=data, derivative=False)
+    if post.type == PostType.IMAGE:
+      image = next(iter(images))
+      height, width = image.shape[:2]
+      scale = FLAGS.rep0st_media_derivative_max_size / max(height, width)
+      if scale < 1:
+        image = cv2.resize(
+            image, (max(1, round(width * scale)), max(1, round(height * scale))),
+            interpolation=cv2.INTER_AREA)
+      return image
+    size = FLAGS.rep0st_media_derivative_frame_size
+    frames = [
+        cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA)
+        for image in images
+    ]
+    if not frames:
+      raise ImageDecodeException(f'No frames decoded for post {post.id}')
+    max_frames = FLAGS.rep0st_media_derivative_max_frames
+    if max_frames and len(frames) > max_frames:
+      frames = [
+          frames[k * len(frames) // max_frames] for k in range(max_frames)
+      ]
+    return numpy.vstack(frames)
+
+  def create(self, post: Post, data: bytes | None = None) -> bool:
+    """Writes the derivative of the media of the post.
+
+    Returns False if the media could not be read.
+    """
+    try:
+      image = self._render(post, data)
+    except (NoMediaFoundException, ImageDecodeException, NotImplementedError,
+            StopIteration):
+      log.exception(f'Could not create media derivative for post {post.id}')
+      media_derivative_service_errors_z.labels(type=post.type.value).inc()
+      return False
+    success, encoded = cv2.imencode('.png', image)
+    if not success:
+      log.error(f'Could not encode media derivative for post {post.id}')
+      media_derivative_service_errors_z.labels(type=post.type.value).inc()
+      return False
+    media_file = derivative_file(self.media_dir, post)
+    part_file = media_file.with_name(media_file.name + '.part')
+    media_file.parent.mkdir(parents=True, exist_ok=True)
+    part_file.write_bytes(encoded.tobytes())
+    os.replace(part_file, media_file)
+    media_derivative_service_created_z.labels(type=post.type.value).inc()
+    log.debug(f'Wrote media derivative for post {post.id}')
+    return True
+
+  def remove_original(self, post: Post, media_kind: MediaKind,
+                      path: str) -> None:
+    """Removes a single media file of the post once its derivative exists.
+
+    Packed media is kept, it is only removed by compacting the pack segments.
+    """
+    if is_packed(post):
+      return
+    media_file = original_file(self.media_dir, media_kind, path)
+    media_file.unlink(missing_ok=True)
+    self.media_index_service.remove(media_file)
@@ -0,0 +1,267 @@
+import fcntl
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+from typing import List, Set
+
+from absl import flags
+from injector import Binder, Module, inject, singleton
+from joblib import Parallel, delayed, parallel_backend
+import numpy
+from prometheus_client import Counter, Gauge
+
+from rep0st.framework.signal_handler import on_shutdown
+from rep0st.service.media_pack import hash_media_path
+from rep0st.service.media_service import _MediaDirectory, _MediaFlagModule
+
+log = logging.getLogger(__name__)
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+    'rep0st_media_index_file', '',
+    'File the media presence index is saved to. Defaults to '
+    '.media_index.npy in the media directory.')
+flags.DEFINE_bool(
+    'rep0st_media_index_rebuild', False,
+    'If True, the media presence index is rebuilt from the media directory '
+    'on startup instead of loaded from its file.')
+flags.DEFINE_integer('rep0st_media_index_scan_workers', 16,
+                     'Number of directories scanned concurrently.')
+flags.DEFINE_integer(
+    'rep0st_media_index_save_interval', 300,
+    'Seconds between saves of the media presence index. Media downloaded '
+    'after the last save is downloaded again after a crash.')
+
+media_index_service_entries_z = Gauge(
+    'rep0st_media_index_service_entries',
+    'Number of media files in the media presence index.')
+media_index_service_lookups_z = Counter(
+    'rep0st_media_index_service_lookups',
+    'Number of lookups in the media presence index by result.', ['result'])
+for result in ['hit', 'miss']:
+  media_index_service_lookups_z.labels(result=result)
+media_index_service_build_seconds_z = Gauge(
+    'rep0st_media_index_service_build_seconds',
+    'Seconds it took to build the media presence index from the media directory.'
+)
+
+# Number of recently added paths kept in a set before they are merged into
+# the sorted array.
+_MERGE_THRESHOLD = 10000
+# Depth of the directories scanned concurrently.
+_SCAN_SPLIT_DEPTH = 2
+
+
+def _scan_directory(root: Path, prefix: str) -> List[int]:
+  hashes = []
+  stack = [(os.fspath(root), prefix)]
+  while stack:
+    directory, directory_prefix = stack.pop()
+    with os.scandir(directory) as it:
+      for entry in it:
+        path = directory_prefix + entry.name
+        if entry.is_dir(follow_symlinks=False):
+          stack.append((entry.path, path + '/'))
+        elif not entry.name.endswith('.part'):
+          hashes.append(hash_media_path(path))
+  return hashes
+
+
+class MediaIndexServiceModule(Module):
+
+  def configure(self, binder: Binder):
+    binder.install(_MediaFlagModule)
+    binder.bind(MediaIndexService)
+
+
+@singleton
+class MediaIndexService:
+  """Set of the media files in the media directory.
+
+  Paths are stored as 64 bit hashes in a sorted array, so millions of files
+  only take a few megabytes and existence checks do not touch the (possibly
+  network mounted) media directory. The index is built once by scanning the
+  media directory, updated by the downloads and saved to a file. Processes
+  sharing the file merge their changes into it when saving.
+  """
+  media_dir: Path
+
+  @inject
+  def __init__(self, media_dir: _MediaDirectory):
+    self.media_dir = media_dir
+    self.index_file = Path(FLAGS.rep0st_media_index_file or
+                           media_dir / '.media_index.npy')
+    self._lock = threading.RLock()
+    self._hashes: numpy.ndarray = None
+    self._added: Set[int] = set()
+    self._removed: Set[int] = set()
+    # Changes not saved yet. Merged into the saved file, so changes saved by
+    # other processes are kept.
+    self._unsaved_added: Set[int] = set()
+    self._unsaved_removed: Set[int] = set()
+    # Set after a scan, the saved file is replaced instead of merged.
+    self._replace_on_save = False
+    self._dirty = False
+    self._last_save = time.monotonic()
+    media_index_service_entries_z.set_function(
+        lambda: 0 if self._hashes is None else len(self._hashes) + len(
+            self._added))
+
+  def _relative(self, media_file: Path) -> str:
+    return media_file.relative_to(self.media_dir).as_posix()
+
+  def _scan(self) -> numpy.ndarray:
+    log.info(f'Scanning media directory {self.media_dir.absolute()}')
+    start = time.time()
+    # Split the tree into subtrees that are scanned concurrently. Files above
+    # the split depth are collected right away.
+    hashes = []
+    subtrees = [(self.media_dir, '')]
+    for _ in range(_SCAN_SPLIT_DEPTH):
+      next_subtrees = []
+      for directory, prefix in subtrees:
+        with os.scandir(directory) as it:
+          for entry in it:
+            path = prefix + entry.name
+            if entry.is_dir(follow_symlinks=False):
+              next_subtrees.append((Path(entry.path), path + '/'))
+            elif not entry.name.endswith('.part'):
+              hashes.append(hash_media_path(path))
+      subtrees = next_subtrees
+    with parallel_backend('threading'), Parallel(
+        n_jobs=FLAGS.rep0st_media_index_scan_workers) as parallel:
+      for subtree_hashes in parallel(
+          delayed(_scan_directory)(directory, prefix)
+          for directory, prefix in subtrees):
+        hashes += subtree_hashes
+    index = numpy.unique(numpy.array(hashes, dtype=numpy.uint64))
+    time_taken = time.time() - start
+    media_index_service_build_seconds_z.set(time_taken)
+    log.info(
+        f'Scanned {len(index)} media files in {len(subtrees)} directories in {time_taken:.2f}s'
+    )
+    return index
+
+  def _ensure_loaded(self) -> None:
+    if self._hashes is not None:
+      return
+    with self._lock:
+      if self._hashes is not None:
+        return
+      if not FLAGS.rep0st_media_index_rebuild and self.index_file.is_file():
+        self._hashes = numpy.load(self.index_file)
+        log.info(
+            f'Loaded media presence index with {len(self._hashes)} files from {self.index_file.absolute()}'
+        )
+        return
+      self._hashes = self._scan()
+      self._replace_on_save = True
+      self._dirty = True
+    self.save()
+
+  def _merge(self) -> None:
+    hashes = self._hashes
+    if self._removed:
+      hashes = hashes[~numpy.isin(
+          hashes, numpy.fromiter(self._removed, dtype=numpy.uint64))]
+    if self._added:
+      hashes = numpy.union1d(
+          hashes, numpy.fromiter(self._added, dtype=numpy.uint64))
+    self._hashes = hashes
+    self._added = set()
+    self._removed = set()
+
+  def contains(self, media_file: Path) -> bool:
+    self._ensure_loaded()
+    h = hash_media_path(self._relative(media_file))
+    with self._lock:
+      if h in self._removed:
+        found = False
+      elif h in self._added:
+        found = True
+      else:
+        i = numpy.searchsorted(self._hashes, numpy.uint64(h))
+        found = bool(i < len(self._hashes) and self._hashes[i] == h)
+    media_index_service_lookups_z.labels(
+        result='hit' if found else 'miss').inc()
+    return found
+
+  def add(self, media_file: Path) -> None:
+    self._ensure_loaded()
+    h = hash_media_path(self._relative(media_file))
+    with self._lock:
+      self._removed.discard(h)
+      self._added.add(h)
+      self._unsaved_removed.discard(h)
+      self._unsaved_added.add(h)
+      self._dirty = True
+      if len(self._added) >= _MERGE_THRESHOLD:
+        self._merge()
+      save = time.monotonic(
+      ) - self._last_save >= FLAGS.rep0st_media_index_save_interval
+    if save:
+      self.save()
+
+  def remove(self, media_file: Path) -> None:
+    self._ensure_loaded()
+    h = hash_media_path(self._relative(media_file))
+    with self._lock:
+      self._added.discard(h)
+      self._removed.add(h)
+      self._unsaved_added.discard(h)
+      self._unsaved_removed.add(h)
+      self._dirty = True
+
+  def _write(self, hashes: numpy.ndarray, added: Set[int], removed: Set[int],
+             replace: bool) -> None:
+    lock_file = self.index_file.with_name(self.index_file.name + '.lock')
+    with lock_file.open('a') as lock:
+      # Other processes save to the same file. Merge the changes into the
+      # saved index under the lock, so no process overwrites the changes of
+      # another.
+      fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+      if not replace and self.index_file.is_file():
+        hashes = numpy.load(self.index_file)
+        if removed:
+          hashes = hashes[~numpy.isin(
+              hashes, numpy.fromiter(removed, dtype=numpy.uint64))]
+        if added:
+          hashes = numpy.union1d(hashes,
+                                 numpy.fromiter(added, dtype=numpy.uint64))
+      tmp_file = self.index_file.with_name(self.index_file.name + '.part')
+      with tmp_file.open('wb') as f:
+        numpy.save(f, hashes)
+      os.replace(tmp_file, self.index_file)
+
+  def save(self) -> None:
+    with self._lock:
+      self._last_save = time.monotonic()
+      if self._hashes is None or not self._dirty:
+        return
+      self._merge()
+      # The arrays are replaced and never changed in place, so the snapshot
+      # can be written without holding the lock.
+      hashes = self._hashes
+      added, removed = self._unsaved_added, self._unsaved_removed
+      replace = self._replace_on_save
+      self._unsaved_added, self._unsaved_removed = set(), set()
+      self._replace_on_save = False
+      self._dirty = False
+    try:
+      self._write(hashes, added, removed, replace)
+    except (IOError, OSError):
+      log.exception(
+          f'Could not save media presence index to {self.index_file.absolute()}'
+      )
+      with self._lock:
+        # Keep the changes for the next save. Changes made since win.
+        self._unsaved_added |= added - self._unsaved_removed
+        self._unsaved_removed |= removed - self._unsaved_added
+        self._replace_on_save = self._replace_on_save or replace
+        self._dirty = True
+
+  @on_shutdown()
+  def handle_shutdown(self):
+    log.info('Saving media presence index')
+    self.save()
@@ -0,0 +1,317 @@
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+from pathlib import Path
+import threading
+import time
+from typing import BinaryIO, Collection, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy
+
+log = logging.getLogger(__name__)
+
+# Record in the index file of a segment.
+_RECORD = numpy.dtype([('hash', '<u8'), ('offset', '<u8'), ('length', '<u4')])
+# Record in the in-memory index of all segments.
+_INDEX = numpy.dtype([('hash', '<u8'), ('segment', '<u4'), ('offset', '<u8'),
+                      ('length', '<u4')])
+
+
+def hash_media_path(path: str) -> int:
+  """Hashes a media path relative to the media directory to 64 bit."""
+  return int.from_bytes(
+      hashlib.blake2b(path.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class CompactionResult(NamedTuple):
+  segments: int
+  records_kept: int
+  records_dropped: int
+  bytes_dropped: int
+
+
+class _SegmentWriter:
+  segment: int
+  pack: BinaryIO
+  index: BinaryIO
+  size: int
+
+  def __init__(self, segment: int, pack: BinaryIO, index: BinaryIO):
+    self.segment = segment
+    self.pack = pack
+    self.index = index
+    self.size = 0
+
+  def close(self):
+    self.index.close()
+    self.pack.close()
+
+
+class MediaPack:
+  """Media files appended to large segment files.
+
+  Every segment consists of a .pack file with the concatenated media and a
+  .idx file with one fixed size record (path hash, offset, length) per media
+  file. Both are append only. A segment is written by a single writer, which
+  holds a lock on the .pack file. Readers keep a sorted index of all records
+  in memory and read the media through mmap without copying it.
+  """
+  pack_dir: Path
+  segment_size: int
+  refresh_interval: float
+
+  def __init__(self,
+               pack_dir: Path,
+               segment_size: int = 1024 * 1024 * 1024,
+               refresh_interval: float = 10.0):
+    self.pack_dir = pack_dir
+    self.segment_size = segment_size
+    self.refresh_interval = refresh_interval
+    self._lock = threading.RLock()
+    self._write_lock = threading.Lock()
+    self._index = numpy.empty(0, dtype=_INDEX)
+    self._loaded: Dict[int, int] = {}
+    self._recent: Dict[int, Tuple[int, int, int]] = {}
+    self._maps: Dict[int, mmap.mmap] = {}
+    self._last_refresh = 0.0
+    self._writer: Optional[_SegmentWriter] = None
+
+  def _file(self, segment: int, suffix: str) -> Path:
+    return self.pack_dir / f'segment-{segment:06d}.{suffix}'
+
+  def _segments(self) -> List[int]:
+    if not self.pack_dir.is_dir():
+      return []
+    return sorted(
+        int(f.name[len('segment-'):-len('.idx')])
+        for f in self.pack_dir.glob('segment-*.idx'))
+
+  def refresh(self, force: bool = False) -> None:
+    """Loads records appended to the segments since the last refresh."""
+    with self._lock:
+      now = time.monotonic()
+      if not force and now - self._last_refresh < self.refresh_interval:
+        return
+      self._last_refresh = now
+      segments = self._segments()
+      if not set(self._loaded).issubset(segments):
+        # Segments were removed by a compaction, start over.
+        self._index = numpy.empty(0, dtype=_INDEX)
+        self._loaded = {}
+        self._maps = {}
+      parts = [self._index]
+      for segment in segments:
+        index_file = self._file(segment, 'idx')
+        try:
+          size = index_file.stat().st_size
+        except FileNotFoundError:
+          continue
+        # Ignore a partially written last record.
+        size -= size % _RECORD.itemsize
+        loaded = self._loaded.get(segment, 0)
+        if size <= loaded:
+          continue
+        with index_file.open('rb') as f:
+          f.seek(loaded)
+          records = numpy.frombuffer(f.read(size - loaded), dtype=_RECORD)
+        part = numpy.empty(len(records), dtype=_INDEX)
+        part['hash'] = records['hash']
+        part['segment'] = segment
+        part['offset'] = records['offset']
+        part['length'] = records['length']
+        parts.append(part)
+        self._loaded[segment] = size
+      if len(parts) > 1:
+        index = numpy.concatenate(parts)
+        # Stable, so the latest record of a path comes last.
+        self._index = index[numpy.argsort(index['hash'], kind='stable')]
+      self._recent = {}
+
+  def _find(self, h: int) -> Optional[Tuple[int, int, int]]:
+    with self._lock:
+      if h in self._recent:
+        return self._recent[h]
+      hashes = self._index['hash']
+      i = numpy.searchsorted(hashes, numpy.uint64(h), side='right') - 1
+      if i < 0 or hashes[i] != h:
+        return None
+      record = self._index[i]
+      return int(record['segment']), int(record['offset']), int(
+          record['length'])
+
+  def _lookup(self, path: str) -> Optional[Tuple[int, int, int]]:
+    h = hash_media_path(path)
+    record = self._find(h)
+    if record is None:
+      # Another process might have added it.
+      self.refresh()
+      record = self._find(h)
+    return record
+
+  def contains(self, path: str) -> bool:
+    return self._lookup(path) is not None
+
+  def _map(self, segment: int, end: int) -> mmap.mmap:
+    with self._lock:
+      m = self._maps.get(segment)
+      if m is None or len(m) < end:
+        # The segment grew since it was mapped. The old mapping is released
+        # once no buffer refers to it anymore.
+        with self._file(segment, 'pack').open('rb') as f:
+          m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[segment] = m
+      return m
+
+  def _view(self, record: Tuple[int, int, int]) -> memoryview:
+    segment, offset, length = record
+    return memoryview(self._map(segment, offset + length))[offset:offset +
+                                                           length]
+
+  def read(self, path: str) -> Optional[memoryview]:
+    """Returns the media at path without copying it, None if not packed."""
+    record = self._lookup(path)
+    if record is None:
+      return None
+    try:
+      return self._view(record)
+    except FileNotFoundError:
+      # The segment was removed by a compaction since the index was loaded.
+      # The media was moved to another segment before.
+      self.refresh(force=True)
+      record = self._find(hash_media_path(path))
+      if record is None:
+        return None
+      return self._view(record)
+
+  def _open_writer(self) -> _SegmentWriter:
+    self.pack_dir.mkdir(parents=True, exist_ok=True)
+    segment = max(self._segments(), default=0) + 1
+    while True:
+      try:
+        # Exclusive create, so concurrent writers never share a segment.
+        pack = self._file(segment, 'pack').open('xb')
+        break
+      except FileExistsError:
+        segment += 1
+    fcntl.flock(pack.fileno(), fcntl.LOCK_EX)
+    index = self._file(segment, 'idx').open('ab')
+    log.info(f'Writing to media pack segment {segment}')
+    return _SegmentWriter(segment, pack, index)
+
+  def _append(self, h: int, data) -> None:
+    with self._write_lock:
+      writer = self._writer
+      if writer is None or (writer.size and
+                            writer.size + len(data) > self.segment_size):
+        if writer is not None:
+          writer.close()
+        writer = self._writer = self._open_writer()
+      offset = writer.size
+      writer.pack.write(data)
+      writer.pack.flush()
+      os.fsync(writer.pack.fileno())
+      # The record is written after the data, so readers never see a record
+      # pointing to missing data.
+      record = numpy.array([(h, offset, len(data))], dtype=_RECORD)
+      writer.index.write(record.tobytes())
+      writer.index.flush()
+      os.fsync(writer.index.fileno())
+      writer.size += len(data)
+      with self._lock:
+        self._recent[h] = (writer.segment, offset, len(data))
+
+  def append(self, path: str, data) -> None:
+    """Appends the media for path. A later append of a path replaces it."""
+    self._append(hash_media_path(path), data)
+
+  def closed_segments(self) -> List[int]:
+    """Returns the segments no writer appends to anymore.
+
+    Writers never reopen a segment, so no media is added to them later.
+    """
+    current = self._writer.segment if self._writer else None
+    segments = []
+    for segment in self._segments():
+      if segment == current:
+        continue
+      try:
+        with self._file(segment, 'pack').open('rb') as pack:
+          fcntl.flock(pack.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except (FileNotFoundError, BlockingIOError):
+        continue
+      segments.append(segment)
+    return segments
+
+  def compact(self, live_hashes: numpy.ndarray, min_dead_ratio: float,
+              segments: Collection[int]) -> CompactionResult:
+    """Rewrites segments with media no longer in live_hashes or replaced.
+
+    Only the given segments with at least min_dead_ratio of their bytes dead
+    are rewritten. They have to be taken from closed_segments() before
+    live_hashes, otherwise media added after live_hashes was taken is
+    dropped. The live media is appended to a new segment, then the old
+    segment is removed. Segments locked by a writer are skipped.
+    """
+    live_hashes = numpy.sort(numpy.asarray(live_hashes, dtype=numpy.uint64))
+    result = CompactionResult(0, 0, 0, 0)
+    current = self._writer.segment if self._writer else None
+    for segment in sorted(segments):
+      if segment == current:
+        continue
+      pack_file = self._file(segment, 'pack')
+      try:
+        pack = pack_file.open('rb')
+      except FileNotFoundError:
+        continue
+      with pack:
+        try:
+          fcntl.flock(pack.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+          log.info(f'Segment {segment} is written to, skipping')
+          continue
+        # The index has to know the latest records to tell the current
+        # records apart.
+        self.refresh(force=True)
+        index_file = self._file(segment, 'idx')
+        data = index_file.read_bytes()
+        records = numpy.frombuffer(
+            data[:len(data) - len(data) % _RECORD.itemsize], dtype=_RECORD)
+        live = numpy.isin(records['hash'], live_hashes)
+        # Media appended again, e.g. after it was broken, leaves older
+        # records behind. Only the record the index points to is live.
+        for i in numpy.flatnonzero(live):
+          record = records[i]
+          if self._find(int(record['hash'])) != (segment, int(
+              record['offset']), int(record['length'])):
+            live[i] = False
+        total_bytes = int(records['length'].sum())
+        dead_bytes = int(records['length'][~live].sum())
+        if not total_bytes or dead_bytes / total_bytes < min_dead_ratio:
+          continue
+        log.info(
+            f'Compacting segment {segment}: dropping {dead_bytes} of {total_bytes} bytes'
+        )
+        if total_bytes:
+          m = mmap.mmap(pack.fileno(), 0, access=mmap.ACCESS_READ)
+          try:
+            for record in records[live]:
+              offset, length = int(record['offset']), int(record['length'])
+              self._append(int(record['hash']), m[offset:offset + length])
+          finally:
+            m.close()
+        index_file.unlink()
+        pack_file.unlink()
+        result = CompactionResult(
+            result.segments + 1, result.records_kept + int(live.sum()),
+            result.records_dropped + int((~live).sum()),
+            result.bytes_dropped + dead_bytes)
+    self.refresh(force=True)
+    return result
+
+  def close(self) -> None:
+    with self._write_lock:
+      if self._writer is not None:
+        self._writer.close()
+        self._writer = None
@@ -0,0 +1,80 @@
+import logging
+
+from absl import flags
+from injector import Binder, Module, inject, singleton
+from prometheus_client import Counter
+
+from rep0st.db.download_queue import PRIORITY_REPAIR, DownloadQueueRepository, DownloadQueueRepositoryModule
+from rep0st.db.post import PostRepository, PostRepositoryModule
+from rep0st.framework.data.transaction import transactional
+
+log = logging.getLogger(__name__)
+FLAGS = flags.FLAGS
+flags.DEFINE_integer(
+    'rep0st_media_retry_delay', 3600,
+    'Seconds before the media of a post with NO_MEDIA_FOUND or MEDIA_BROKEN is '
+    'retried. Doubles with every retry.')
+flags.DEFINE_integer('rep0st_media_retry_max_delay', 30 * 24 * 3600,
+                     'Maximum number of seconds between two media retries.')
+flags.DEFINE_integer(
+    'rep0st_media_retry_max_retries', 10,
+    'Number of media retries before a post is marked MEDIA_UNAVAILABLE and not '
+    'retried anymore.')
+flags.DEFINE_integer('rep0st_media_retry_batch_size', 1000,
+                     'Number of posts retried in one transaction.')
+
+media_retry_service_posts_z = Counter(
+    'rep0st_media_retry_service_posts',
+    'Number of posts handled by the media retry job by action.', ['action'])
+for action in ['scheduled', 'retried', 'given_up']:
+  media_retry_service_posts_z.labels(action=action)
+
+
+class MediaRetryServiceModule(Module):
+
+  def configure(self, binder: Binder):
+    binder.install(PostRepositoryModule)
+    binder.install(DownloadQueueRepositoryModule)
+    binder.bind(MediaRetryService)
+
+
+@singleton
+class MediaRetryService:
+  post_repository: PostRepository = None
+  download_queue_repository: DownloadQueueRepository = None
+
+  @inject
+  def __init__(self, post_repository: PostRepository,
+               download_queue_repository: DownloadQueueRepository):
+    self.post_repository = post_repository
+    self.download_queue_repository = download_queue_repository
+
+  @transactional()
+  def _retry_batch(self) -> int:
+    post_ids = self.post_repository.claim_media_retries(
+        FLAGS.rep0st_media_retry_batch_size, FLAGS.rep0st_media_retry_delay,
+        FLAGS.rep0st_media_retry_max_delay)
+    if post_ids:
+      self.download_queue_repository.enqueue_posts(
+          self.post_repository.get_by_ids(post_ids).all(), PRIORITY_REPAIR)
+    return len(post_ids)
+
+  def retry_media(self):
+    log.info('Starting media retry')
+    # Posts that got an error since the last run.
+    scheduled = self.post_repository.schedule_media_retries(
+        FLAGS.rep0st_media_retry_delay, FLAGS.rep0st_media_retry_max_delay)
+    media_retry_service_posts_z.labels(action='scheduled').inc(scheduled)
+    given_up = self.post_repository.give_up_media_retries(
+        FLAGS.rep0st_media_retry_max_retries)
+    media_retry_service_posts_z.labels(action='given_up').inc(given_up)
+    retried = 0
+    while True:
+      count = self._retry_batch()
+      if count == 0:
+        break
+      media_retry_service_posts_z.labels(action='retried').inc(count)
+      retried += count
+    log.info(
+        f'Finished media retry. {scheduled} posts scheduled, {retried} posts retried, '
+        f'{given_up} posts marked MEDIA_UNAVAILABLE')
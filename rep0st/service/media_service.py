@@ -1,21 +1,123 @@
+import enum
+import importlib.util
 import logging
+import os
 from pathlib import Path
-from typing import BinaryIO, Callable, Dict, Iterable, NewType, Union, IO
+import threading
+import time
+from typing import Any, BinaryIO, Callable, Dict, Iterable, List, NewType, Optional, Union, IO
 import numpy
 from absl import flags
 from cv2 import IMREAD_COLOR, imdecode, cvtColor, COLOR_RGB2BGR
-from injector import Binder, Module, inject, singleton
+from injector import Binder, Module, inject, provider, singleton
 import ffmpeg
+from prometheus_client import Counter
 import subprocess
+import tempfile
 
-from rep0st.db import PostType
-from rep0st.db.post import Post
+from rep0st.db import MediaKind, PostType
+from rep0st.db.post import Post, main_media_kind
+from rep0st.service.media_pack import MediaPack
 
 log = logging.getLogger(__name__)
 FLAGS = flags.FLAGS
 flags.DEFINE_string('rep0st_media_path', '',
                     'Path to media directory used by rep0st to save media.')
 _MediaDirectory = NewType('_MediaDirectory', Path)
+flags.DEFINE_bool(
+    'rep0st_media_pack', False,
+    'If True, downloaded images are appended to segment files under packs/ in '
+    'the media directory instead of stored as single files. Images are read '
+    'from the segments and from single files regardless of this flag.')
+flags.DEFINE_integer('rep0st_media_pack_segment_size', 1024 * 1024 * 1024,
+                     'Size in bytes after which a new pack segment is started.')
+flags.DEFINE_float(
+    'rep0st_media_pack_refresh_interval', 10.0,
+    'Minimum seconds between reloads of the pack index when media is not '
+    'found in it.')
+
+
+class VideoDecoder(enum.Enum):
+  # Decode videos by piping them through an ffmpeg subprocess.
+  FFMPEG = 'FFMPEG'
+  # Decode videos in-process using libav through PyAV.
+  PYAV = 'PYAV'
+
+
+flags.DEFINE_bool(
+    'rep0st_media_derivatives', False,
+    'If True, a small derivative of the media is written under derived/ in the '
+    'media directory when it is downloaded and features are calculated from it '
+    'instead of the original.')
+flags.DEFINE_integer(
+    'rep0st_media_derivative_max_size', 256,
+    'Maximum width and height of image derivatives in pixels.')
+flags.DEFINE_integer(
+    'rep0st_media_derivative_frame_size', 96,
+    'Width and height of the frames in the frame strip derivatives of videos '
+    'and animated images in pixels.')
+flags.DEFINE_integer(
+    'rep0st_media_derivative_max_frames', 60,
+    'Maximum number of frames in the frame strip derivatives. Longer media is '
+    'sampled evenly.')
+flags.DEFINE_bool(
+    'rep0st_media_keep_originals', True,
+    'If False, media files are removed once their derivative was written. '
+    'Only has an effect with --rep0st_media_derivatives.')
+
+
+class ReadOrder(enum.Enum):
+  # Read media in the order of the post ids.
+  ID = 'ID'
+  # Read media in the order of their paths, which groups files of the same
+  # directory.
+  PATH = 'PATH'
+  # Read media in the order of their inode numbers, which roughly follows
+  # their location on disk for most file systems.
+  INODE = 'INODE'
+
+
+flags.DEFINE_enum_class(
+    'rep0st_media_read_order', ReadOrder.ID, ReadOrder,
+    'Order media of a batch is read in when calculating features. PATH or INODE '
+    'reduce seeks on media directories on spinning disks.')
+flags.DEFINE_integer(
+    'rep0st_media_readahead', 32,
+    'Number of posts whose media is requested from disk ahead of decoding when '
+    'calculating features. 0 disables the readahead.')
+flags.DEFINE_enum_class(
+    'rep0st_video_decoder', VideoDecoder.FFMPEG, VideoDecoder,
+    'Backend used to decode videos. PYAV requires the optional `av` package.')
+flags.DEFINE_float(
+    'rep0st_animated_fps', 2.0,
+    'Frame rate animated images (gif) are sampled with before analyzing them.')
+flags.DEFINE_integer(
+    'rep0st_animated_max_frames', 60,
+    'Maximum number of frames decoded from a single animated image (gif).')
+
+read_media_service_read_bytes_z = Counter(
+    'rep0st_read_media_service_read_bytes',
+    'Number of bytes of media files read by post type.', ['type'])
+read_media_service_io_wait_seconds_z = Counter(
+    'rep0st_read_media_service_io_wait_seconds',
+    'Seconds spent waiting for media files to be read from disk by post type.',
+    ['type'])
+for post_type in PostType:
+  read_media_service_read_bytes_z.labels(type=post_type.value)
+  read_media_service_io_wait_seconds_z.labels(type=post_type.value)
+
+# Read buffers larger than this are not kept for the next read.
+_MAX_POOLED_BUFFER_SIZE = 64 * 1024 * 1024
+
+
+def media_type_from_buffer(data: bytes) -> PostType:
+  """Guesses the type of the media in the buffer from its magic bytes."""
+  if data[:6] in (b'GIF87a', b'GIF89a'):
+    return PostType.ANIMATED
+  # MP4 starts with an ftyp box, WebM (Matroska) with an EBML header.
+  if data[4:8] == b'ftyp' or data[:4] == b'\x1a\x45\xdf\xa3':
+    return PostType.VIDEO
+  return PostType.IMAGE
 
 
 def _readline(stream: IO[bytes]) -> Union[None, str]:
@@ -39,6 +141,61 @@ class _MediaFlagModule(Module):
     binder.bind(_MediaDirectory, to=media_path)
 
 
+class _MediaPackModule(Module):
+
+  def configure(self, binder: Binder) -> None:
+    binder.install(_MediaFlagModule)
+
+  @inject
+  @provider
+  @singleton
+  def provide_media_pack(self, media_dir: _MediaDirectory) -> MediaPack:
+    return MediaPack(media_dir / 'packs', FLAGS.rep0st_media_pack_segment_size,
+                     FLAGS.rep0st_media_pack_refresh_interval)
+
+
+def original_file(media_dir: Path, media_kind: MediaKind, path: str) -> Path:
+  """Returns the file media of the kind is saved to."""
+  if media_kind == MediaKind.FULLSIZE:
+    return media_dir / 'full' / path
+  return media_dir / path
+
+
+def blob_file(media_dir: Path, sha256: str) -> Path:
+  """Returns the file media with the content hash is stored to as blob."""
+  # Shard the blobs, so directories stay small.
+  return media_dir / 'blobs' / sha256[:2] / sha256[2:4] / sha256
+
+
+def derivative_file(media_dir: Path, post: Post) -> Path:
+  """Returns the file the derivative of the media of the post is saved to."""
+  return media_dir / 'derived' / f'{post.image}.png'
+
+
+def derivative_source_kind(post: Post) -> Optional[MediaKind]:
+  """Returns the kind of the media the derivative of the post is made from."""
+  return MediaKind.FULLSIZE if post.fullsize else main_media_kind(post)
+
+
+def is_packed(post: Post) -> bool:
+  """Returns True if downloaded media of the post is stored in pack segments.
+
+  Only decides where media is written. Use packed_paths() to read it.
+  """
+  return FLAGS.rep0st_media_pack and post.type == PostType.IMAGE
+
+
+def packed_paths(post: Post) -> List[str]:
+  """Returns the paths the media of the post might be packed under.
+
+  Only images are packed. Videos and animated images are decoded by ffmpeg,
+  which needs them as files.
+  """
+  if post.type != PostType.IMAGE:
+    return []
+  return ([f'full/{post.fullsize}'] if post.fullsize else []) + [post.image]
+
+
 class DecodeMediaServiceModule(Module):
 
   def configure(self, binder: Binder):
@@ -48,6 +205,32 @@ class DecodeMediaServiceModule(Module):
 @singleton
 class DecodeMediaService:
 
+  def __init__(self):
+    # Read buffers are reused per thread, so reading an image does not
+    # allocate a new buffer every time.
+    self._buffers = threading.local()
+
+  def _read_file(self, file: BinaryIO) -> memoryview:
+    size = os.fstat(file.fileno()).st_size
+    buffer = getattr(self._buffers, 'buffer', None)
+    if buffer is None or len(buffer) < size:
+      buffer = bytearray(max(size, 2 * len(buffer or b'')))
+      if len(buffer) <= _MAX_POOLED_BUFFER_SIZE:
+        self._buffers.buffer = buffer
+    view = memoryview(buffer)
+    start = time.time()
+    read = 0
+    # Reads can return less than requested on network file systems.
+    while read < size:
+      n = file.readinto(view[read:size])
+      if not n:
+        break
+      read += n
+    read_media_service_io_wait_seconds_z.labels(
+        type=PostType.IMAGE.value).inc(time.time() - start)
+    read_media_service_read_bytes_z.labels(type=PostType.IMAGE.value).inc(read)
+    return view[:read]
+
   def _decode_image(self, data: numpy.ndarray) -> numpy.ndarray:
     try:
       img = imdecode(data, IMREAD_COLOR)
@@ -64,14 +247,75 @@ class DecodeMediaService:
       raise NoMediaFoundException('Could not data from buffer') from e
     yield self._decode_image(data)
 
+  def _decode_from_buffer(
+      self, data: bytes, decode_fn: Callable[[BinaryIO], Iterable[numpy.ndarray]]
+  ) -> Iterable[numpy.ndarray]:
+    # ffmpeg reads from stdin, which needs a real file descriptor. Writing to
+    # a pipe while reading the frames would deadlock on large inputs.
+    with tempfile.TemporaryFile() as f:
+      f.write(data)
+      f.seek(0)
+      yield from decode_fn(f)
+
+  def decode_video_from_buffer(self, data: bytes) -> Iterable[numpy.ndarray]:
+    return self._decode_from_buffer(data, self.decode_video_from_file)
+
+  def decode_animated_from_buffer(self,
+                                  data: bytes) -> Iterable[numpy.ndarray]:
+    return self._decode_from_buffer(data, self.decode_animated_from_file)
+
   def decode_image_from_file(self, file: BinaryIO) -> Iterable[numpy.ndarray]:
     try:
-      data = numpy.fromfile(file, dtype=numpy.uint8)
+      # A view on the read buffer, imdecode reads it without another copy.
+      data = numpy.frombuffer(self._read_file(file), dtype=numpy.uint8)
     except (IOError, OSError) as e:
       raise NoMediaFoundException(
           f'Could not read data from file {file}') from e
     yield self._decode_image(data)
 
+  def _decode_frames_with_ffmpeg(self, file: BinaryIO,
+                                 cmd: ffmpeg.nodes.OutputStream
+                                ) -> Iterable[numpy.ndarray]:
+    proc = subprocess.Popen(
+        cmd.compile(),
+        stdin=file,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+
+    try:
+      while True:
+        format = _readline(proc.stdout)
+        if not format:
+          break
+        if format != 'P6':
+          raise ImageDecodeException(
+              'frames returned by ffmpeg cannot be decoded due to an unsupported format'
+          )
+        width, height = [int(x) for x in _readline(proc.stdout).split(' ')]
+        max_value = int(_readline(proc.stdout))
+        if max_value != 255:
+          raise ImageDecodeException(
+              f'max_value has to be 255, it is {max_value}')
+
+        in_bytes = proc.stdout.read(width * height * 3)
+        if not in_bytes:
+          raise ImageDecodeException('could not read the full frame')
+        in_frame = numpy.frombuffer(in_bytes,
+                                    numpy.uint8).reshape([height, width, 3])
+        in_frame = cvtColor(in_frame, COLOR_RGB2BGR)
+        yield in_frame
+
+      retcode = proc.wait(timeout=1)
+
+      if retcode != 0:
+        err = proc.stderr.read().decode('utf-8')
+        raise ImageDecodeException(err)
+    finally:
+      if proc.poll() is None:
+        # The caller stopped reading frames early.
+        proc.kill()
+        proc.wait()
+
   def decode_video_from_file(self, file: BinaryIO) -> Iterable[numpy.ndarray]:
     cmd = ffmpeg.input(
         'pipe:',
@@ -81,46 +325,55 @@ class DecodeMediaService:
         threads=1,
         loglevel='error').output(
             'pipe:', vcodec='ppm', format='rawvideo')
-    proc = subprocess.Popen(
-        cmd.compile(),
-        stdin=file,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
+    return self._decode_frames_with_ffmpeg(file, cmd)
 
-    while True:
-      format = _readline(proc.stdout)
-      if not format:
-        break
-      if format != 'P6':
-        raise ImageDecodeException(
-            'frames returned by ffmpeg cannot be decoded due to an unsupported format'
-        )
-      width, height = [int(x) for x in _readline(proc.stdout).split(' ')]
-      max_value = int(_readline(proc.stdout))
-      if max_value != 255:
-        raise ImageDecodeException(
-            f'max_value has to be 255, it is {max_value}')
-
-      in_bytes = proc.stdout.read(width * height * 3)
-      if not in_bytes:
-        raise ImageDecodeException('could not read the full frame')
-      in_frame = numpy.frombuffer(in_bytes,
-                                  numpy.uint8).reshape([height, width, 3])
-      in_frame = cvtColor(in_frame, COLOR_RGB2BGR)
-      yield in_frame
-
-    retcode = proc.wait(timeout=1)
+  def decode_animated_from_file(self,
+                                file: BinaryIO) -> Iterable[numpy.ndarray]:
+    # GIFs have no keyframes. Resample to a fixed frame rate instead and stop
+    # after a fixed number of frames to bound the cost of long animations.
+    cmd = ffmpeg.input(
+        'pipe:', hide_banner=None, threads=1, loglevel='error').filter(
+            'fps', fps=FLAGS.rep0st_animated_fps).output(
+                'pipe:',
+                vcodec='ppm',
+                format='rawvideo',
+                vframes=FLAGS.rep0st_animated_max_frames)
+    return self._decode_frames_with_ffmpeg(file, cmd)
+
+  def decode_video_from_file_pyav(self,
+                                  file: BinaryIO) -> Iterable[numpy.ndarray]:
+    try:
+      import av
+    except ImportError as e:
+      raise ImportError(
+          'Decoding videos with PYAV requires the `av` package') from e
 
-    if retcode != 0:
-      err = proc.stderr.read().decode('utf-8')
-      raise ImageDecodeException(err)
+    try:
+      with av.open(file, mode='r') as container:
+        stream = container.streams.video[0]
+        # Same as `skip_frame=nokey` for the ffmpeg subprocess: the decoder
+        # only emits keyframes and skips decoding of all other frames.
+        stream.codec_context.skip_frame = 'NONKEY'
+        stream.thread_count = 1
+        for frame in container.decode(stream):
+          # Convert straight into BGR, no extra copy through cvtColor needed.
+          yield frame.to_ndarray(format='bgr24')
+    except (av.FFmpegError, IndexError) as e:
+      raise ImageDecodeException(f'Could not decode video: {e}') from e
 
 
 class ReadMediaServiceModule(Module):
 
   def configure(self, binder: Binder):
+    if FLAGS.rep0st_video_decoder == VideoDecoder.PYAV:
+      # Fail on startup instead of on the first video.
+      if importlib.util.find_spec('av') is None:
+        raise ImportError(
+            'rep0st_video_decoder=PYAV requires the `av` package. Install it '
+            'or use rep0st_video_decoder=FFMPEG.')
     binder.install(DecodeMediaServiceModule)
     binder.install(_MediaFlagModule)
+    binder.install(_MediaPackModule)
     binder.bind(ReadMediaService)
 
 
@@ -136,37 +389,143 @@ class ImageDecodeException(Exception):
 class ReadMediaService:
   media_dir: Path
   decode_media_service: DecodeMediaService
+  media_pack: MediaPack
   decoders: Dict[PostType, Callable[[Iterable[numpy.ndarray]], BinaryIO]]
 
   @inject
   def __init__(self, media_dir: _MediaDirectory,
-               decode_media_service: DecodeMediaService):
+               decode_media_service: DecodeMediaService,
+               media_pack: MediaPack):
     self.media_dir = media_dir
     self.decode_media_service = decode_media_service
+    self.media_pack = media_pack
     self.decoders = {
         PostType.IMAGE: self.decode_media_service.decode_image_from_file,
         PostType.VIDEO: self.decode_media_service.decode_video_from_file,
+        PostType.ANIMATED: self.decode_media_service.decode_animated_from_file,
     }
+    if FLAGS.rep0st_video_decoder == VideoDecoder.PYAV:
+      self.decoders[
+          PostType.VIDEO] = self.decode_media_service.decode_video_from_file_pyav
+
+  def _decode_derivative(self, post: Post,
+                         data: bytes) -> Iterable[numpy.ndarray]:
+    image = next(self.decode_media_service.decode_image_from_buffer(data))
+    if post.type == PostType.IMAGE:
+      yield image
+      return
+    # Frames are square and stacked on top of each other.
+    size = image.shape[1]
+    for i in range(image.shape[0] // size):
+      yield image[i * size:(i + 1) * size]
+
+  def _media_files(self, post: Post) -> List[Path]:
+    # Files get_images reads from, in the order it tries them.
+    media_files = []
+    if FLAGS.rep0st_media_derivatives:
+      media_files.append(derivative_file(self.media_dir, post))
+    if any(self.media_pack.contains(path) for path in packed_paths(post)):
+      return media_files
+    if post.fullsize:
+      media_files.append(self.media_dir / 'full' / post.fullsize)
+    media_files.append(self.media_dir / post.image)
+    return media_files
+
+  def prefetch(self, post: Post) -> None:
+    """Asks the kernel to read the media of the post into the page cache.
+
+    Returns right away, the media is read in the background.
+    """
+    for media_file in self._media_files(post):
+      try:
+        fd = os.open(media_file, os.O_RDONLY)
+      except OSError:
+        continue
+      try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+      except OSError:
+        log.debug(f'Could not prefetch {media_file.absolute()}')
+      finally:
+        os.close(fd)
+      return
+
+  def read_order_key(self, post: Post) -> Any:
+    """Returns the key posts are sorted by to read their media in order."""
+    order = FLAGS.rep0st_media_read_order
+    if order == ReadOrder.PATH:
+      return post.image
+    if order == ReadOrder.INODE:
+      for media_file in self._media_files(post):
+        try:
+          return media_file.stat().st_ino
+        except OSError:
+          pass
+      return 0
+    return post.id
+
+  def get_images(self,
+                 post: Post,
+                 data: bytes | None = None,
+                 derivative: bool = True) -> Iterable[numpy.ndarray]:
+    """Returns the images features are calculated from.
+
+    The derivative of the media is preferred if derivative is set, otherwise
+    the original media is decoded.
+    """
+    if data is not None and post.type == PostType.IMAGE:
+      # The media was just downloaded, no need to read it from disk again.
+      yield from self.decode_media_service.decode_image_from_buffer(data)
+      return
 
-  def get_images(self, post: Post) -> Iterable[numpy.ndarray]:
-    media_file = self.media_dir / post.image
+    if post.type not in self.decoders:
+      raise NotImplementedError(
+          f'Decoder needed for {post} for type {post.type} is not implemented')
+
+    if FLAGS.rep0st_media_derivatives and derivative:
+      start = time.time()
+      try:
+        derived = derivative_file(self.media_dir, post).read_bytes()
+      except (IOError, OSError):
+        derived = None
+      if derived is not None:
+        read_media_service_io_wait_seconds_z.labels(
+            type=post.type.value).inc(time.time() - start)
+        read_media_service_read_bytes_z.labels(type=post.type.value).inc(
+            len(derived))
+        yield from self._decode_derivative(post, derived)
+        return
+
+    for path in packed_paths(post):
+      # The view points into the mapped segment, imdecode reads it without a
+      # copy.
+      data = self.media_pack.read(path)
+      if data is not None:
+        yield from self.decode_media_service.decode_image_from_buffer(data)
+        return
 
+    media_file = self.media_dir / post.image
+    f = None
     if post.fullsize:
       fullsize_media_file = self.media_dir / 'full' / post.fullsize
-      if not fullsize_media_file.is_file():
+      # Open the file right away instead of checking if it exists first. This
+      # saves a round trip on network mounted media directories.
+      try:
+        f = fullsize_media_file.open('rb')
+        log.debug(f'Using fullsize image {fullsize_media_file.absolute()}')
+        media_file = fullsize_media_file
+      except (IOError, OSError):
         log.error(
             f'Fullsize image for {post.id} not found at {fullsize_media_file.absolute()}. Falling back to resized image'
         )
-      else:
-        log.debug(f'Using fullsize image {fullsize_media_file.absolute()}')
-        media_file = fullsize_media_file
-
-    if post.type not in self.decoders:
-      raise NotImplementedError(
-          f'Decoder needed for {post} for type {post.type} is not implemented')
 
     try:
-      with media_file.open("rb") as f:
+      if f is None:
+        f = media_file.open('rb')
+      with f:
+        if post.type != PostType.IMAGE:
+          # Videos and animated images are read by the decoder.
+          read_media_service_read_bytes_z.labels(type=post.type.value).inc(
+              os.fstat(f.fileno()).st_size)
         for image in self.decoders[post.type](f):
           yield image
     except (IOError, OSError) as e:
@@ -1,12 +1,18 @@
+import enum
 import logging
-from typing import Collection, NamedTuple
+from typing import Collection, List, NamedTuple
 
+import numpy
+from numpy.typing import NDArray
 from injector import Binder, Module, inject, singleton
+from sqlalchemy.orm import selectinload
 
 from rep0st.db import PostType
 from rep0st.db.post import Flag, Post, PostRepository, PostRepositoryModule
+from rep0st.db.tag import TagFilter
 from rep0st.service.analyze_service import AnalyzeService, AnalyzeServiceModule
-from rep0st.service.media_service import DecodeMediaService, DecodeMediaServiceModule
+from rep0st.service.feature_service import FrameSamplingPolicy, FrameSamplingPolicyModule, decoded_frames, sample_frames
+from rep0st.service.media_service import DecodeMediaService, DecodeMediaServiceModule, media_type_from_buffer
 
 log = logging.getLogger(__name__)
 
@@ -17,12 +23,36 @@ class PostSearchServiceModule(Module):
     binder.install(AnalyzeServiceModule)
     binder.install(PostRepositoryModule)
     binder.install(DecodeMediaServiceModule)
+    binder.install(FrameSamplingPolicyModule)
     binder.bind(PostSearchService)
 
 
+class FrameAggregation(enum.Enum):
+  # Rank posts by the score of their best matching frame.
+  BEST_FRAME = 'BEST_FRAME'
+  # Rank posts by the number of query frames they matched, then by score.
+  FRAME_VOTE = 'FRAME_VOTE'
+
+
+def parse_tag_filter(value: str) -> TagFilter:
+  """Parses a tag filter of the form `name` or `name>confidence`.
+
+  Raises ValueError if the filter is invalid.
+  """
+  pattern, _, min_confidence = value.partition('>')
+  pattern = pattern.strip()
+  if not pattern.strip('*'):
+    raise ValueError(f'Tag filter {value} has no tag name')
+  if not min_confidence:
+    return TagFilter(pattern)
+  return TagFilter(pattern, float(min_confidence))
+
+
 class SearchResult(NamedTuple):
   score: float
   post: Post
+  # Number of query frames the post matched. Always 1 for image queries.
+  matched_frames: int = 1
 
 
 @singleton
@@ -30,32 +60,150 @@ class PostSearchService:
   decode_media_service: DecodeMediaService = None
   analyze_service: AnalyzeService = None
   post_repository: PostRepository = None
+  frame_sampling_policy: FrameSamplingPolicy = None
 
   @inject
   def __init__(self, decode_media_service: DecodeMediaService,
                analyze_service: AnalyzeService,
-               post_repository: PostRepository):
+               post_repository: PostRepository,
+               frame_sampling_policy: FrameSamplingPolicy):
     self.decode_media_service = decode_media_service
     self.analyze_service = analyze_service
     self.post_repository = post_repository
+    self.frame_sampling_policy = frame_sampling_policy
 
-  def search_file(self,
-                  data: bytes,
-                  flags: list[Flag] | None = None,
-                  exact: bool | None = False) -> Collection[SearchResult]:
-    image = list(self.decode_media_service.decode_image_from_buffer(data))[0]
-    feature_vector = self.analyze_service.analyze(image)
-
-    search_results = [
+  def _search_feature_vector(
+      self,
+      type: PostType,
+      feature_vector,
+      flags: list[Flag] | None = None,
+      exact: bool | None = False,
+      tags: list[TagFilter] | None = None) -> Collection[SearchResult]:
+    return [
         SearchResult(score, post)
         for score, post in self.post_repository.search_posts(
-            PostType.IMAGE,
+            type,
             feature_vector,
             flags=flags,
             # Find a lot of candidates to ensure the filter by flag doesn't
             # yield empty results in case of a restrictive search.
             ef_search=1000,
-            exact=exact).limit(50)
+            exact=exact,
+            tags=tags).options(selectinload(Post.tag_summary)).limit(50)
+    ]
+
+  def _search_feature_vectors(
+      self,
+      type: PostType,
+      feature_vectors: List[NDArray[numpy.float32]],
+      flags: list[Flag] | None = None,
+      exact: bool | None = False,
+      aggregation: FrameAggregation = FrameAggregation.BEST_FRAME,
+      tags: list[TagFilter] | None = None) -> Collection[SearchResult]:
+    return [
+        SearchResult(score, post, votes)
+        for score, votes, post in self.post_repository.search_posts_multi(
+            type,
+            feature_vectors,
+            flags=flags,
+            ef_search=1000,
+            exact=exact,
+            order_by_votes=aggregation == FrameAggregation.FRAME_VOTE,
+            tags=tags).options(selectinload(Post.tag_summary)).limit(50)
     ]
 
-    return sorted(search_results, key=lambda sr: sr.score, reverse=True)
+  def _search_image(self,
+                    data: bytes,
+                    flags: list[Flag] | None = None,
+                    exact: bool | None = False,
+                    animated: bool | None = False,
+                    tags: list[TagFilter] | None = None
+                   ) -> Collection[SearchResult]:
+    image = list(self.decode_media_service.decode_image_from_buffer(data))[0]
+    feature_vector = self.analyze_service.analyze(image)
+
+    search_results = self._search_feature_vector(
+        PostType.IMAGE, feature_vector, flags=flags, exact=exact, tags=tags)
+    if animated:
+      # Every type has its own partial index, so search them separately.
+      # Animated posts have multiple frames, only keep the best one per post.
+      best_by_post = {}
+      for sr in self._search_feature_vector(
+          PostType.ANIMATED,
+          feature_vector,
+          flags=flags,
+          exact=exact,
+          tags=tags):
+        if sr.post.id not in best_by_post or best_by_post[
+            sr.post.id].score < sr.score:
+          best_by_post[sr.post.id] = sr
+      search_results = search_results + list(best_by_post.values())
+    return search_results
+
+  def _search_frames(
+      self,
+      data: bytes,
+      media_type: PostType,
+      flags: list[Flag] | None = None,
+      exact: bool | None = False,
+      aggregation: FrameAggregation = FrameAggregation.BEST_FRAME,
+      tags: list[TagFilter] | None = None) -> Collection[SearchResult]:
+    if media_type == PostType.ANIMATED:
+      frames = self.decode_media_service.decode_animated_from_buffer(data)
+    else:
+      frames = self.decode_media_service.decode_video_from_buffer(data)
+    feature_vectors = [
+        self.analyze_service.analyze(frame)
+        for frame in decoded_frames(frames, self.frame_sampling_policy)
+    ]
+    feature_vectors = [
+        feature_vectors[i]
+        for i in sample_frames(feature_vectors, self.frame_sampling_policy)
+    ]
+    if not feature_vectors:
+      return []
+    log.debug(f'Searching with {len(feature_vectors)} frames')
+
+    # Gifs are commonly uploaded as videos and the other way around, so
+    # search both.
+    search_results = []
+    for type in [PostType.VIDEO, PostType.ANIMATED]:
+      search_results += self._search_feature_vectors(
+          type,
+          feature_vectors,
+          flags=flags,
+          exact=exact,
+          aggregation=aggregation,
+          tags=tags)
+    return search_results
+
+  def search_file(
+      self,
+      data: bytes,
+      flags: list[Flag] | None = None,
+      exact: bool | None = False,
+      animated: bool | None = False,
+      aggregation: FrameAggregation = FrameAggregation.BEST_FRAME,
+      tags: list[TagFilter] | None = None) -> Collection[SearchResult]:
+    """Searches posts similar to the media in data.
+
+    If tags are given, only posts matching all of the tag filters are found.
+    """
+    media_type = media_type_from_buffer(data)
+    if media_type == PostType.IMAGE:
+      search_results = self._search_image(
+          data, flags=flags, exact=exact, animated=animated, tags=tags)
+    else:
+      search_results = self._search_frames(
+          data,
+          media_type,
+          flags=flags,
+          exact=exact,
+          aggregation=aggregation,
+          tags=tags)
+
+    if aggregation == FrameAggregation.FRAME_VOTE:
+      key = lambda sr: (sr.matched_frames, sr.score)
+    else:
+      key = lambda sr: sr.score
+    return sorted(search_results, key=key, reverse=True)[:50]
@@ -1,17 +1,39 @@
+from datetime import datetime
 import logging
+import math
+import time
+from typing import List, Tuple
 
+from absl import flags
 from injector import Binder, Module, inject, singleton
 from prometheus_client import Counter
 from prometheus_client.metrics import Gauge
-from sqlalchemy import and_
 
 from rep0st import util
+from rep0st.db.download_queue import PRIORITY_BACKFILL, PRIORITY_NEW, PRIORITY_REPAIR, DownloadQueueRepository, DownloadQueueRepositoryModule
 from rep0st.db.post import Post, PostErrorStatus, PostRepository, PostRepositoryModule
+from rep0st.db.sweep_cursor import SweepCursorRepository, SweepCursorRepositoryModule
 from rep0st.framework.data.transaction import transactional
 from rep0st.pr0gramm.api import Pr0grammAPI, Pr0grammAPIModule
-from rep0st.service.download_media_service import DownloadMediaException, DownloadMediaService, DownloadMediaServiceModule
 
 log = logging.getLogger(__name__)
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('rep0st_post_service_ingest_batch_size_min', 100,
+                     'Minimum number of posts saved in one statement.')
+flags.DEFINE_integer(
+    'rep0st_post_service_ingest_batch_size_max', 2000,
+    'Maximum number of posts saved in one statement. The batch size is tuned '
+    'between the minimum and maximum for the highest throughput.')
+flags.DEFINE_integer(
+    'rep0st_update_all_posts_recent_range', 20000,
+    'Number of the most recent post ids checked most often by the all post '
+    'update. Every older range of ids is twice as large as the one before and '
+    'is checked less often.')
+flags.DEFINE_integer(
+    'rep0st_update_all_posts_batches_per_run', 100,
+    'Number of batches of 1000 posts checked by one run of the all post '
+    'update. The run resumes where the previous one stopped. If 0, every run '
+    'checks all posts.')
 
 post_service_posts_added_z = Counter('rep0st_post_service_posts_added',
                                      'Number of posts added to database')
@@ -20,124 +42,205 @@ post_service_latest_post_id_z = Gauge(
 post_service_latest_post_in_database_z = Gauge(
     'rep0st_post_service_latest_post_in_database',
     'ID of the latest post in the database.')
+post_service_reconciled_posts_z = Counter(
+    'rep0st_post_service_reconciled_posts',
+    'Number of posts changed by the full post update by action.', ['action'])
+for action in ['added', 'deleted', 'undeleted', 'flags_changed']:
+  post_service_reconciled_posts_z.labels(action=action)
+post_service_ingest_batch_size_z = Gauge(
+    'rep0st_post_service_ingest_batch_size',
+    'Number of posts saved in one statement by the post update.')
+post_service_sweep_coverage_z = Gauge(
+    'rep0st_post_service_sweep_coverage',
+    'Fraction of the posts in the range checked by the current pass of the all '
+    'post update by range.', ['tier'])
+post_service_sweep_lag_z = Gauge(
+    'rep0st_post_service_sweep_lag_seconds',
+    'Seconds since the last completed pass of the all post update by range.',
+    ['tier'])
+
+# Number of posts checked in one transaction by the all post update.
+_SWEEP_BATCH_SIZE = 1000
 
 
 class PostServiceModule(Module):
 
   def configure(self, binder: Binder):
     binder.install(Pr0grammAPIModule)
-    binder.install(DownloadMediaServiceModule)
     binder.install(PostRepositoryModule)
+    binder.install(SweepCursorRepositoryModule)
+    binder.install(DownloadQueueRepositoryModule)
     binder.bind(PostService)
 
 
 @singleton
 class PostService:
   api: Pr0grammAPI = None
-  download_media_service: DownloadMediaService = None
   post_repository: PostRepository = None
+  sweep_cursor_repository: SweepCursorRepository = None
+  download_queue_repository: DownloadQueueRepository = None
 
   @inject
-  def __init__(self, api: Pr0grammAPI,
-               download_media_service: DownloadMediaService,
-               post_repository: PostRepository):
+  def __init__(self, api: Pr0grammAPI, post_repository: PostRepository,
+               sweep_cursor_repository: SweepCursorRepository,
+               download_queue_repository: DownloadQueueRepository):
     self.api = api
-    self.download_media_service = download_media_service
     self.post_repository = post_repository
+    self.sweep_cursor_repository = sweep_cursor_repository
+    self.download_queue_repository = download_queue_repository
     post_service_latest_post_in_database_z.set_function(
         self.post_repository.get_latest_post_id)
 
-  def _download_media(self, post: Post):
-    log.debug(f'Downloading media for post {post.id}')
-    try:
-      self.download_media_service.download_media(post)
-      post.error_status = None
-    except DownloadMediaException:
-      post.error_status = PostErrorStatus.NO_MEDIA_FOUND
-      log.exception(f'Error downloading media for post {post.id}')
-
-  @transactional(autoflush=False)
-  def _process_posts(self, posts) -> None:
-    log.debug(f'Processing {len(posts)} posts')
-    for post in posts:
-      self._download_media(post)
+  @transactional()
+  def _ingest_posts(self, posts: List[Post]) -> int:
     log.debug(f'Saving {len(posts)} posts to database')
-    self.post_repository.persist_all(posts)
-    post_service_posts_added_z.inc(len(posts))
+    post_ids = set(
+        self.post_repository.upsert_all(
+            posts, error_status=PostErrorStatus.MEDIA_PENDING))
+    # Metadata is saved at database speed, the download workers catch up with
+    # the media.
+    self.download_queue_repository.enqueue_posts(
+        [post for post in posts if post.id in post_ids], PRIORITY_NEW)
+    post_service_posts_added_z.inc(len(post_ids))
     post_service_latest_post_id_z.set(posts[-1].id)
-    log.debug(f'Processed {len(posts)} posts')
+    return len(post_ids)
 
   def update_posts(self, end_id: int | None = None):
     latest_post = self.post_repository.get_latest_post_id()
     counter = 0
     log.info(f'Starting post update. Latest post {latest_post}')
-    for posts in util.batch(
-        100, self.api.iterate_posts(start=latest_post + 1, end=end_id)):
-      self._process_posts(posts)
-      counter += len(posts)
+    batch_size = util.AdaptiveBatchSize(
+        FLAGS.rep0st_post_service_ingest_batch_size_min,
+        FLAGS.rep0st_post_service_ingest_batch_size_min,
+        FLAGS.rep0st_post_service_ingest_batch_size_max)
+    for posts in util.adaptive_batch(
+        batch_size, self.api.iterate_posts(start=latest_post + 1,
+                                           end=end_id)):
+      start = time.time()
+      counter += self._ingest_posts(posts)
+      batch_size.record(len(posts), time.time() - start)
+      post_service_ingest_batch_size_z.set(batch_size.size)
 
     log.info(
         f'Finished updating posts. {counter} posts were added to the database')
 
   @transactional(autoflush=False)
-  def _process_batch(self, batch_start_id: int, batch_end_id: int):
+  def _process_batch(self,
+                     batch_start_id: int,
+                     batch_end_id: int,
+                     sweep_cursor: str | None = None,
+                     pass_completed: bool = False):
     log.info(f'Processing posts {batch_start_id}-{batch_end_id}')
-    posts_from_api = {
-        p.id: p
-        for p in self.api.iterate_posts(start=batch_start_id, end=batch_end_id)
-    }
-    posts_from_db = {
-        p.id: p for p in self.post_repository.get_posts().filter(
-            and_(Post.id >= batch_start_id, Post.id <= batch_end_id))
-    }
-    to_save = []
-    for i in range(batch_start_id, batch_end_id + 1):
-      post_from_db = posts_from_db.get(i, None)
-      post_from_api = posts_from_api.get(i, None)
-      if post_from_api and not post_from_db:
-        # Post returned by API, but is not in DB.
-        log.debug(f'Adding missing post: {post_from_api}')
-        self._download_media(post_from_api)
-        to_save.append(post_from_api)
-        continue
-      if not post_from_db:
-        # We never saw this post and it doesn't exist. Nothing we can do to bring it back :(
-        log.debug(f'Ignoring post with id {i} since we never saw it')
-        continue
-      if not post_from_api:
-        # Post not returned by API, but it is in DB.
-        # Mark as deleted.
-        if not post_from_db.deleted:
-          log.debug(
-              f'Marking post deleted since it is no longer in the API: {post_from_db}'
-          )
-          post_from_db.feature_vectors = []
-          post_from_db.deleted = True
-          # Remove the features from the DB for good measure.
-          post_from_db.features = []
-          post_from_db.features_indexed = False
-          to_save.append(post_from_db)
-        continue
-      # Post is in both DB and API. Potentially update it.
-      if post_from_db.deleted:
-        log.debug(
-            f'Unmarking post as deleted since the API contains it: {post_from_db}'
-        )
-        post_from_db.deleted = False
-      if post_from_db.flags != post_from_api.flags:
-        log.debug(
-            f'Updating flags of post since they changed: {post_from_db}. post_from_db.flags={post_from_db.flags}, post_from_api.flags={post_from_api.flags}'
-        )
-        post_from_db.flags = post_from_api.flags
-      old_error_status = post_from_db.error_status
-      # Download media if not exists or broken.
-      self._download_media(post_from_db)
-      if old_error_status != post_from_db.error_status:
-        # Remove the features. The update feature job will try to index the media again on the next run.
-        post_from_db.features = []
-        post_from_db.features_indexed = False
-      to_save.append(post_from_db)
-    self.post_repository.persist_all(to_save)
+    posts_from_api = list(
+        self.api.iterate_posts(start=batch_start_id, end=batch_end_id))
+    result = self.post_repository.reconcile_posts(posts_from_api,
+                                                  batch_start_id, batch_end_id)
+    log.debug(
+        f'Reconciled posts {batch_start_id}-{batch_end_id}: {len(result.missing_ids)} missing, '
+        f'{len(result.deleted_ids)} deleted, {len(result.undeleted_ids)} undeleted, '
+        f'{result.flags_changed} with changed flags')
+    post_service_reconciled_posts_z.labels(action='added').inc(
+        len(result.missing_ids))
+    post_service_reconciled_posts_z.labels(action='deleted').inc(
+        len(result.deleted_ids))
+    post_service_reconciled_posts_z.labels(action='undeleted').inc(
+        len(result.undeleted_ids))
+    post_service_reconciled_posts_z.labels(action='flags_changed').inc(
+        result.flags_changed)
+
+    # Only posts whose state changed need their media checked: new posts and
+    # posts that came back. Posts with media errors are retried by the media
+    # retry job.
+    missing_ids = set(result.missing_ids)
+    new_posts = [post for post in posts_from_api if post.id in missing_ids]
+    for post in new_posts:
+      post.error_status = PostErrorStatus.MEDIA_PENDING
+    self.post_repository.persist_all(new_posts)
+    self.download_queue_repository.enqueue_posts(new_posts, PRIORITY_BACKFILL)
+    if result.undeleted_ids:
+      self.download_queue_repository.enqueue_posts(
+          self.post_repository.get_by_ids(result.undeleted_ids).all(),
+          PRIORITY_REPAIR)
+    if sweep_cursor:
+      # Advance the cursor in the same transaction, so a batch is never
+      # skipped.
+      self.sweep_cursor_repository.advance(sweep_cursor, batch_end_id,
+                                           pass_completed)
+
+  def _sweep_tiers(self, start_id: int, end_id: int) -> List[Tuple[int, int]]:
+    # The most recent ids change the most, so they are split into the
+    # smallest range. Every older range is twice as large as the one before.
+    tiers = []
+    tier_end = end_id
+    tier_size = max(FLAGS.rep0st_update_all_posts_recent_range,
+                    _SWEEP_BATCH_SIZE)
+    while tier_end >= start_id:
+      tier_start = max(start_id, tier_end - tier_size + 1)
+      tiers.append((tier_start, tier_end))
+      tier_end = tier_start - 1
+      tier_size *= 2
+    return tiers
+
+  def _allocate_batches(self, tiers: List[Tuple[int, int]],
+                        budget: int) -> List[int]:
+    # Every tier gets half of the remaining budget, but no more than one pass.
+    # Every tier gets at least one batch, so old posts are still checked
+    # eventually.
+    allocation = []
+    for i, (tier_start, tier_end) in enumerate(tiers):
+      tier_batches = math.ceil((tier_end - tier_start + 1) / _SWEEP_BATCH_SIZE)
+      share = budget if i == len(tiers) - 1 else budget // 2
+      batches = min(tier_batches, max(1, share))
+      budget = max(0, budget - batches)
+      allocation.append(batches)
+    return allocation
+
+  @transactional()
+  def _resume_sweep(self, name: str, tier_start: int, tier_end: int) -> int:
+    cursor = self.sweep_cursor_repository.get_cursor(name)
+    if cursor.pass_started is None or cursor.position >= tier_end:
+      log.info(f'Starting new pass of {name} at post {tier_start}')
+      cursor.pass_started = datetime.utcnow()
+      cursor.position = tier_start - 1
+    # The tiers move up with new posts. Ids below the tier were moved to the
+    # next tier and are checked there.
+    cursor.position = max(cursor.position, tier_start - 1)
+    return cursor.position
+
+  @transactional()
+  def _update_sweep_metrics(self, name: str, tier: int, tier_start: int,
+                            tier_end: int):
+    cursor = self.sweep_cursor_repository.get_cursor(name)
+    coverage = (cursor.position - tier_start + 1) / (tier_end - tier_start + 1)
+    if cursor.pass_started is None:
+      coverage = 1.0
+    post_service_sweep_coverage_z.labels(tier=tier).set(
+        min(max(coverage, 0.0), 1.0))
+    if cursor.pass_completed:
+      post_service_sweep_lag_z.labels(tier=tier).set(
+          (datetime.utcnow() - cursor.pass_completed).total_seconds())
+
+  def _sweep_tier(self, tier: int, tier_start: int, tier_end: int,
+                  batches: int):
+    name = f'update_all_posts_tier_{tier}'
+    position = self._resume_sweep(name, tier_start, tier_end)
+    log.info(
+        f'Checking up to {batches} batches of posts {tier_start}-{tier_end} starting at {position + 1}'
+    )
+    for _ in range(batches):
+      batch_start_id = position + 1
+      batch_end_id = min(batch_start_id + _SWEEP_BATCH_SIZE - 1, tier_end)
+      pass_completed = batch_end_id >= tier_end
+      self._process_batch(
+          batch_start_id,
+          batch_end_id,
+          sweep_cursor=name,
+          pass_completed=pass_completed)
+      position = batch_end_id
+      if pass_completed:
+        log.info(f'Completed pass of {name}')
+        break
+    self._update_sweep_metrics(name, tier, tier_start, tier_end)
 
   def update_all_posts(self,
                        start_id: int | None = 1,
@@ -153,6 +256,13 @@ class PostService:
       end_id = min(max(max_post_id_from_api, max_post_id_from_db), end_id)
     else:
       end_id = max(max_post_id_from_api, max_post_id_from_db)
-    for batch_start_id, batch_end_id in util.batched_ranges(
-        start_id, end_id, 1000):
-      self._process_batch(batch_start_id, batch_end_id)
+    budget = FLAGS.rep0st_update_all_posts_batches_per_run
+    if not budget:
+      for batch_start_id, batch_end_id in util.batched_ranges(
+          start_id, end_id, _SWEEP_BATCH_SIZE):
+        self._process_batch(batch_start_id, batch_end_id)
+      return
+    tiers = self._sweep_tiers(start_id, end_id)
+    for tier, ((tier_start, tier_end), batches) in enumerate(
+        zip(tiers, self._allocate_batches(tiers, budget))):
+      self._sweep_tier(tier, tier_start, tier_end, batches)
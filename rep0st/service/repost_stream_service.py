@@ -0,0 +1,395 @@
+from datetime import datetime, timedelta, timezone
+import json
+import logging
+import queue
+import select
+import threading
+import time
+from typing import Collection, Dict, Iterator, List, NamedTuple
+
+from absl import flags
+from injector import Binder, Module, inject, singleton
+import numpy
+from numpy.typing import NDArray
+from prometheus_client import Counter, Gauge
+import requests
+from werkzeug import Request, Response
+from werkzeug.routing import Rule
+
+from rep0st.config.rep0st_database import Rep0stDatabaseModule
+from rep0st.db import PostType
+from rep0st.db.feature import FeatureVector
+from rep0st.db.post import Post
+from rep0st.db.post_duplicate import REPOST_CHANNEL, PostDuplicateRepository
+from rep0st.framework.data.database import DatabaseEngine
+from rep0st.framework.data.transaction import transactional
+from rep0st.framework.signal_handler import on_shutdown
+from rep0st.framework.web import endpoint
+from rep0st.service.duplicate_service import DuplicateService, DuplicateServiceModule
+
+log = logging.getLogger(__name__)
+FLAGS = flags.FLAGS
+flags.DEFINE_bool(
+    'rep0st_repost_stream', False,
+    'If True, new posts are checked for reposts right after their features '
+    'were indexed and matches are published to the database and the webhook. '
+    'The web application serves the published matches on '
+    '/api/reposts/stream if this is True.')
+flags.DEFINE_integer(
+    'rep0st_repost_stream_max_age', 3600,
+    'Only posts created at most this many seconds ago are checked. Older '
+    'posts are indexed by backfills and are not of interest.')
+flags.DEFINE_integer(
+    'rep0st_repost_stream_queue_size', 1000,
+    'Maximum number of posts waiting to be checked. Posts are dropped if the '
+    'check does not keep up.')
+flags.DEFINE_integer('rep0st_repost_stream_batch_size', 50,
+                     'Maximum number of posts checked per transaction.')
+flags.DEFINE_integer(
+    'rep0st_repost_stream_subscriber_queue_size', 100,
+    'Maximum number of matches buffered per stream subscriber. Matches are '
+    'dropped for subscribers not reading fast enough.')
+flags.DEFINE_integer(
+    'rep0st_repost_stream_max_subscribers', 2,
+    'Maximum number of concurrent stream subscribers. Every subscriber holds '
+    'a webserver thread, so this can be at most half of --webserver_threads.')
+flags.DEFINE_integer(
+    'rep0st_repost_stream_keepalive', 5,
+    'Seconds after which a comment is sent to idle stream subscribers. The '
+    'webserver thread of a disconnected subscriber is freed with the next '
+    'write.')
+flags.DEFINE_string('rep0st_repost_webhook_url', None,
+                    'URL matches are POSTed to as a JSON list.')
+flags.DEFINE_integer('rep0st_repost_webhook_batch_size', 50,
+                     'Maximum number of matches sent per webhook request.')
+flags.DEFINE_float(
+    'rep0st_repost_webhook_interval', 5.0,
+    'Seconds matches are collected for before they are sent to the webhook.')
+flags.DEFINE_integer(
+    'rep0st_repost_webhook_queue_size', 1000,
+    'Maximum number of matches waiting to be sent to the webhook. Matches '
+    'are dropped if the webhook does not keep up.')
+flags.DEFINE_float('rep0st_repost_webhook_timeout', 10.0,
+                   'Timeout in seconds of a webhook request.')
+
+repost_stream_posts_checked_z = Counter(
+    'rep0st_repost_stream_posts_checked', 'Number of posts checked for reposts.')
+repost_stream_matches_z = Counter('rep0st_repost_stream_matches',
+                                  'Number of posts found to be reposts.')
+repost_stream_dropped_z = Counter(
+    'rep0st_repost_stream_dropped',
+    'Number of posts or matches dropped because a queue was full.', ['queue'])
+repost_stream_published_z = Counter(
+    'rep0st_repost_stream_published',
+    'Number of matches published to the database.')
+repost_stream_subscribers_z = Gauge('rep0st_repost_stream_subscribers',
+                                    'Number of connected stream subscribers.')
+repost_stream_webhook_requests_z = Counter(
+    'rep0st_repost_stream_webhook_requests',
+    'Number of requests sent to the webhook.', ['result'])
+for queue_name in ['check', 'subscriber', 'webhook']:
+  repost_stream_dropped_z.labels(queue=queue_name)
+for result in ['success', 'error']:
+  repost_stream_webhook_requests_z.labels(result=result)
+
+
+class IndexedPost(NamedTuple):
+  id: int
+  type: PostType
+  created: datetime
+  feature_vectors: List[NDArray[numpy.float32]]
+
+
+# Postgres drops notifications with a payload of 8000 bytes or more.
+_MAX_PAYLOAD = 7900
+
+
+class RepostStreamServiceModule(Module):
+
+  def configure(self, binder: Binder):
+    binder.install(DuplicateServiceModule)
+    binder.bind(RepostStreamService)
+
+
+class RepostFeedServiceModule(Module):
+
+  def configure(self, binder: Binder):
+    if (FLAGS.rep0st_repost_stream and
+        FLAGS.rep0st_repost_stream_max_subscribers * 2 >
+        FLAGS.webserver_threads):
+      # Fail on startup instead of when subscribers starve other requests.
+      raise ValueError(
+          f'rep0st_repost_stream_max_subscribers={FLAGS.rep0st_repost_stream_max_subscribers} '
+          f'must be at most half of webserver_threads={FLAGS.webserver_threads}. '
+          'Every subscriber holds a webserver thread.')
+    binder.install(Rep0stDatabaseModule)
+    binder.bind(RepostFeedService)
+
+
+def _is_recent(created: datetime) -> bool:
+  if created is None:
+    return False
+  if created.tzinfo is None:
+    created = created.replace(tzinfo=timezone.utc)
+  max_age = timedelta(seconds=FLAGS.rep0st_repost_stream_max_age)
+  return created >= datetime.now(timezone.utc) - max_age
+
+
+def _put(q: queue.Queue, item, queue_name: str) -> None:
+  try:
+    q.put_nowait(item)
+  except queue.Full:
+    repost_stream_dropped_z.labels(queue=queue_name).inc()
+
+
+def _payload(match: dict) -> str:
+  payload = json.dumps(match)
+  if len(payload) < _MAX_PAYLOAD:
+    return payload
+  # Keep the most similar reposts that fit.
+  match = dict(match, reposts=list(match['reposts']))
+  while len(payload) >= _MAX_PAYLOAD and match['reposts']:
+    match['reposts'].pop()
+    payload = json.dumps(match)
+  return payload
+
+
+@singleton
+class RepostStreamService:
+  """Publishes reposts among newly indexed posts as they are found.
+
+  Indexing services hand the posts they committed features for to submit().
+  Posts are checked on a separate thread and matches are published with a
+  NOTIFY on REPOST_CHANNEL, so the web application serves them no matter
+  which job found them. All queues are bounded and drop when full, so a slow
+  webhook never blocks indexing.
+  """
+  duplicate_service: DuplicateService
+  post_duplicate_repository: PostDuplicateRepository
+
+  @inject
+  def __init__(self, duplicate_service: DuplicateService,
+               post_duplicate_repository: PostDuplicateRepository):
+    self.duplicate_service = duplicate_service
+    self.post_duplicate_repository = post_duplicate_repository
+    self._posts = queue.Queue(maxsize=FLAGS.rep0st_repost_stream_queue_size)
+    self._webhook = queue.Queue(
+        maxsize=FLAGS.rep0st_repost_webhook_queue_size)
+    self._lock = threading.Lock()
+    self._started = False
+    self._stop = threading.Event()
+
+  def _start(self) -> None:
+    with self._lock:
+      if self._started:
+        return
+      self._started = True
+    threading.Thread(
+        name='Repost check', target=self._check_thread, daemon=True).start()
+    if FLAGS.rep0st_repost_webhook_url:
+      threading.Thread(
+          name='Repost webhook', target=self._webhook_thread,
+          daemon=True).start()
+
+  def snapshot(self, posts: Collection[Post],
+               feature_vectors: Collection[FeatureVector]) -> List[IndexedPost]:
+    """Copies what is needed to check the recent posts.
+
+    Has to be called before the transaction saving the features ends, the
+    result can be passed to submit() once it is committed.
+    """
+    if not FLAGS.rep0st_repost_stream:
+      return []
+    vectors: Dict[int, List[NDArray[numpy.float32]]] = {}
+    for feature_vector in feature_vectors:
+      vectors.setdefault(feature_vector.post.id, []).append(feature_vector.vec)
+    return [
+        IndexedPost(post.id, post.type, post.created, vectors[post.id])
+        for post in posts
+        if post.id in vectors and _is_recent(post.created)
+    ]
+
+  def submit(self, indexed_posts: Collection[IndexedPost]) -> None:
+    """Queues the posts to be checked. Never blocks."""
+    if not indexed_posts:
+      return
+    self._start()
+    for indexed_post in indexed_posts:
+      _put(self._posts, indexed_post, 'check')
+
+  @transactional()
+  def _check(self, indexed_posts: List[IndexedPost]) -> List[dict]:
+    matches = []
+    for indexed_post in indexed_posts:
+      duplicates = self.duplicate_service.find_duplicates(
+          Post(id=indexed_post.id, type=indexed_post.type),
+          indexed_post.feature_vectors)
+      if not duplicates:
+        continue
+      matches.append({
+          'post_id': indexed_post.id,
+          'created': indexed_post.created.isoformat(),
+          'reposts': [{
+              'post_id': duplicate.duplicate_id,
+              'similarity': duplicate.score
+          } for duplicate in sorted(duplicates, key=lambda d: -d.score)]
+      })
+    # Sent when the transaction commits.
+    self.post_duplicate_repository.notify_reposts(
+        [_payload(match) for match in matches])
+    repost_stream_posts_checked_z.inc(len(indexed_posts))
+    repost_stream_matches_z.inc(len(matches))
+    repost_stream_published_z.inc(len(matches))
+    return matches
+
+  def _check_thread(self) -> None:
+    while not self._stop.is_set():
+      try:
+        batch = [self._posts.get(timeout=1.0)]
+      except queue.Empty:
+        continue
+      while len(batch) < FLAGS.rep0st_repost_stream_batch_size:
+        try:
+          batch.append(self._posts.get_nowait())
+        except queue.Empty:
+          break
+      try:
+        matches = self._check(batch)
+      except Exception:
+        log.exception(f'Error checking {len(batch)} posts for reposts')
+        continue
+      for match in matches:
+        log.info(f'Post {match["post_id"]} is a repost')
+        if FLAGS.rep0st_repost_webhook_url:
+          _put(self._webhook, match, 'webhook')
+
+  def _webhook_thread(self) -> None:
+    session = requests.Session()
+    while not self._stop.is_set():
+      try:
+        batch = [self._webhook.get(timeout=1.0)]
+      except queue.Empty:
+        continue
+      deadline = time.monotonic() + FLAGS.rep0st_repost_webhook_interval
+      while len(batch) < FLAGS.rep0st_repost_webhook_batch_size:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          break
+        try:
+          batch.append(self._webhook.get(timeout=remaining))
+        except queue.Empty:
+          break
+      try:
+        resp = session.post(
+            FLAGS.rep0st_repost_webhook_url,
+            json=batch,
+            timeout=FLAGS.rep0st_repost_webhook_timeout)
+        resp.raise_for_status()
+        repost_stream_webhook_requests_z.labels(result='success').inc()
+      except requests.RequestException as e:
+        # Matches are not retried, the webhook gets the next batch.
+        log.warning(f'Could not send {len(batch)} matches to webhook: {e}')
+        repost_stream_webhook_requests_z.labels(result='error').inc()
+
+  @on_shutdown()
+  def handle_shutdown(self):
+    self._stop.set()
+
+
+@singleton
+class RepostFeedService:
+  """Serves the reposts published by RepostStreamService to subscribers.
+
+  A single connection listens on REPOST_CHANNEL once the first subscriber
+  connects and hands every match to all subscribers. Subscriber queues are
+  bounded and drop when full, so slow subscribers do not hold back others.
+  """
+  database_engine: DatabaseEngine
+
+  @inject
+  def __init__(self, database_engine: DatabaseEngine):
+    self.database_engine = database_engine
+    self._subscribers: List[queue.Queue] = []
+    self._lock = threading.Lock()
+    self._started = False
+    self._stop = threading.Event()
+    repost_stream_subscribers_z.set_function(lambda: len(self._subscribers))
+
+  def _start(self) -> None:
+    with self._lock:
+      if self._started:
+        return
+      self._started = True
+    threading.Thread(
+        name='Repost listener', target=self._listen_thread,
+        daemon=True).start()
+
+  def _publish(self, payload: str) -> None:
+    with self._lock:
+      subscribers = list(self._subscribers)
+    for subscriber in subscribers:
+      _put(subscriber, payload, 'subscriber')
+
+  def _listen(self) -> None:
+    with self.database_engine.connect().execution_options(
+        isolation_level='AUTOCOMMIT') as connection:
+      connection.exec_driver_sql(f'LISTEN {REPOST_CHANNEL}')
+      dbapi_connection = connection.connection.driver_connection
+      log.info(f'Listening for reposts on channel {REPOST_CHANNEL}')
+      while not self._stop.is_set():
+        if select.select([dbapi_connection], [], [], 1.0) == ([], [], []):
+          continue
+        dbapi_connection.poll()
+        while dbapi_connection.notifies:
+          self._publish(dbapi_connection.notifies.pop(0).payload)
+      connection.exec_driver_sql(f'UNLISTEN {REPOST_CHANNEL}')
+
+  def _listen_thread(self) -> None:
+    while not self._stop.is_set():
+      try:
+        self._listen()
+      except Exception:
+        # Matches published while reconnecting are lost.
+        log.exception('Error listening for reposts, reconnecting')
+        self._stop.wait(5.0)
+
+  def _stream(self, subscriber: queue.Queue) -> Iterator[str]:
+    yield ': connected\n\n'
+    while not self._stop.is_set():
+      try:
+        payload = subscriber.get(timeout=FLAGS.rep0st_repost_stream_keepalive)
+      except queue.Empty:
+        yield ': keepalive\n\n'
+        continue
+      yield f'event: repost\ndata: {payload}\n\n'
+
+  def _unsubscribe(self, subscriber: queue.Queue) -> None:
+    with self._lock:
+      if subscriber in self._subscribers:
+        self._subscribers.remove(subscriber)
+
+  @endpoint(Rule('/api/reposts/stream', methods=['GET']))
+  def stream(self, request: Request) -> Response:
+    if not FLAGS.rep0st_repost_stream:
+      return Response('repost stream is deactivated', status=404)
+    subscriber = queue.Queue(
+        maxsize=FLAGS.rep0st_repost_stream_subscriber_queue_size)
+    with self._lock:
+      if len(self._subscribers) >= FLAGS.rep0st_repost_stream_max_subscribers:
+        return Response('too many subscribers', status=503)
+      self._subscribers.append(subscriber)
+    self._start()
+    resp = Response(
+        self._stream(subscriber),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+    # Called by the server once the client is gone.
+    resp.call_on_close(lambda: self._unsubscribe(subscriber))
+    return resp
+
+  @on_shutdown()
+  def handle_shutdown(self):
+    self._stop.set()
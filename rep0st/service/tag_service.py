@@ -1,12 +1,22 @@
 import logging
+from typing import List
 
+from absl import flags
 from injector import Module, inject, singleton
 
 from rep0st import util
-from rep0st.db.tag import TagRepository, TagRepositoryModule
+from rep0st.db.tag import Tag, TagRepository, TagRepositoryModule
+from rep0st.framework.data.transaction import transactional
 from rep0st.pr0gramm.api import Pr0grammAPI
 
 log = logging.getLogger(__name__)
+FLAGS = flags.FLAGS
+flags.DEFINE_integer(
+    'rep0st_update_tags_lookback', 10000,
+    'Number of tag ids before the latest saved tag fetched again on every run, '
+    'so votes of recent tags are updated.')
+flags.DEFINE_integer('rep0st_post_tag_summary_size', 10,
+                     'Number of tags kept in the tag summary of a post.')
 
 
 class TagServiceModule(Module):
@@ -26,13 +36,34 @@ class TagService:
     self.api = api
     self.tag_repository = tag_repository
 
+  @transactional()
+  def _save_tags(self, tags: List[Tag]) -> None:
+    self.tag_repository.upsert_all(tags)
+    # Only the summaries of posts with changed tags are updated.
+    self.tag_repository.update_summaries({tag.post_id for tag in tags},
+                                         FLAGS.rep0st_post_tag_summary_size)
+
+  def _create_summaries(self) -> None:
+    start, end = self.tag_repository.get_tagged_post_id_range()
+    log.info(f'Creating tag summaries of posts {start}-{end}')
+    for batch_start, batch_end in util.batched_ranges(start, end + 1, 10000):
+      self.tag_repository.update_summaries(
+          range(batch_start, batch_end + 1),
+          FLAGS.rep0st_post_tag_summary_size)
+
   def update_tags(self):
+    if not self.tag_repository.has_summaries():
+      self._create_summaries()
     latest_tag = self.tag_repository.get_latest_tag_id()
-    log.info(f'Starting tag updated. Latest tag {latest_tag}')
+    start = max(1, latest_tag - FLAGS.rep0st_update_tags_lookback)
+    log.info(
+        f'Starting tag updated. Latest tag {latest_tag}, starting at {start}')
     counter = 0
-    for batch in util.batch(10000, self.api.iterate_tags(start=latest_tag)):
+    # The API prefetches the next pages while a batch is saved.
+    for batch in util.batch(10000, self.api.iterate_tags(start=start)):
       counter += len(batch)
       log.info(f'Saving {len(batch)} tags')
-      self.tag_repository.persist_bulk(batch)
+      self._save_tags(batch)
     log.info(
-        f'Finished updating tags. {counter} tags were added to the database')
+        f'Finished updating tags. {counter} tags were added or updated in the database'
+    )
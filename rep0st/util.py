@@ -1,5 +1,7 @@
 from itertools import islice
 import logging
+import queue
+import threading
 from typing import Callable, Iterable, Iterator, List, TypeVar
 
 import numpy
@@ -17,6 +19,50 @@ def batch(n: int, i: Iterator[T]) -> Iterable[List[T]]:
     piece = list(islice(i, n))
 
 
+class AdaptiveBatchSize:
+  """Batch size tuned to the highest throughput.
+
+  The size is changed by factor after every full batch. It keeps moving in the
+  same direction as long as the throughput increases and turns around once it
+  drops, so it settles around the best size.
+  """
+  size: int = None
+  minimum: int = None
+  maximum: int = None
+  factor: float = None
+
+  def __init__(self,
+               initial: int,
+               minimum: int,
+               maximum: int,
+               factor: float = 1.5):
+    self.minimum = max(minimum, 1)
+    self.maximum = max(maximum, self.minimum)
+    self.size = min(max(initial, self.minimum), self.maximum)
+    self.factor = factor
+    self._grow = True
+    self._last_throughput = None
+
+  def record(self, count: int, seconds: float) -> None:
+    # Partial batches are not comparable to full ones.
+    if count < self.size or seconds <= 0:
+      return
+    throughput = count / seconds
+    if self._last_throughput is not None and throughput < self._last_throughput:
+      self._grow = not self._grow
+    self._last_throughput = throughput
+    size = self.size * self.factor if self._grow else self.size / self.factor
+    self.size = min(max(int(size), self.minimum), self.maximum)
+
+
+def adaptive_batch(batch_size: AdaptiveBatchSize,
+                   i: Iterator[T]) -> Iterable[List[T]]:
+  piece = list(islice(i, batch_size.size))
+  while piece:
+    yield piece
+    piece = list(islice(i, batch_size.size))
+
+
 def batched_ranges(start, end, batch_size):
   for i in range(start, end, batch_size):
     yield (i, min(i + batch_size - 1, end))
@@ -45,3 +91,58 @@ def get_secret(content, file_flag):
     with open(file_flag, 'r') as file:
       content = file.read().strip()
   return content
+
+
+class _PrefetchDone:
+  pass
+
+
+class _PrefetchError:
+
+  def __init__(self, e: BaseException):
+    self.e = e
+
+
+def prefetch(it: Iterable[T], n: int, name: str = 'Prefetch') -> Iterator[T]:
+  """Consumes the iterable in a background thread, up to n elements ahead.
+
+  Exceptions raised by the iterable are reraised in the consumer. If the
+  consumer stops early, the background thread stops after its current element.
+  """
+  if n <= 0:
+    yield from it
+    return
+
+  buffer = queue.Queue(maxsize=n)
+  stop = threading.Event()
+
+  def _put(e):
+    while not stop.is_set():
+      try:
+        buffer.put(e, timeout=1)
+        return True
+      except queue.Full:
+        continue
+    return False
+
+  def _produce():
+    try:
+      for e in it:
+        if not _put(e):
+          return
+      _put(_PrefetchDone)
+    except BaseException as e:
+      _put(_PrefetchError(e))
+
+  thread = threading.Thread(name=name, target=_produce, daemon=True)
+  thread.start()
+  try:
+    while True:
+      e = buffer.get()
+      if e is _PrefetchDone:
+        return
+      if isinstance(e, _PrefetchError):
+        raise e.e
+      yield e
+  finally:
+    stop.set()
@@ -4,15 +4,18 @@ from typing import Any
 
 from absl import flags
 from injector import Module, inject, singleton
+from sqlalchemy.orm import selectinload
 from werkzeug import Request, Response
 from werkzeug.routing import Rule
 
-from rep0st.db.post import PostRepository
+from rep0st.db.post import Post, PostRepository
 from rep0st.framework.app import COMMIT_SHA
 from rep0st.framework.data.transaction import transactional
 from rep0st.framework.web import endpoint
+from rep0st.service.duplicate_service import DuplicateService, DuplicateServiceModule
 from rep0st.service.media_service import ImageDecodeException, NoMediaFoundException
-from rep0st.service.post_search_service import PostSearchService, PostSearchServiceModule
+from rep0st.service.post_search_service import FrameAggregation, PostSearchService, PostSearchServiceModule, parse_tag_filter
+from rep0st.service.repost_stream_service import RepostFeedServiceModule
 from rep0st.util import AutoJSONEncoder
 from rep0st.web import MediaHelper
 
@@ -25,6 +28,8 @@ class ApiModule(Module):
 
   def configure(self, binder):
     binder.install(PostSearchServiceModule)
+    binder.install(DuplicateServiceModule)
+    binder.install(RepostFeedServiceModule)
     binder.bind(Api)
 
 
@@ -32,12 +37,15 @@ class ApiModule(Module):
 class Api(MediaHelper):
   post_search_service: PostSearchService = None
   post_repository: PostRepository = None
+  duplicate_service: DuplicateService = None
 
   @inject
   def __init__(self, post_search_service: PostSearchService,
-               post_repository: PostRepository):
+               post_repository: PostRepository,
+               duplicate_service: DuplicateService):
     self.post_search_service = post_search_service
     self.post_repository = post_repository
+    self.duplicate_service = duplicate_service
 
   def render(self,
              resp: Any = None,
@@ -62,9 +70,28 @@ class Api(MediaHelper):
         },
         status=200)
 
-  def _search(self, data: bytes, exact: bool | None = False) -> Response:
+  def _search(self,
+              request: Request,
+              data: bytes,
+              exact: bool | None = False) -> Response:
+    animated = request.args.get('animated', False, bool)
     try:
-      results = self.post_search_service.search_file(data, exact=exact)
+      aggregation = FrameAggregation(
+          request.args.get('aggregation', FrameAggregation.BEST_FRAME.value,
+                           str).upper())
+    except ValueError:
+      return self.render(error='invalid aggregation', status=400)
+    try:
+      tags = [parse_tag_filter(tag) for tag in request.args.getlist('tag')]
+    except ValueError:
+      return self.render(error='invalid tag filter', status=400)
+    try:
+      results = self.post_search_service.search_file(
+          data,
+          exact=exact,
+          animated=animated,
+          aggregation=aggregation,
+          tags=tags)
     except (NoMediaFoundException, ImageDecodeException):
       return self.render(error='invalid image', status=400)
     except:
@@ -74,6 +101,7 @@ class Api(MediaHelper):
 
     return self.render(resp=[{
         'similarity': sr.score,
+        'matched_frames': sr.matched_frames,
         'post': sr.post
     } for sr in results])
 
@@ -90,7 +118,7 @@ class Api(MediaHelper):
     except:
       return self.render(error='no image', status=400)
 
-    return self._search(data, exact=exact)
+    return self._search(request, data, exact=exact)
 
   @transactional()
   @endpoint(Rule('/api/search', methods=['GET']))
@@ -105,4 +133,26 @@ class Api(MediaHelper):
     data = self.file_from_url(url)
     if not data:
       return self.render(error='could not load image from url', status=400)
-    return self._search(data, exact=exact)
+    return self._search(request, data, exact=exact)
+
+  @transactional()
+  @endpoint(Rule('/api/post/<int:post_id>/reposts', methods=['GET']))
+  def reposts(self, request: Request, post_id: int):
+    post = self.post_repository.get_by_id(post_id).one_or_none()
+    if post is None:
+      return self.render(error='post not found', status=404)
+    members = self.duplicate_service.get_reposts(post_id)
+    posts = {
+        p.id: p for p in self.post_repository.get_by_ids(
+            [member.post_id for member in members]).options(
+                selectinload(Post.tag_summary))
+    }
+    return self.render(
+        resp={
+            'post_id': post_id,
+            'cluster_id': self.duplicate_service.get_cluster_id(post_id),
+            'reposts': [{
+                'similarity': member.score,
+                'post': posts[member.post_id]
+            } for member in members if member.post_id in posts]
+        })
@@ -132,6 +132,8 @@ class Main(MediaHelper):
           error='Zumindest ein Filter muss ausgewählt sein!',
           flags=flags)
 
+    animated = request.form.get('animated', False, bool)
+
     exact = request.args.get('exact', False, bool)
     if exact and not FLAGS.rep0st_web_enable_exact_search:
       return self.render(
@@ -161,8 +163,9 @@ class Main(MediaHelper):
 
     try:
       results = self.post_search_service.search_file(
-          data, flags=flags, exact=exact)
-      return self.render(search_results=results, flags=flags)
+          data, flags=flags, exact=exact, animated=animated)
+      return self.render(
+          search_results=results, flags=flags, animated=animated)
     except (NoMediaFoundException, ImageDecodeException):
       return self.render(status=400, error='Ungültiges Bild!', flags=flags)
     except Exception: